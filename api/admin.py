@@ -1,9 +1,61 @@
+from django import forms
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 
+from . import importer
 from .models import Organization, OrganizationUser, Delivery, Deal, MinistryOrder, HospitalOrder, PaymentLetter, ProducerOffer, Payment
+from .models import HospitalOrderMirror, MinistryOrderMirror, DeliveryMirror, PaymentLetterMirror, ProducerOfferMirror, ProducerStockMirror, LedgerTransaction, IdempotencyKey, Settlement
 
 
-admin.site.register(Organization)
+class OrganizationImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV or XLSX file with name and group columns.')
+    group = forms.ChoiceField(
+        choices=[('', 'From the group column')] + [(group, group) for group in importer.IMPORT_GROUPS],
+        required=False
+    )
+
+
+class OrganizationAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/api/organization/change_list.html'
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='api_organization_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        """
+        Import organizations from a CSV or XLSX file.
+        """
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        form = OrganizationImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            try:
+                created, skipped = importer.import_organizations(
+                    upload.read(), upload.name, group=form.cleaned_data['group'] or None
+                )
+            except importer.InvalidImport as inst:
+                form.add_error('file', str(inst))
+            else:
+                self.message_user(request, '{} organizations imported, {} already existing skipped.'.format(len(created), skipped))
+                return redirect('admin:api_organization_changelist')
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            form=form,
+            title='Import organizations'
+        )
+        return TemplateResponse(request, 'admin/api/organization/import.html', context)
+
+
+admin.site.register(Organization, OrganizationAdmin)
 admin.site.register(OrganizationUser)
 admin.site.register(Delivery)
 admin.site.register(Deal)
@@ -12,3 +64,13 @@ admin.site.register(HospitalOrder)
 admin.site.register(PaymentLetter)
 admin.site.register(ProducerOffer)
 admin.site.register(Payment)
+
+admin.site.register(HospitalOrderMirror)
+admin.site.register(MinistryOrderMirror)
+admin.site.register(DeliveryMirror)
+admin.site.register(PaymentLetterMirror)
+admin.site.register(ProducerOfferMirror)
+admin.site.register(ProducerStockMirror)
+admin.site.register(LedgerTransaction)
+admin.site.register(IdempotencyKey)
+admin.site.register(Settlement)
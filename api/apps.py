@@ -1,5 +1,17 @@
+import os
 from django.apps import AppConfig
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # Connects the signals keeping the organization directory up to date
+        from . import directory
+        # Journals the deletion of ledger records
+        from . import journal
+
+        # Admin is enrolled lazily on the first ledger call unless asked for at startup.
+        if os.environ.get('BLOCKCHAIN_ENROLL_ON_STARTUP'):
+            from . import blockchain as bc
+            bc.client.run(bc.enrollment.ensure())
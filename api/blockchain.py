@@ -1,7 +1,212 @@
-import requests, json, time, datetime, os
+import asyncio, contextvars, json, time, datetime, logging, os, queue, threading, weakref
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
+
+import httpx
+
+from .metrics import Counter, Gauge, Histogram
 
 bc_url = os.environ["BLOCKCHAIN_API_URL"]
 
+logger = logging.getLogger(__name__)
+
+REQUESTS = Counter(
+    "ledger_requests_total", "Ledger calls by chaincode function and outcome.", ["function", "outcome"])
+LATENCY = Histogram(
+    "ledger_request_duration_seconds", "Time spent waiting for the gateway by chaincode function.", ["function"])
+REQUEST_BYTES = Counter(
+    "ledger_request_bytes_total", "Size of request bodies sent to the gateway.", ["function"])
+RESPONSE_BYTES = Counter(
+    "ledger_response_bytes_total", "Size of response bodies received from the gateway.", ["function"])
+CACHE_HITS = Counter(
+    "ledger_cache_hits_total", "Ledger reads served from the cache.", ["function"])
+CACHE_MISSES = Counter(
+    "ledger_cache_misses_total", "Ledger reads missing in the cache.", ["function"])
+CACHE_SIZE = Gauge(
+    "ledger_cache_entries", "Ledger reads held in the cache.")
+COALESCED_READS = Counter(
+    "ledger_coalesced_reads_total", "Ledger reads which shared the call of an identical read in flight.")
+BREAKER_OPEN = Gauge(
+    "ledger_breaker_open", "1 while the gateway circuit breaker is open or half open.")
+
+# Time by which the ledger calls of the current request must be done, as time.monotonic(). None for no limit.
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def set_deadline(seconds):
+    """
+    Limit the time ledger calls of the current context can take.
+    :param seconds: Time budget in seconds, None for no limit.
+    :return: Token to be passed to reset_deadline.
+    """
+    return deadline.set(None if seconds is None else time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    deadline.reset(token)
+
+
+def time_left():
+    """
+    :return: Seconds left until the deadline, None if there is no deadline.
+    """
+    value = deadline.get()
+    if value is None:
+        return None
+    return max(0.0, value - time.monotonic())
+
+
+def deadline_passed():
+    return time_left() == 0
+
+
+# Report of the ledger write running in the current context, see atrack_write.
+write_report = contextvars.ContextVar("write_report", default=None)
+
+
+async def with_deadline(coro, value):
+    """
+    Run a coroutine with the given deadline, context variables do not follow
+    coroutines submitted to another thread's loop.
+    """
+    deadline.set(value)
+    return await coro
+
+
+class GatewayClient:
+    """
+    Non-blocking HTTP client for the blockchain gateway. Keeps a pool of
+    keep-alive connections per event loop so consecutive ledger calls reuse
+    open connections instead of doing a new TCP/TLS handshake every time.
+
+    Blocking callers submit their coroutines to one background event loop
+    with run(), so calls from every thread of the worker share a single pool
+    and can all be in flight at the same time.
+    """
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.05, read_timeout=10):
+        """
+        :param base_url: Gateway URL, every path is appended to it.
+        :param pool_size: Max number of connections kept open to the gateway.
+        :param connect_timeout: Seconds to wait for a connection.
+        :param read_timeout: Seconds to wait for the response.
+        """
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._clients = weakref.WeakKeyDictionary()
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """
+        Background event loop of the blocking API. It is started on first use,
+        and again after a fork since threads do not survive it.
+        :return: Event loop.
+        """
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="blockchain-gateway", daemon=True).start()
+                    self._clients = weakref.WeakKeyDictionary()
+                    self._loop = loop
+                    self._pid = os.getpid()
+        return self._loop
+
+    def run(self, coro):
+        """
+        Run a coroutine on the background loop and wait for its result.
+        :param coro: Coroutine to run.
+        :return: Result of the coroutine.
+        """
+        return self.submit(coro).result()
+
+    def submit(self, coro):
+        """
+        Start a coroutine on the background loop without waiting for it.
+        :param coro: Coroutine to run.
+        :return: concurrent.futures.Future of its result.
+        """
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is loop:
+            coro.close()
+            raise RuntimeError("Blocking blockchain call inside the gateway loop, await the async function instead.")
+
+        return asyncio.run_coroutine_threadsafe(with_deadline(coro, deadline.get()), loop)
+
+    @property
+    def http(self):
+        """
+        HTTP client of the running event loop, connections can not be shared between loops.
+        :return: httpx.AsyncClient
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            http = self._clients.get(loop)
+            if http is None:
+                http = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                    timeout=self.timeout(),
+                )
+                self._clients[loop] = http
+        return http
+
+    def timeout(self, seconds=None):
+        """
+        Timeout of a single request. Waiting for a free pooled connection is not limited.
+        :param seconds: Read timeout in seconds, client default if None.
+        :return: httpx.Timeout
+        """
+        if seconds is None:
+            return httpx.Timeout(self.read_timeout, connect=self.connect_timeout, pool=None)
+        return httpx.Timeout(seconds, connect=min(self.connect_timeout, seconds), pool=None)
+
+    async def post(self, path, json=None, data=None, timeout=None):
+        """
+        Send a POST request to the gateway.
+        :param path: URL path after the API section.
+        :param json: Body to be sent as JSON.
+        :param data: Body to be sent form encoded.
+        :param timeout: Read timeout in seconds, client default if None.
+        :return: Response object.
+        """
+        return await self.http.post(self.base_url + path, json=json, data=data, timeout=self.timeout(timeout))
+
+    async def aclose(self):
+        """
+        Close pooled connections of the running event loop.
+        :return:
+        """
+        with self._lock:
+            http = self._clients.pop(asyncio.get_running_loop(), None)
+        if http is not None:
+            await http.aclose()
+
+    def close(self):
+        """
+        Close pooled connections of the background loop.
+        :return:
+        """
+        if self._loop is not None and self._pid == os.getpid():
+            self.run(self.aclose())
+
+
+client = GatewayClient(
+    bc_url,
+    pool_size=int(os.environ.get("BLOCKCHAIN_POOL_SIZE", 10)),
+    connect_timeout=float(os.environ.get("BLOCKCHAIN_CONNECT_TIMEOUT", 3.05)),
+    read_timeout=float(os.environ.get("BLOCKCHAIN_READ_TIMEOUT", 10)),
+)
+
 
 def get_timestamp_in_millis():
     """
@@ -21,54 +226,613 @@ def millis_to_str(millis):
     return datetime.datetime.fromtimestamp(ms/1000.0).strftime("%Y-%m-%d %H:%M")
 
 
-def create_admin():
+# Gateway answers containing one of these are taken as a rejected admin identity.
+IDENTITY_ERROR_MARKERS = (
+    "does not exist in the wallet",
+    "identity not found",
+    "failed to enroll",
+    "authentication failure",
+    "access denied",
+)
+
+
+async def acreate_admin():
     """
     Enrolls admin on blockchain.
-    :return:
+    :return: Success of the enrollment as bool.
     """
-    print("Enrolling admin...")
-    url = bc_url + "enrollAdmin"
+    logger.info("Enrolling admin...")
     data = {
         "adminName": "admin",
         "password": "adminpw",
     }
 
     try:
-        requests.post(url, data, timeout=10)
-        print("Admin enrolled!")
-    except:
-        print("Error while enrolling admin...")
+        response = await client.post("enrollAdmin", data=data)
+    except Exception:
+        logger.warning("Error while enrolling admin", exc_info=True)
+        return False
 
+    if response.status_code >= 400:
+        logger.warning("Error while enrolling admin: %s", response.status_code)
+        return False
 
-def blockchain_request(path, data):
+    logger.info("Admin enrolled!")
+    return True
+
+
+def create_admin():
+    """
+    Blocking version of acreate_admin.
+    :return: Success of the enrollment as bool.
+    """
+    return client.run(acreate_admin())
+
+
+def is_identity_error(response):
+    """
+    Check if the gateway rejected the request because of the admin identity.
+    :param response: Response object from the gateway.
+    :return: True if the admin has to be enrolled again.
+    """
+    if response.status_code in (401, 403):
+        return True
+
+    text = response.text.lower()
+    return any(marker in text for marker in IDENTITY_ERROR_MARKERS)
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same key share one call. The first
+    caller starts it, the others wait for its result. Works across threads and
+    event loops, since followers wait on a concurrent.futures.Future. The call
+    runs in its own task, so cancelling the caller which started it does not
+    cancel it for the others.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def do(self, key, function):
+        """
+        Run the function unless a call with the same key is already in flight.
+        :param key: Key of the call.
+        :param function: Coroutine function to be called without arguments.
+        :return: Result of the call, followers get the same object as the caller running it.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        task = asyncio.ensure_future(function())
+        task.add_done_callback(lambda task: self._finish(key, future, task))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, future, task):
+        with self._lock:
+            del self._calls[key]
+
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to the gateway after consecutive failures. While
+    open, calls fail immediately. After the cooldown it is half open and lets
+    a few trial calls through, closing again on success.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, cooldown=30, half_open_calls=1):
+        """
+        :param failure_threshold: Consecutive failures which open the breaker.
+        :param cooldown: Seconds to stay open before trying the gateway again.
+        :param half_open_calls: Max number of trial calls in flight while half open.
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.half_open_calls = half_open_calls
+        self.failures = 0
+        self.opened_at = None
+        self.trials = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    @property
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def allow(self):
+        """
+        Check if a call can be sent to the gateway. Every allowed call must be
+        followed by record_success or record_failure.
+        :return: True if the call can be sent.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN or self.trials >= self.half_open_calls:
+                return False
+            self.trials += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trials = 0
+
+    def release(self):
+        """
+        Give back a trial call which ended without telling anything about the gateway.
+        :return:
+        """
+        with self._lock:
+            self.trials = max(0, self.trials - 1)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning("Gateway failing, opening the circuit breaker...")
+                self.opened_at = time.monotonic()
+                self.trials = 0
+
+
+breaker = CircuitBreaker(
+    failure_threshold=int(os.environ.get("BLOCKCHAIN_BREAKER_THRESHOLD", 5)),
+    cooldown=float(os.environ.get("BLOCKCHAIN_BREAKER_COOLDOWN", 30)),
+)
+
+
+class AdminEnrollment:
+    """
+    Enrolls the admin identity once per process and remembers it. The admin is
+    enrolled again only after the gateway rejects the identity.
+    """
+
+    def __init__(self, retry_after=30):
+        """
+        :param retry_after: Seconds to wait before trying again after a failed enrollment.
+        """
+        self.retry_after = retry_after
+        self.generation = 0
+        self.enrolled = False
+        self.failed_at = None
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    async def ensure(self):
+        """
+        Enroll the admin if it is not enrolled yet. Only one caller enrolls,
+        callers on any thread or event loop wait for it and reuse the result.
+        :return: Generation of the enrollment, to be passed to renew.
+        """
+        if self.enrolled:
+            return self.generation
+
+        with self._lock:
+            if self.failed_at is not None and time.monotonic() - self.failed_at < self.retry_after:
+                return self.generation
+
+        return await self._flight.do("enrollAdmin", self._enroll)
+
+    async def _enroll(self):
+        if self.enrolled:
+            return self.generation
+
+        enrolled = await acreate_admin()
+        with self._lock:
+            if enrolled:
+                self.enrolled = True
+                self.failed_at = None
+                self.generation += 1
+            else:
+                self.failed_at = time.monotonic()
+            return self.generation
+
+    async def renew(self, generation):
+        """
+        Enroll again after the identity was rejected. Callers which saw the
+        same rejected generation share a single enrollment.
+        :param generation: Generation returned by ensure before the failing request.
+        :return: New generation.
+        """
+        with self._lock:
+            if self.enrolled and self.generation == generation:
+                self.enrolled = False
+        return await self.ensure()
+
+    def reset(self):
+        """
+        Forget the enrollment, next request enrolls again.
+        :return:
+        """
+        with self._lock:
+            self.enrolled = False
+            self.failed_at = None
+
+
+enrollment = AdminEnrollment(retry_after=float(os.environ.get("BLOCKCHAIN_ENROLL_RETRY_AFTER", 30)))
+
+
+class LedgerCache:
+    """
+    LRU cache of ledger reads, keyed by chaincode function and its arguments.
+    Every function has its own time to live, functions without one are never
+    cached. Writes drop the reads they affect, see CACHE_INVALIDATIONS.
+    """
+
+    def __init__(self, ttls, max_size=1024):
+        """
+        :param ttls: Seconds to keep results, by chaincode function.
+        :param max_size: Max number of results kept, least recently used are dropped first.
+        """
+        self.ttls = ttls
+        self.max_size = max_size
+        self.hits = {}
+        self.misses = {}
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path, args):
+        return path, tuple(sorted((args or {}).items()))
+
+    def get(self, path, args, stale=False):
+        """
+        Get a cached result. Expired results are kept until they are evicted,
+        so that they can still be served while the gateway is unavailable.
+        :param path: Chaincode function.
+        :param args: Arguments of the function.
+        :param stale: Return the result even if it is expired.
+        :return: Copy of the result, None if it is not cached or expired.
+        """
+        if path not in self.ttls or self.max_size <= 0:
+            return None
+
+        key = self.key(path, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not stale and entry[0] < time.monotonic():
+                entry = None
+
+            if entry is None:
+                self.misses[path] = self.misses.get(path, 0) + 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits[path] = self.hits.get(path, 0) + 1
+            return dict(entry[1])
+
+    def set(self, path, args, value, version):
+        """
+        Cache a result unless something was invalidated since the read started.
+        :param path: Chaincode function.
+        :param args: Arguments of the function.
+        :param value: Result as dictionary.
+        :param version: Cache version taken before the read was sent.
+        :return:
+        """
+        if path not in self.ttls or self.max_size <= 0:
+            return
+
+        key = self.key(path, args)
+        with self._lock:
+            if version != self.version:
+                return
+
+            self._entries[key] = (time.monotonic() + self.ttls[path], dict(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path, args=None):
+        """
+        Drop a cached result.
+        :param path: Chaincode function.
+        :param args: Arguments of the function, every result of the function if None.
+        :return:
+        """
+        with self._lock:
+            self.version += 1
+            if args is not None:
+                self._entries.pop(self.key(path, args), None)
+                return
+
+            for key in [key for key in self._entries if key[0] == path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        :return: Size of the cache with hits and misses by chaincode function.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+            }
+
+
+# Chaincode functions which only read the ledger.
+READ_FUNCTIONS = frozenset([
+    "getMinistryInfo",
+    "getProducerInfo",
+    "getMinistryOrderInfo",
+    "getHospitalOrderInfo",
+    "getDeliveryInfo",
+    "getProducerOfferInfo",
+    "getPaymentLetterInfo",
+])
+
+# Seconds to cache the result of each read function.
+CACHE_TTLS = {
+    "getMinistryInfo": 5,
+    "getProducerInfo": 10,
+    "getMinistryOrderInfo": 30,
+    "getHospitalOrderInfo": 30,
+    "getDeliveryInfo": 30,
+    "getProducerOfferInfo": 30,
+    "getPaymentLetterInfo": 300,
+}
+
+# Reads affected by each write function, as (read function, read args) built from the write args.
+# Args of None drop every cached result of the read function.
+CACHE_INVALIDATIONS = {
+    "makeMinistryOrder": lambda args: [
+        ("getMinistryInfo", None),
+        ("getMinistryOrderInfo", {"orderID": args["orderID"]}),
+    ],
+    "updateMask": lambda args: [
+        ("getProducerInfo", {"coID": args["coID"]}),
+    ],
+    "makeHospitalOrder": lambda args: [
+        ("getHospitalOrderInfo", {"orderID": args["orderID"]}),
+    ],
+    "updateHospitalDelivery": lambda args: [
+        ("getHospitalOrderInfo", {"orderID": args["orderID"]}),
+    ],
+    "makeProducerOffer": lambda args: [
+        ("getProducerOfferInfo", {"offerID": args["offerID"]}),
+    ],
+    # Accepting an offer can change the status of the other offers of the order as well
+    "acceptOffer": lambda args: [
+        ("getMinistryOrderInfo", {"orderID": args["orderID"]}),
+        ("getProducerOfferInfo", None),
+    ],
+    "createDeal": lambda args: [
+        ("getMinistryInfo", None),
+        ("getProducerInfo", {"coID": args["coID"]}),
+        ("getPaymentLetterInfo", {"letterID": args["letterID"]}),
+    ],
+    "createDelivery": lambda args: [
+        ("getDeliveryInfo", {"delID": args["delID"]}),
+    ],
+    "updateDelivery": lambda args: [
+        ("getDeliveryInfo", {"delID": args["delID"]}),
+    ],
+    "createPaymentLetter": lambda args: [
+        ("getPaymentLetterInfo", {"letterID": args["letterID"]}),
+    ],
+}
+
+cache = LedgerCache(CACHE_TTLS, max_size=int(os.environ.get("BLOCKCHAIN_CACHE_SIZE", 4096)))
+
+# Identical reads in flight at the same time share one gateway call.
+reads_in_flight = SingleFlight()
+
+
+def invalidate_cache(path, args):
+    """
+    Drop the cached reads affected by a write.
+    :param path: Chaincode function of the write.
+    :param args: Arguments of the write.
+    :return:
+    """
+    if path not in CACHE_INVALIDATIONS:
+        return
+
+    for read_path, read_args in CACHE_INVALIDATIONS[path](args):
+        cache.invalidate(read_path, read_args)
+
+
+def report_unsure(path, inst=None):
+    """
+    Tell the write tracked by atrack_write that it failed after its request may have reached the gateway.
+    :param path: Chaincode function of the request.
+    :param inst: Exception raised while sending the request, None if it was sent.
+    :return:
+    """
+    report = write_report.get()
+    if report is None or path in READ_FUNCTIONS:
+        return
+
+    if isinstance(inst, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        # No connection was made, nothing was sent
+        return
+
+    report["unsure"] = True
+
+
+async def atrack_write(coro):
+    """
+    Await a ledger write, telling whether it may have reached the ledger if it
+    failed. Writes failing before their request was sent can be sent again
+    safely, the ones whose response was lost may have been committed.
+    :param coro: Write call, like aupdate_mask(producer_id, mask_amount).
+    :return: Success of the write as bool, and True if it failed after its request may have been sent.
+    """
+    report = {"unsure": False}
+    token = write_report.set(report)
+    try:
+        success = await coro
+    finally:
+        write_report.reset(token)
+    return success, not success and report["unsure"]
+
+
+async def ablockchain_request(path, data):
     """
     Template for blockchain request. All blockchain functions use this.
     :param path: URL path after the API section.
     :param data: Data to be sent in the request body.
     :return: Response body as dictionary type.
     """
-    create_admin()
-    url = bc_url + path
-    print("Sending request to " + url)
-    print(data)
-    response_content = None
+    args = data.get("args")
+    cached = cache.get(path, args)
+    if cached is not None:
+        return cached
+
+    if path not in READ_FUNCTIONS:
+        return await send_request(path, data)
+
+    # Reads started before one of our writes are not shared with the reads after it
+    key = (cache.version,) + LedgerCache.key(path, args)
+    result = await reads_in_flight.do(key, lambda: send_request(path, data))
+    return dict(result) if isinstance(result, dict) else result
+
+
+async def post_within_deadline(path, data):
+    """
+    Post to the gateway, giving up on reads when the deadline passes before the client timeout.
+    Writes are waited for, since they may be committed anyway once sent.
+    :param path: URL path after the API section.
+    :param data: Data to be sent in the request body.
+    :return: Response object.
+    """
+    remaining = time_left()
+    if remaining is None or path not in READ_FUNCTIONS:
+        return await client.post(path, json=data)
+
+    return await asyncio.wait_for(client.post(path, json=data), remaining)
+
+
+async def send_request(path, data):
+    """
+    Send a request to the gateway, enrolling the admin when needed.
+    :param path: URL path after the API section.
+    :param data: Data to be sent in the request body.
+    :return: Response body as dictionary type.
+    """
+    args = data.get("args")
+    if deadline_passed():
+        # Time budget of the request is used up, do not wait for the gateway
+        REQUESTS.inc(function=path, outcome="deadline")
+        return cache.get(path, args, stale=True)
+
+    if not breaker.allow():
+        # Fail fast, serving the last known result of reads if there is one
+        REQUESTS.inc(function=path, outcome="rejected")
+        return cache.get(path, args, stale=True)
+
+    version = cache.version
+    generation = await enrollment.ensure()
+    logger.debug("Sending request to %s: %s", path, data)
+    started = time.monotonic()
+    outcome = "error"
+    response = None
     try:
-        response = requests.post(url, json=data, timeout=10)
-        response_content = response.content
+        response = await post_within_deadline(path, data)
+        if is_identity_error(response):
+            logger.warning("Admin identity rejected, enrolling again...")
+            await enrollment.renew(generation)
+            response = await post_within_deadline(path, data)
+        outcome = "ok" if response.status_code < 400 else "error"
+    except asyncio.TimeoutError:
+        outcome = "deadline"
+        logger.warning("Deadline passed while waiting for %s", path)
+        breaker.release()
+        report_unsure(path)
+        return cache.get(path, args, stale=True)
+    except asyncio.CancelledError:
+        # The caller went away, which tells nothing about the gateway
+        outcome = "cancelled"
+        breaker.release()
+        raise
+    except httpx.TimeoutException as inst:
+        outcome = "timeout"
+        logger.warning("Request to %s timed out", path)
+        breaker.record_failure()
+        report_unsure(path, inst)
+        return None
     except Exception as inst:
-        print("Error!")
-        print(inst)
+        logger.warning("Request to %s failed", path, exc_info=True)
+        breaker.record_failure()
+        report_unsure(path, inst)
         return None
+    finally:
+        # State of the ledger is unknown after a failed write as well
+        invalidate_cache(path, args)
+        REQUESTS.inc(function=path, outcome=outcome)
+        LATENCY.observe(time.monotonic() - started, function=path)
+
+    REQUEST_BYTES.inc(len(response.request.content), function=path)
+    RESPONSE_BYTES.inc(len(response.content), function=path)
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
 
     try:
-        response_dict = json.loads(response_content)
-        print(response_dict)
-        return response_dict
+        response_dict = json.loads(response.content)
+        logger.debug("Response from %s: %s", path, response_dict)
     except:
-        return response_content
+        return response.content
 
+    if response.status_code < 400 and isinstance(response_dict, dict):
+        cache.set(path, args, response_dict, version)
+    return response_dict
 
-def get_ministry_masks():
+
+def blockchain_request(path, data):
+    """
+    Blocking version of ablockchain_request.
+    :param path: URL path after the API section.
+    :param data: Data to be sent in the request body.
+    :return: Response body as dictionary type.
+    """
+    return client.run(ablockchain_request(path, data))
+
+
+async def aget_ministry_masks():
     """
     Get mask amount at hand for ministry.
     :return: Mask amount.
@@ -79,13 +843,21 @@ def get_ministry_masks():
         "channel": "channel1",
         "smartcontract": "cc",
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     if resp is not None and "maskAmount" in resp:
         return resp["maskAmount"]
     return None
 
 
-def get_producer_masks(producer_id):
+def get_ministry_masks():
+    """
+    Blocking version of aget_ministry_masks.
+    :return: Mask amount.
+    """
+    return client.run(aget_ministry_masks())
+
+
+async def aget_producer_masks(producer_id):
     """
     Get mask amount at hand for given producer.
     :param producer_id: ID of the producer in the blockchain.
@@ -98,7 +870,7 @@ def get_producer_masks(producer_id):
         "smartcontract": "cc",
         "args": {"coID": str(producer_id)}
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return -1
@@ -109,7 +881,16 @@ def get_producer_masks(producer_id):
     return int(resp['amount'])
 
 
-def get_ministry_order_info(order_id):
+def get_producer_masks(producer_id):
+    """
+    Blocking version of aget_producer_masks.
+    :param producer_id: ID of the producer in the blockchain.
+    :return: Mask amount
+    """
+    return client.run(aget_producer_masks(producer_id))
+
+
+async def aget_ministry_order_info(order_id):
     """
     Get ministry order details
     :param order_id: Blockchain id of the order
@@ -122,7 +903,7 @@ def get_ministry_order_info(order_id):
         "smartcontract": "cc",
         "args": {"orderID": str(order_id)}
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return None
@@ -138,7 +919,16 @@ def get_ministry_order_info(order_id):
     return result
 
 
-def make_ministry_order(order_id, mask_amount, date_str):
+def get_ministry_order_info(order_id):
+    """
+    Blocking version of aget_ministry_order_info.
+    :param order_id: Blockchain id of the order
+    :return: Amount and end date
+    """
+    return client.run(aget_ministry_order_info(order_id))
+
+
+async def amake_ministry_order(order_id, mask_amount, date_str):
     """
         Make a new order by ministry
         :param order_id: Blockchain id of order
@@ -157,11 +947,21 @@ def make_ministry_order(order_id, mask_amount, date_str):
             "date": get_timestamp_in_millis()
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def update_mask(producer_id, mask_amount):
+def make_ministry_order(order_id, mask_amount, date_str):
+    """
+    Blocking version of amake_ministry_order.
+    :param order_id: Blockchain id of order
+    :param mask_amount: Mask amount requested
+    :return: Success of transaction as bool
+    """
+    return client.run(amake_ministry_order(order_id, mask_amount, date_str))
+
+
+async def aupdate_mask(producer_id, mask_amount):
     """
     Update mask stocks of a producer
     :param producer_id: Blockchain id of producer
@@ -178,11 +978,21 @@ def update_mask(producer_id, mask_amount):
             "amount": str(mask_amount)
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def make_hospital_order(order_id, mask_amount, hospital_id, urgency):
+def update_mask(producer_id, mask_amount):
+    """
+    Blocking version of aupdate_mask.
+    :param producer_id: Blockchain id of producer
+    :param mask_amount: Mask amount to be added
+    :return: Success of transaction as bool
+    """
+    return client.run(aupdate_mask(producer_id, mask_amount))
+
+
+async def amake_hospital_order(order_id, mask_amount, hospital_id, urgency):
     """
     Makes order from hospital for their needs
     :param order_id: Blockchain key for the order
@@ -204,11 +1014,22 @@ def make_hospital_order(order_id, mask_amount, hospital_id, urgency):
             "deliveryStatus": "0"
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def update_hospital_order(order_id, status):
+def make_hospital_order(order_id, mask_amount, hospital_id, urgency):
+    """
+    Blocking version of amake_hospital_order.
+    :param order_id: Blockchain key for the order
+    :param mask_amount: Mask amount needed by hospital
+    :param hospital_id: Blockchain key for the hospital
+    :return:
+    """
+    return client.run(amake_hospital_order(order_id, mask_amount, hospital_id, urgency))
+
+
+async def aupdate_hospital_order(order_id, status):
     """
     Updates hospital order status
     :param order_id: Blockchain key for the order
@@ -224,11 +1045,20 @@ def update_hospital_order(order_id, status):
             "deliveryStatus": str(status)
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def get_delivery_info(deal_id):
+def update_hospital_order(order_id, status):
+    """
+    Blocking version of aupdate_hospital_order.
+    :param order_id: Blockchain key for the order
+    :return: Success of the transaction
+    """
+    return client.run(aupdate_hospital_order(order_id, status))
+
+
+async def aget_delivery_info(deal_id):
     path = "getDeliveryInfo"
     data = {
         "username": "admin",
@@ -236,7 +1066,7 @@ def get_delivery_info(deal_id):
         "smartcontract": "cc",
         "args": {"delID": str(deal_id)}
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return None
@@ -248,7 +1078,16 @@ def get_delivery_info(deal_id):
     }
 
 
-def get_hospital_order_info(order_id):
+def get_delivery_info(deal_id):
+    """
+    Blocking version of aget_delivery_info.
+    :param deal_id:
+    :return:
+    """
+    return client.run(aget_delivery_info(deal_id))
+
+
+async def aget_hospital_order_info(order_id):
     """
     Get hospital order mask amount
     :param order_id: Blockchain key for oder
@@ -261,7 +1100,7 @@ def get_hospital_order_info(order_id):
         "smartcontract": "cc",
         "args": {"orderID": str(order_id)}
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return None
@@ -277,7 +1116,16 @@ def get_hospital_order_info(order_id):
     return hospital_order
 
 
-def get_producer_offer_info(offer_id):
+def get_hospital_order_info(order_id):
+    """
+    Blocking version of aget_hospital_order_info.
+    :param order_id: Blockchain key for oder
+    :return: Number of masks ordered with priority
+    """
+    return client.run(aget_hospital_order_info(order_id))
+
+
+async def aget_producer_offer_info(offer_id):
     """
     Get offer made by producer
     :param offer_id: Blockchain key for offer
@@ -290,7 +1138,7 @@ def get_producer_offer_info(offer_id):
         "smartcontract": "cc",
         "args": {"offerID": str(offer_id)}
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return None
@@ -306,7 +1154,16 @@ def get_producer_offer_info(offer_id):
     return offer
 
 
-def create_producer_offer(offer_id, producer_id, order_id, offer):
+def get_producer_offer_info(offer_id):
+    """
+    Blocking version of aget_producer_offer_info.
+    :param offer_id: Blockchain key for offer
+    :return: Offer
+    """
+    return client.run(aget_producer_offer_info(offer_id))
+
+
+async def acreate_producer_offer(offer_id, producer_id, order_id, offer):
     """
     Create offer by producers.
     :param offer_id:
@@ -328,12 +1185,24 @@ def create_producer_offer(offer_id, producer_id, order_id, offer):
             "date": get_timestamp_in_millis()
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     return resp is not None
 
 
-def accept_offer(offer_id, order_id):
+def create_producer_offer(offer_id, producer_id, order_id, offer):
+    """
+    Blocking version of acreate_producer_offer.
+    :param offer_id:
+    :param producer_id:
+    :param order_id:
+    :param offer:
+    :return:
+    """
+    return client.run(acreate_producer_offer(offer_id, producer_id, order_id, offer))
+
+
+async def aaccept_offer(offer_id, order_id):
     """
     Accept offer for an order.
     :param offer_id: Blockchain ID of the offer.
@@ -351,11 +1220,21 @@ def accept_offer(offer_id, order_id):
         }
     }
 
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def create_deal(deal_id, producer_id, price, letter_id, mask_amount):
+def accept_offer(offer_id, order_id):
+    """
+    Blocking version of aaccept_offer.
+    :param offer_id: Blockchain ID of the offer.
+    :param order_id: Blockchain ID of the order.
+    :return: Success of transaction.
+    """
+    return client.run(aaccept_offer(offer_id, order_id))
+
+
+async def acreate_deal(deal_id, producer_id, price, letter_id, mask_amount):
     """
     Creates a deal in blockchain
     :param deal_id:
@@ -379,11 +1258,24 @@ def create_deal(deal_id, producer_id, price, letter_id, mask_amount):
             "date": get_timestamp_in_millis(),
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def create_delivery(delivery_id, producer_id, status=1):
+def create_deal(deal_id, producer_id, price, letter_id, mask_amount):
+    """
+    Blocking version of acreate_deal.
+    :param deal_id:
+    :param producer_id:
+    :param price:
+    :param letter_id:
+    :param mask_amount:
+    :return: True if anything is returned in the body, else False
+    """
+    return client.run(acreate_deal(deal_id, producer_id, price, letter_id, mask_amount))
+
+
+async def acreate_delivery(delivery_id, producer_id, status=1):
     """
     Create a new delivery.
     :param delivery_id: UUID of the delivery.
@@ -403,11 +1295,22 @@ def create_delivery(delivery_id, producer_id, status=1):
             "date": get_timestamp_in_millis(),
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def update_delivery(delivery_id, status):
+def create_delivery(delivery_id, producer_id, status=1):
+    """
+    Blocking version of acreate_delivery.
+    :param delivery_id: UUID of the delivery.
+    :param producer_id: Blockchain ID of the producer.
+    :param status: Status of the delivery, 1 by default.
+    :return: Success of the transaction.
+    """
+    return client.run(acreate_delivery(delivery_id, producer_id, status))
+
+
+async def aupdate_delivery(delivery_id, status):
     """
     Update status of a delivery.
     :param delivery_id: Blockchain ID of the delivery.
@@ -424,11 +1327,21 @@ def update_delivery(delivery_id, status):
             "status": str(status)
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
     return resp is not None
 
 
-def get_payment_letter_info(letter_id):
+def update_delivery(delivery_id, status):
+    """
+    Blocking version of aupdate_delivery.
+    :param delivery_id: Blockchain ID of the delivery.
+    :param status: New status of the delivery.
+    :return: Success of the transaction as bool.
+    """
+    return client.run(aupdate_delivery(delivery_id, status))
+
+
+async def aget_payment_letter_info(letter_id):
     """
     Get payment amount
     :param letter_id: Bc id of the letter
@@ -443,7 +1356,7 @@ def get_payment_letter_info(letter_id):
             "letterID": str(letter_id),
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     if resp is None:
         return None
@@ -456,7 +1369,16 @@ def get_payment_letter_info(letter_id):
     }
 
 
-def create_payment_letter(letter_id, bank_id, price):
+def get_payment_letter_info(letter_id):
+    """
+    Blocking version of aget_payment_letter_info.
+    :param letter_id: Bc id of the letter
+    :return: Payment letter as dictionary.
+    """
+    return client.run(aget_payment_letter_info(letter_id))
+
+
+async def acreate_payment_letter(letter_id, bank_id, price):
     """
     Create a payment letter by bank
     :param letter_id: UUID of the payment letter.
@@ -476,6 +1398,149 @@ def create_payment_letter(letter_id, bank_id, price):
             "Date": get_timestamp_in_millis(),
         }
     }
-    resp = blockchain_request(path, data)
+    resp = await ablockchain_request(path, data)
 
     return resp is not None
+
+
+def create_payment_letter(letter_id, bank_id, price):
+    """
+    Blocking version of acreate_payment_letter.
+    :param letter_id: UUID of the payment letter.
+    :param bank_id: Blockchain ID of the bank.
+    :param price: Price of the payment.
+    :return: Boolean of success of transaction
+    """
+    return client.run(acreate_payment_letter(letter_id, bank_id, price))
+
+
+# Lookups which can be fanned out with get_many, by kind.
+BATCH_LOOKUPS = {
+    "producer_masks": aget_producer_masks,
+    "ministry_order": aget_ministry_order_info,
+    "hospital_order": aget_hospital_order_info,
+    "delivery": aget_delivery_info,
+    "producer_offer": aget_producer_offer_info,
+    "payment_letter": aget_payment_letter_info,
+}
+
+# Cached read behind every lookup of BATCH_LOOKUPS, as (read function, argument holding the blockchain id).
+LOOKUP_READS = {
+    "producer_masks": ("getProducerInfo", "coID"),
+    "ministry_order": ("getMinistryOrderInfo", "orderID"),
+    "hospital_order": ("getHospitalOrderInfo", "orderID"),
+    "delivery": ("getDeliveryInfo", "delID"),
+    "producer_offer": ("getProducerOfferInfo", "offerID"),
+    "payment_letter": ("getPaymentLetterInfo", "letterID"),
+}
+
+BatchResult = namedtuple("BatchResult", ["id", "value", "error"])
+
+
+def invalidate_lookup(kind, item_id):
+    """
+    Drop the cached read behind a lookup of BATCH_LOOKUPS.
+    :param kind: One of the keys of BATCH_LOOKUPS.
+    :param item_id: Blockchain id looked up.
+    :return:
+    """
+    read_path, id_arg = LOOKUP_READS[kind]
+    cache.invalidate(read_path, {id_arg: str(item_id)})
+
+
+async def aget_many(kind, ids, max_workers=None):
+    """
+    Run the same lookup for many ids concurrently.
+    :param kind: One of the keys of BATCH_LOOKUPS.
+    :param ids: Blockchain ids to look up.
+    :param max_workers: Max number of requests in flight, connection pool size by default.
+    :return: List of BatchResult in the order of ids. Failed lookups have value None and the error set.
+    """
+    lookup = BATCH_LOOKUPS[kind]
+    semaphore = asyncio.Semaphore(max_workers or client.pool_size)
+
+    async def run(item_id):
+        async with semaphore:
+            try:
+                return BatchResult(item_id, await lookup(item_id), None)
+            except Exception as inst:
+                return BatchResult(item_id, None, inst)
+
+    return list(await asyncio.gather(*[run(item_id) for item_id in ids]))
+
+
+def get_many(kind, ids, max_workers=None):
+    """
+    Blocking version of aget_many.
+    :param kind: One of the keys of BATCH_LOOKUPS.
+    :param ids: Blockchain ids to look up.
+    :param max_workers: Max number of requests in flight, connection pool size by default.
+    :return: List of BatchResult in the order of ids.
+    """
+    ids = list(ids)
+
+    if not ids:
+        return []
+
+    return client.run(aget_many(kind, ids, max_workers))
+
+
+def iter_many(kind, ids, max_workers=None):
+    """
+    Same as get_many, but yields every result as soon as its lookup completes.
+    Lookups still running when the iterator is closed are cancelled.
+    :param kind: One of the keys of BATCH_LOOKUPS.
+    :param ids: Blockchain ids to look up.
+    :param max_workers: Max number of requests in flight, connection pool size by default.
+    :return: Iterator of BatchResult, in completion order.
+    """
+    ids = list(ids)
+
+    if not ids:
+        return
+
+    lookup = BATCH_LOOKUPS[kind]
+    completed = queue.Queue()
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_workers or client.pool_size)
+
+        async def run(item_id):
+            result = BatchResult(item_id, None, None)
+            try:
+                async with semaphore:
+                    result = BatchResult(item_id, await lookup(item_id), None)
+            except Exception as inst:
+                result = BatchResult(item_id, None, inst)
+            finally:
+                # Every id gets a result, the iterator waits for all of them
+                completed.put(result)
+
+        await asyncio.gather(*[run(item_id) for item_id in ids])
+
+    future = client.submit(run_all())
+    try:
+        for _ in ids:
+            yield completed.get()
+    finally:
+        future.cancel()
+
+
+def collect_metrics():
+    """
+    Metrics of the ledger calls made by this process.
+    :return: List of metrics, see api.metrics.render.
+    """
+    stats = cache.stats()
+    for function, hits in stats["hits"].items():
+        CACHE_HITS.set(hits, function=function)
+    for function, misses in stats["misses"].items():
+        CACHE_MISSES.set(misses, function=function)
+    CACHE_SIZE.set(stats["size"])
+    COALESCED_READS.set(reads_in_flight.shared)
+    BREAKER_OPEN.set(1 if breaker.is_open else 0)
+
+    return [
+        REQUESTS, LATENCY, REQUEST_BYTES, RESPONSE_BYTES,
+        CACHE_HITS, CACHE_MISSES, CACHE_SIZE, COALESCED_READS, BREAKER_OPEN,
+    ]
@@ -0,0 +1,114 @@
+from collections import namedtuple
+
+from . import mirror
+
+
+# Rows of a model whose field has one of the values, newest first.
+Rows = namedtuple("Rows", ["model", "field", "values"])
+
+# Ledger records of a kind of mirror, by blockchain id.
+Ledger = namedtuple("Ledger", ["kind", "ids"])
+
+
+class QueryError(Exception):
+    pass
+
+
+class DataLoader:
+    """
+    Resolves the lookups of many queries together, for one request. Queries
+    are generators yielding Rows or Ledger lookups and receiving their
+    result, until they return their own. They are advanced in rounds: the
+    lookups of all the queries in a round are deduplicated and batched into
+    one SQL query per model and field and one ledger batch per kind, and
+    anything looked up once is served from the loader afterwards.
+    """
+
+    def __init__(self, verify=False):
+        """
+        :param verify: Fetch ledger records from the ledger rather than the mirrors.
+        """
+        self.verify = verify
+        self.rows = {}
+        self.records = {}
+
+    def run(self, queries):
+        """
+        :param queries: List of query generators.
+        :return: Results of the queries in the same order, the QueryError for failed ones.
+        """
+        results = [None] * len(queries)
+        pending = {}
+        for index, query in enumerate(queries):
+            self.advance(index, query, None, pending, results)
+
+        while pending:
+            self.fetch([lookup for query, lookup in pending.values()])
+
+            waiting, pending = pending, {}
+            for index, (query, lookup) in waiting.items():
+                self.advance(index, query, self.resolve(lookup), pending, results)
+
+        return results
+
+    def advance(self, index, query, value, pending, results):
+        try:
+            lookup = query.send(value)
+        except StopIteration as stop:
+            results[index] = stop.value
+        except QueryError as inst:
+            results[index] = inst
+        else:
+            pending[index] = (query, lookup)
+
+    def fetch(self, lookups):
+        """
+        Load what the lookups of a round need and the loader does not hold yet.
+        :param lookups: List of Rows and Ledger.
+        :return:
+        """
+        missing_rows = {}
+        missing_records = {}
+        for lookup in lookups:
+            if isinstance(lookup, Rows):
+                loaded = self.rows.setdefault((lookup.model, lookup.field), {})
+                missing = missing_rows.setdefault((lookup.model, lookup.field), set())
+                missing.update(value for value in lookup.values if value not in loaded)
+            else:
+                loaded = self.records.setdefault(lookup.kind, {})
+                missing = missing_records.setdefault(lookup.kind, set())
+                missing.update(str(item_id) for item_id in lookup.ids if str(item_id) not in loaded)
+
+        for (model, field), values in missing_rows.items():
+            if not values:
+                continue
+
+            loaded = self.rows[(model, field)]
+            for value in values:
+                loaded[value] = []
+
+            ordering = '-created_at' if any(f.name == 'created_at' for f in model._meta.fields) else '-pk'
+            for row in model.objects.filter(**{field + '__in': values}).order_by(ordering):
+                loaded[getattr(row, field)].append(row)
+
+        for kind, ids in missing_records.items():
+            loaded = self.records[kind]
+            for bc_result in mirror.get_many(kind, sorted(ids), verify=self.verify):
+                loaded[bc_result.id] = bc_result.value
+
+    def resolve(self, lookup):
+        """
+        :param lookup: Rows or Ledger, fetched already.
+        :return: List of rows for Rows, records by blockchain id for Ledger, None for the ones missing
+            on the ledger. Records are copies, queries can change them.
+        """
+        if isinstance(lookup, Rows):
+            loaded = self.rows[(lookup.model, lookup.field)]
+            return [row for value in dict.fromkeys(lookup.values) for row in loaded[value]]
+
+        loaded = self.records[lookup.kind]
+        records = {}
+        for item_id in lookup.ids:
+            value = loaded[str(item_id)]
+            records[str(item_id)] = dict(value) if isinstance(value, dict) else value
+        return records
@@ -0,0 +1,166 @@
+import threading, time, uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import Http404
+
+from . import models
+from .serializers import OrganizationSerializer
+
+
+class OrganizationDirectory:
+    """
+    In-process copy of the organizations, by id and by ledger key, along with
+    their serialized form. Organizations are saved and deleted through the
+    ORM only, which invalidates the directory with a new version stamp in the
+    Django cache. Workers compare their stamp with it to detect they are
+    stale, so with a cache shared by the workers every one of them reloads
+    after a change. With a per-process cache, copies are reloaded after
+    max_age seconds at the latest, or as soon as an organization missing in
+    them is found in the database.
+    """
+
+    VERSION_KEY = 'api:organization-directory:version'
+
+    def __init__(self, max_age=60, check_interval=1):
+        """
+        :param max_age: Seconds after which the directory is reloaded anyway.
+        :param check_interval: Seconds between two checks of the version stamp.
+        """
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = None
+        self._version = None
+        self._loaded_at = 0
+        self._checked_at = 0
+
+    def version(self):
+        version = cache.get(self.VERSION_KEY)
+        if version is None:
+            cache.add(self.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.VERSION_KEY)
+        return version
+
+    def entries(self):
+        """
+        :return: Organizations by id, by key and by group, and serialized organizations by id.
+        """
+        now = time.monotonic()
+        entries = self._entries
+        if entries is not None and now - self._loaded_at < self.max_age:
+            if now - self._checked_at < self.check_interval:
+                return entries
+            self._checked_at = now
+            if self.version() == self._version:
+                return entries
+
+        with self._lock:
+            version = self.version()
+            if self._entries is not None and self._version == version and now - self._loaded_at < self.max_age:
+                return self._entries
+
+            organizations = list(models.Organization.objects.order_by('id'))
+            by_group = {}
+            for organization in organizations:
+                by_group.setdefault(organization.group, []).append(organization)
+
+            self._entries = {
+                "id": {organization.id: organization for organization in organizations},
+                "key": {organization.key: organization for organization in organizations if organization.key},
+                "group": by_group,
+                "data": {organization.id: OrganizationSerializer(organization).data for organization in organizations},
+            }
+            self._version = version
+            self._loaded_at = self._checked_at = time.monotonic()
+            return self._entries
+
+    def lookup(self, index, value):
+        """
+        :param index: "id" or "key".
+        :param value: Id or blockchain id of the organization.
+        :return: Organization, None if there is none.
+        """
+        organization = self.entries()[index].get(value)
+        if organization is not None or value is None:
+            return organization
+
+        if not models.Organization.objects.filter(**{index: value}).exists():
+            return None
+
+        # Created by another worker since the directory was loaded
+        self.clear()
+        return self.entries()[index].get(value)
+
+    def get(self, organization_id):
+        """
+        :param organization_id: Id of the organization, as int or string.
+        :return: Organization, None if there is none.
+        """
+        return self.lookup("id", as_id(organization_id))
+
+    def get_by_key(self, key):
+        """
+        :param key: Blockchain id of the organization.
+        :return: Organization, None if there is none.
+        """
+        return self.lookup("key", key)
+
+    def in_group(self, group):
+        """
+        :param group: One of ORGANIZATION_TYPES.
+        :return: Organizations of the group ordered by id.
+        """
+        return list(self.entries()["group"].get(group, []))
+
+    def data(self, organization_id):
+        """
+        :param organization_id: Id of the organization, as int or string.
+        :return: Organization serialized with OrganizationSerializer, None if there is none.
+        """
+        if self.get(organization_id) is None:
+            return None
+
+        data = self.entries()["data"].get(as_id(organization_id))
+        return None if data is None else dict(data)
+
+    def clear(self):
+        with self._lock:
+            self._entries = None
+
+    def invalidate(self):
+        self.clear()
+        cache.set(self.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+directory = OrganizationDirectory()
+
+
+def get_or_404(organization_id=None, key=None):
+    """
+    Same as get_object_or_404 for organizations, served from the directory.
+    :param organization_id: Id of the organization.
+    :param key: Blockchain id of the organization, used when no id is given.
+    :return: Organization
+    """
+    organization = directory.get(organization_id) if key is None else directory.get_by_key(key)
+    if organization is None:
+        raise Http404('No Organization matches the given query.')
+    return organization
+
+
+@receiver(post_save, sender=models.Organization)
+@receiver(post_delete, sender=models.Organization)
+def invalidate_directory(sender, **kwargs):
+    # Other workers are told once the change is visible to them
+    directory.clear()
+    transaction.on_commit(directory.invalidate)
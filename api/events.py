@@ -0,0 +1,148 @@
+import datetime, time
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import models
+from .streaming import sse_message
+
+
+# Kinds of records whose status changes are published.
+KINDS = [kind for kind, label in models.STATUS_EVENT_KINDS]
+
+# Seconds between two reads of new events by a stream.
+POLL_INTERVAL = 1
+
+# Seconds without events after which a stream sends a comment, so proxies keep the connection open.
+HEARTBEAT = 15
+
+# Milliseconds browsers wait before reconnecting a closed stream.
+RETRY = 1000
+
+
+def max_events():
+    return getattr(settings, 'STATUS_EVENTS_MAX', 10000)
+
+
+def commit_lag():
+    return datetime.timedelta(seconds=getattr(settings, 'CURSOR_COMMIT_LAG', 5))
+
+
+def publish(kind, record_id, status):
+    """
+    Record a status change to be pushed to the streams. Only the last
+    STATUS_EVENTS_MAX events are kept, older ones are dropped here.
+    :param kind: One of KINDS.
+    :param record_id: Blockchain id of the record.
+    :param status: New status of the record.
+    :return: StatusEvent
+    """
+    event = models.StatusEvent.objects.create(kind=kind, record_id=record_id, status=str(status))
+    models.StatusEvent.objects.filter(id__lte=event.id - max_events()).delete()
+    return event
+
+
+def latest_id():
+    """
+    :return: Id of the last event, 0 if there is none.
+    """
+    return models.StatusEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def safe_id():
+    """
+    :return: Id of the last event older than CURSOR_COMMIT_LAG, 0 if there is none. Every event before it is
+        visible, see journal.safe_id.
+    """
+    events = models.StatusEvent.objects.filter(created_at__lte=timezone.now() - commit_lag())
+    return events.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def missed(last_id):
+    """
+    :param last_id: Id of the last event a client received.
+    :return: True if events following it may have been dropped already.
+    """
+    return last_id < latest_id() - max_events()
+
+
+def after(last_id, kinds, batch_size=100):
+    """
+    :param last_id: Id of the last event a client received.
+    :param kinds: Kinds of events to return.
+    :param batch_size: Max number of events.
+    :return: List of StatusEvent following last_id, oldest first.
+    """
+    return list(models.StatusEvent.objects.filter(id__gt=last_id, kind__in=kinds).order_by('id')[:batch_size])
+
+
+def event_data(event):
+    return {
+        "kind": event.kind,
+        "id": str(event.record_id),
+        "status": event.status,
+        "date": event.created_at.isoformat()
+    }
+
+
+def stream(last_id, kinds, duration=None, poll_interval=POLL_INTERVAL, heartbeat=HEARTBEAT):
+    """
+    Status changes as server-sent events, named after their kind and
+    identified by their id. A client reconnecting with the id of the last
+    event it received gets the events it missed, new clients only get the
+    events published after they connected. When events a client missed were
+    dropped already, it is sent a reset event so that it reloads its lists.
+    Events of transactions committing out of order show up after events
+    with higher ids, so the ids sent stop before events newer than
+    CURSOR_COMMIT_LAG: a reconnecting client may get these twice, but does
+    not miss the ones which show up late. The stream ends after duration
+    seconds and browsers reconnect with the Last-Event-ID header after RETRY,
+    so a worker is only held by a client for a few seconds at a time.
+    :param last_id: Id of the last event the client received, None for a new client.
+    :param kinds: Kinds of events to send.
+    :param duration: Seconds before the stream ends, STATUS_EVENTS_STREAM_SECONDS by default.
+    :param poll_interval: Seconds between two reads of new events.
+    :param heartbeat: Seconds without events before a comment is sent.
+    :return: Iterator of server-sent event messages.
+    """
+    if duration is None:
+        duration = getattr(settings, 'STATUS_EVENTS_STREAM_SECONDS', 5)
+
+    yield sse_message(retry=RETRY)
+
+    # Events after last_id sent already, or published before the client connected
+    sent = set()
+    if last_id is None or missed(last_id):
+        reset = last_id is not None
+        last_id = safe_id()
+        sent = set(models.StatusEvent.objects.filter(id__gt=last_id, kind__in=kinds).values_list('id', flat=True))
+        if reset:
+            yield sse_message({"reason": "Events were dropped, reload the lists."}, event='reset', event_id=last_id)
+
+    ends_at = time.monotonic() + duration
+    sent_at = time.monotonic()
+    while True:
+        horizon = timezone.now() - commit_lag()
+        held = False
+        events = []
+        for event in after(last_id, kinds):
+            held = held or event.created_at > horizon
+            if not held:
+                last_id = event.id
+            if event.id not in sent:
+                sent.add(event.id)
+                events.append(event)
+                yield sse_message(event_data(event), event=event.kind, event_id=last_id)
+        sent = {event_id for event_id in sent if event_id > last_id}
+
+        now = time.monotonic()
+        if events:
+            sent_at = now
+        elif now - sent_at >= heartbeat:
+            sent_at = now
+            yield sse_message(comment='keepalive')
+
+        if now >= ends_at:
+            return
+        if not events:
+            time.sleep(min(poll_interval, max(ends_at - now, 0)))
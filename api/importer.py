@@ -0,0 +1,96 @@
+import csv, os
+
+import xlrd
+from django.db import transaction
+
+from . import models
+from .directory import directory
+
+
+# Organizations which can be imported, there is a single ministry
+IMPORT_GROUPS = ('HOSPITAL', 'PRODUCER', 'BANK')
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+def read_rows(content, filename):
+    """
+    Read a CSV or XLSX file with a header row.
+    :param content: File content as bytes.
+    :param filename: Name of the file, its extension gives the format.
+    :return: Rows as dicts by lower case column name.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension in ('.xlsx', '.xls'):
+        try:
+            sheet = xlrd.open_workbook(file_contents=content).sheet_by_index(0)
+        except xlrd.XLRDError as inst:
+            raise InvalidImport(str(inst))
+        rows = [sheet.row_values(index) for index in range(sheet.nrows)]
+    elif extension == '.csv':
+        try:
+            rows = list(csv.reader(content.decode('utf-8-sig').splitlines()))
+        except UnicodeDecodeError:
+            raise InvalidImport("CSV files must be UTF-8 encoded.")
+    else:
+        raise InvalidImport("Unsupported file type, use CSV or XLSX.")
+
+    if not rows:
+        return []
+
+    header = [str(column).strip().lower() for column in rows[0]]
+    return [dict(zip(header, row)) for row in rows[1:]]
+
+
+def parse_organizations(rows, group=None):
+    """
+    :param rows: Rows from read_rows, with a name column and a group column unless group is given.
+    :param group: Group of every organization, overrides the group column.
+    :return: List of unsaved Organization.
+    """
+    organizations = []
+    for line, row in enumerate(rows, start=2):
+        name = str(row.get("name") or "").strip()
+        row_group = (group or str(row.get("group") or "")).strip().upper()
+
+        if not name and not row_group:
+            continue
+        if not name:
+            raise InvalidImport("Row {}: name is missing.".format(line))
+        if row_group not in IMPORT_GROUPS:
+            raise InvalidImport("Row {}: group must be one of {}.".format(line, ", ".join(IMPORT_GROUPS)))
+
+        organizations.append(models.Organization(name=name, group=row_group))
+
+    return organizations
+
+
+def import_organizations(content, filename, group=None, batch_size=1000):
+    """
+    Create the organizations listed in a CSV or XLSX file, skipping the ones
+    which already exist with the same name and group. Keys are set in the
+    same insert.
+    :param content: File content as bytes.
+    :param filename: Name of the file.
+    :param group: Group of every organization, read from the group column by default.
+    :param batch_size: Number of organizations inserted at once.
+    :return: Created organizations and the number of skipped ones.
+    """
+    organizations = parse_organizations(read_rows(content, filename), group)
+
+    existing = set(models.Organization.objects.filter(group__in=IMPORT_GROUPS).values_list('name', 'group'))
+    new = []
+    for organization in organizations:
+        if (organization.name, organization.group) not in existing:
+            existing.add((organization.name, organization.group))
+            new.append(organization)
+
+    with transaction.atomic():
+        created = models.Organization.objects.bulk_create(new, batch_size=batch_size)
+        # bulk_create sends no post_save
+        transaction.on_commit(directory.invalidate)
+
+    return created, len(organizations) - len(new)
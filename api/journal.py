@@ -0,0 +1,165 @@
+import datetime, threading, time
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import models
+from . import blockchain as bc
+
+
+# Local records whose deletion is journaled, by kind of mirror.
+DELETED_KINDS = {
+    models.HospitalOrder: "hospital_order",
+    models.MinistryOrder: "ministry_order",
+    models.Delivery: "delivery",
+    models.PaymentLetter: "payment_letter",
+    models.ProducerOffer: "producer_offer",
+}
+
+
+def max_entries():
+    return getattr(settings, 'CHANGE_JOURNAL_MAX', 100000)
+
+
+def commit_lag():
+    return datetime.timedelta(seconds=getattr(settings, 'CURSOR_COMMIT_LAG', 5))
+
+
+def record(kind, ids):
+    """
+    Journal a change of records, so that clients syncing from a cursor fetch
+    them again. Only the last CHANGE_JOURNAL_MAX entries are kept, older ones
+    are dropped here.
+    :param kind: One of the keys of mirror.MIRRORS.
+    :param ids: Blockchain ids of the records.
+    :return:
+    """
+    ids = [str(item_id) for item_id in ids]
+    if not ids:
+        return
+
+    models.JournalEntry.objects.bulk_create([models.JournalEntry(kind=kind, record_id=item_id) for item_id in ids])
+    models.JournalEntry.objects.filter(id__lte=latest_id() - max_entries()).delete()
+
+
+def latest_id():
+    """
+    :return: Id of the last entry, 0 if there is none.
+    """
+    return models.JournalEntry.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def safe_id():
+    """
+    Entries of transactions committing out of order show up after entries
+    with higher ids. Cursors stop at the last entry older than
+    CURSOR_COMMIT_LAG, by when every entry before it is visible.
+    :return: Id of the last entry older than CURSOR_COMMIT_LAG, 0 if there is none. Clients sync from it as their cursor.
+    """
+    entries = models.JournalEntry.objects.filter(created_at__lte=timezone.now() - commit_lag())
+    return entries.order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def expired(cursor):
+    """
+    :param cursor: Cursor a client syncs from.
+    :return: True if entries following it may have been dropped already.
+    """
+    return cursor < latest_id() - max_entries()
+
+
+def changes(kind, cursor, limit=500):
+    """
+    :param kind: One of the keys of mirror.MIRRORS.
+    :param cursor: Cursor a client syncs from.
+    :param limit: Max number of entries read.
+    :return: Blockchain ids of the records changed after the cursor, the cursor following them
+        and whether there are more changes after it. Changes newer than CURSOR_COMMIT_LAG are
+        left for later, see safe_id.
+    """
+    safe = safe_id()
+    entries = list(
+        models.JournalEntry.objects.filter(kind=kind, id__gt=cursor, id__lte=safe)
+        .order_by('id').values_list('id', 'record_id')[:limit + 1]
+    )
+
+    more = len(entries) > limit
+    entries = entries[:limit]
+    ids = list(dict.fromkeys(record_id for entry_id, record_id in entries))
+    return ids, entries[-1][0] if more else max(cursor, safe), more
+
+
+class CacheSync:
+    """
+    Drops the cached ledger reads of the records journaled as changed, so that
+    a process does not serve what other processes changed, like the writes
+    committed by the transaction worker, from its own cache. Like client
+    cursors, the cursor stops before entries newer than CURSOR_COMMIT_LAG,
+    the ones after it which were handled already are remembered. The journal
+    is read at most once every check_interval, and not while nothing is
+    cached: the entries are read once reads are cached again.
+    """
+
+    def __init__(self, max_entries=1000, check_interval=1):
+        """
+        :param max_entries: Max number of entries read at once, the whole cache is dropped when more are new.
+        :param check_interval: Seconds between two reads of the journal.
+        """
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.cursor = None
+        self.seen = set()
+        self._lock = threading.Lock()
+        self._checked_at = None
+
+    def run(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+
+        if len(bc.cache) == 0:
+            return
+
+        if self.cursor is None:
+            # Changes made since the cached reads were fetched are not known
+            self.reset()
+            return
+
+        entries = list(
+            models.JournalEntry.objects.filter(id__gt=self.cursor)
+            .order_by('id').values_list('id', 'kind', 'record_id', 'created_at')[:self.max_entries + 1]
+        )
+        if len(entries) > self.max_entries:
+            self.reset()
+            return
+
+        horizon = timezone.now() - commit_lag()
+        with self._lock:
+            seen = set()
+            for entry_id, kind, record_id, created_at in entries:
+                if entry_id not in self.seen:
+                    bc.invalidate_lookup(kind, record_id)
+                if created_at <= horizon and not seen:
+                    self.cursor = entry_id
+                else:
+                    seen.add(entry_id)
+            self.seen = seen
+
+    def reset(self):
+        cursor = safe_id()
+        with self._lock:
+            self.cursor = cursor
+            self.seen = set()
+            bc.cache.clear()
+
+
+cache_sync = CacheSync()
+
+
+@receiver(post_delete)
+def journal_deletion(sender, instance, **kwargs):
+    if sender in DELETED_KINDS:
+        record(DELETED_KINDS[sender], [instance.pk])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import importer
+
+
+class Command(BaseCommand):
+    help = 'Imports hospitals, producers and banks from a CSV or XLSX file with name and group columns.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='CSV or XLSX file.')
+        parser.add_argument('--group', choices=importer.IMPORT_GROUPS, default=None,
+                            help='Group of every organization, read from the group column by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of organizations inserted at once.')
+
+    def handle(self, *args, **options):
+        with open(options['file'], 'rb') as file:
+            content = file.read()
+
+        try:
+            created, skipped = importer.import_organizations(
+                content, options['file'], group=options['group'], batch_size=options['batch_size']
+            )
+        except importer.InvalidImport as inst:
+            raise CommandError(str(inst))
+
+        self.stdout.write('{} organizations imported, {} already existing skipped'.format(len(created), skipped))
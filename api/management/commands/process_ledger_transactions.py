@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import outbox
+
+
+class Command(BaseCommand):
+    help = 'Submits queued ledger transactions to the blockchain.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of transactions taken at once.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of transactions submitted at the same time.')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds to wait when there is nothing to submit.')
+        parser.add_argument('--once', action='store_true',
+                            help='Submit the due transactions and exit.')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = outbox.process(batch_size=options['batch_size'], workers=options['workers'])
+            if processed:
+                self.stdout.write('{} transactions processed'.format(processed))
+
+            if options['once'] and not processed:
+                return
+            if not processed:
+                time.sleep(options['interval'])
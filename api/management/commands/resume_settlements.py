@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import models
+from api import settlement
+
+
+class Command(BaseCommand):
+    help = 'Resumes failed payment settlements from their last completed step.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and resume again every given seconds.')
+
+    def handle(self, *args, **options):
+        while True:
+            for settlement_id in settlement.resumable():
+                try:
+                    payment_settlement = settlement.acquire(models.Settlement.objects.filter(id=settlement_id))
+                except settlement.SettlementBusy:
+                    continue
+
+                payment_settlement = settlement.settle(payment_settlement)
+                self.stdout.write('{}: {}'.format(payment_settlement, payment_settlement.last_error or 'settled'))
+
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import mirror
+
+
+class Command(BaseCommand):
+    help = 'Refreshes the ledger mirror tables from the blockchain.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', choices=sorted(mirror.MIRRORS),
+                            help='Kind of records to refresh, all of them by default. Can be repeated.')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of records fetched from the ledger at once.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Keep running and refresh again every given seconds.')
+
+    def handle(self, *args, **options):
+        kinds = options['kind'] or sorted(mirror.MIRRORS)
+
+        while True:
+            for kind in kinds:
+                started = time.monotonic()
+                stored = mirror.sync(kind, batch_size=options['batch_size'])
+                self.stdout.write('{}: {} records mirrored in {:.2f}s'.format(kind, stored, time.monotonic() - started))
+
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
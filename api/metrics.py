@@ -0,0 +1,102 @@
+import threading
+
+
+class Counter:
+    """
+    Counter with labels, exposed in Prometheus text format.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+
+class Histogram:
+    """
+    Histogram with labels, exposed in Prometheus text format.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            counts, total, observations = self._values.get(key, ([0] * len(self.buckets), 0, 0))
+            # Buckets are cumulative, a value is counted in every bucket it fits in
+            counts = [count + 1 if value <= bound else count for count, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, observations + 1)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, (counts, total, observations) in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + "_bucket", dict(labels, le=format_value(bound)), count
+            yield self.name + "_bucket", dict(labels, le="+Inf"), observations
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, observations
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(metrics):
+    """
+    Render metrics in Prometheus text format.
+    :param metrics: Counters, gauges and histograms.
+    :return: Exposition as string.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join('{}="{}"'.format(label, escape(labels[label])) for label in labels)
+                lines.append("{}{{{}}} {}".format(name, label_text, format_value(value)))
+            else:
+                lines.append("{} {}".format(name, format_value(value)))
+    return "\n".join(lines) + "\n"
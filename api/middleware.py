@@ -0,0 +1,130 @@
+import datetime, hashlib, json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from rest_framework import status
+
+from . import models
+from . import journal
+from . import blockchain as bc
+
+
+class RequestDeadlineMiddleware:
+    """
+    Gives every request a time budget for its ledger calls. The budget is taken
+    from the X-Request-Deadline header in seconds, capped at
+    REQUEST_DEADLINE_MAX, or REQUEST_DEADLINE by default.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = bc.set_deadline(self.budget(request))
+        try:
+            return self.get_response(request)
+        finally:
+            bc.reset_deadline(token)
+
+    @staticmethod
+    def budget(request):
+        default = getattr(settings, 'REQUEST_DEADLINE', None)
+        maximum = getattr(settings, 'REQUEST_DEADLINE_MAX', None)
+
+        try:
+            seconds = float(request.META['HTTP_X_REQUEST_DEADLINE'])
+        except (KeyError, ValueError):
+            return default
+
+        if seconds <= 0:
+            return default
+        if maximum is not None:
+            seconds = min(seconds, maximum)
+        return seconds
+
+
+class LedgerCacheMiddleware:
+    """
+    Drops the cached ledger reads of the records changed by other processes
+    before requests, at most once every check interval, see journal.CacheSync.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        journal.cache_sync.run()
+        return self.get_response(request)
+
+
+class IdempotencyMiddleware:
+    """
+    Makes POST, PUT and PATCH requests carrying an Idempotency-Key header safe
+    to retry. The first response for a key is stored for IDEMPOTENCY_KEY_TTL
+    and replayed for requests repeating the key, so retried writes do not
+    create duplicate records on the ledger. Server errors are not stored, the
+    request can be retried with the same key.
+    """
+
+    METHODS = ('POST', 'PUT', 'PATCH')
+
+    # Response headers replayed along with the body.
+    HEADERS = ('Location', 'X-Ledger-Degraded', 'X-Ledger-Partial')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if not key or request.method not in self.METHODS:
+            return self.get_response(request)
+
+        fingerprint = hashlib.sha256(request.body).hexdigest()
+        lookup = {'key': key[:255], 'method': request.method, 'path': request.path[:1024]}
+        now = timezone.now()
+
+        models.IdempotencyKey.objects.filter(expires_at__lte=now).delete()
+        try:
+            with transaction.atomic():
+                entry = models.IdempotencyKey.objects.create(
+                    fingerprint=fingerprint,
+                    expires_at=now + getattr(settings, 'IDEMPOTENCY_KEY_TTL', datetime.timedelta(hours=24)),
+                    **lookup
+                )
+        except IntegrityError:
+            return self.replay(models.IdempotencyKey.objects.filter(**lookup).first(), fingerprint)
+
+        try:
+            response = self.get_response(request)
+        except Exception:
+            entry.delete()
+            raise
+
+        if response.status_code >= 500 or response.streaming:
+            entry.delete()
+            return response
+
+        entry.status_code = response.status_code
+        entry.content = response.content
+        entry.content_type = response.get('Content-Type')
+        entry.headers = json.dumps({header: response[header] for header in self.HEADERS if response.has_header(header)})
+        entry.save()
+        return response
+
+    @staticmethod
+    def replay(entry, fingerprint):
+        if entry is None or entry.status_code is None:
+            return JsonResponse({'error': 'A request with this Idempotency-Key is in progress.'},
+                                status=status.HTTP_409_CONFLICT)
+
+        if entry.fingerprint != fingerprint:
+            return JsonResponse({'error': 'Idempotency-Key was used for a different request.'},
+                                status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        response = HttpResponse(bytes(entry.content), status=entry.status_code, content_type=entry.content_type)
+        for header, value in json.loads(entry.headers or '{}').items():
+            response[header] = value
+        response['Idempotent-Replayed'] = 'true'
+        return response
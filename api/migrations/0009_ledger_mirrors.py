@@ -0,0 +1,75 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_paymentletter_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryMirror',
+            fields=[
+                ('delivery', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mirror', serialize=False, to='api.Delivery')),
+                ('date', models.CharField(max_length=32)),
+                ('status', models.CharField(max_length=32)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HospitalOrderMirror',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mirror', serialize=False, to='api.HospitalOrder')),
+                ('amount', models.IntegerField()),
+                ('urgency', models.IntegerField()),
+                ('date', models.CharField(db_index=True, max_length=32)),
+                ('status', models.CharField(max_length=32)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MinistryOrderMirror',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mirror', serialize=False, to='api.MinistryOrder')),
+                ('amount', models.IntegerField()),
+                ('end_date', models.CharField(max_length=32)),
+                ('open_date', models.CharField(max_length=32)),
+                ('winner', models.CharField(max_length=2056, null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PaymentLetterMirror',
+            fields=[
+                ('letter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mirror', serialize=False, to='api.PaymentLetter')),
+                ('bank', models.CharField(max_length=2056)),
+                ('price', models.IntegerField()),
+                ('date', models.CharField(max_length=32)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProducerOfferMirror',
+            fields=[
+                ('offer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='mirror', serialize=False, to='api.ProducerOffer')),
+                ('producer', models.CharField(max_length=2056)),
+                ('order', models.CharField(max_length=2056)),
+                ('price', models.CharField(max_length=64)),
+                ('status', models.CharField(max_length=32)),
+                ('date', models.CharField(max_length=32)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProducerStockMirror',
+            fields=[
+                ('producer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_mirror', serialize=False, to='api.Organization')),
+                ('amount', models.IntegerField()),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:41
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_ledger_mirrors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerTransaction',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('function', models.CharField(max_length=64)),
+                ('args', models.TextField()),
+                ('record', models.TextField(blank=True, null=True)),
+                ('refresh', models.TextField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('PENDING', 'PENDING'), ('RUNNING', 'RUNNING'), ('COMMITTED', 'COMMITTED'), ('FAILED', 'FAILED')], default='PENDING', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='ledgertransaction',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='api_ledgert_status_f4feee_idx'),
+        ),
+    ]
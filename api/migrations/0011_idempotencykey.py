@@ -0,0 +1,32 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_ledgertransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('method', models.CharField(max_length=8)),
+                ('path', models.CharField(max_length=1024)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('status_code', models.IntegerField(null=True)),
+                ('content', models.BinaryField(null=True)),
+                ('content_type', models.CharField(max_length=255, null=True)),
+                ('headers', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'unique_together': {('key', 'method', 'path')},
+            },
+        ),
+    ]
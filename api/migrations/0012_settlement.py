@@ -0,0 +1,34 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Settlement',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('letter_id', models.CharField(max_length=2056)),
+                ('deal_id', models.CharField(max_length=2056)),
+                ('delivery_id', models.CharField(max_length=2056)),
+                ('mask_amount', models.IntegerField(blank=True, null=True)),
+                ('steps', models.TextField(default='[]')),
+                ('status', models.CharField(choices=[('RUNNING', 'RUNNING'), ('COMPLETED', 'COMPLETED'), ('FAILED', 'FAILED')], default='RUNNING', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bank', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='bank_settlements', to='api.Organization')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.Payment')),
+                ('producer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='producer_settlements', to='api.Organization')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_settlement'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='order',
+            field=models.CharField(db_index=True, max_length=2056),
+        ),
+        migrations.AlterField(
+            model_name='paymentletter',
+            name='order',
+            field=models.CharField(db_index=True, max_length=2056, null=True),
+        ),
+    ]
@@ -0,0 +1,83 @@
+import uuid
+
+from django.db import migrations
+
+
+# Models keyed by ledger ids, and the columns referencing them, with what is done to the rows
+# referencing records which do not exist locally: set to NULL, deleted as deleting the record
+# would, or left for the admin to sort out.
+LEDGER_KEYED = ['HospitalOrder', 'MinistryOrder', 'Deal', 'Delivery', 'PaymentLetter', 'ProducerOffer']
+REFERENCES = [
+    ('ProducerOffer', 'order', 'MinistryOrder', 'delete'),
+    ('PaymentLetter', 'order', 'MinistryOrder', 'null'),
+    ('Payment', 'order', 'MinistryOrder', 'fail'),
+    ('Deal', 'letter', 'PaymentLetter', 'fail'),
+]
+
+
+def is_uuid(value):
+    try:
+        return str(uuid.UUID(value)) == value
+    except (TypeError, ValueError, AttributeError):
+        return False
+
+
+def prepare_ledger_ids(apps, schema_editor):
+    """
+    Ids move to uuid columns in the next migration. Their text form must stay
+    the same since it is the id on the ledger, so every id has to be a UUID in
+    canonical form already. References to records which do not exist locally
+    can not become foreign keys: nullable ones are set to NULL, offers of
+    missing orders are deleted, and payments or deals of missing records stop
+    the migration, since they can not be dropped without the admin.
+    """
+    invalid = []
+    for model_name in LEDGER_KEYED:
+        for pk in apps.get_model('api', model_name).objects.values_list('pk', flat=True).iterator():
+            if not is_uuid(pk):
+                invalid.append('{} {!r}'.format(model_name, pk))
+
+    for model_name, field, target, on_missing in REFERENCES:
+        values = apps.get_model('api', model_name).objects.exclude(**{field: None}).values_list(field, flat=True)
+        for value in values.distinct().iterator():
+            if not is_uuid(value):
+                invalid.append('{}.{} {!r}'.format(model_name, field, value))
+
+    if invalid:
+        raise ValueError('Ledger ids are not canonical UUIDs: ' + ', '.join(invalid))
+
+    dangling = []
+    for model_name, field, target, on_missing in REFERENCES:
+        if on_missing == 'fail':
+            for pk, value in dangling_references(apps, model_name, field, target).values_list('pk', field).iterator():
+                dangling.append('{} {!r} ({} {!r})'.format(model_name, pk, field, value))
+
+    if dangling:
+        raise ValueError('Records reference ledger records which do not exist, create these or delete the records first: '
+                         + ', '.join(dangling))
+
+    for model_name, field, target, on_missing in REFERENCES:
+        rows = dangling_references(apps, model_name, field, target)
+        if on_missing == 'null':
+            rows.update(**{field: None})
+        elif on_missing == 'delete':
+            rows.delete()
+
+
+def dangling_references(apps, model_name, field, target):
+    """
+    :return: Queryset of the rows of model_name whose field references a target record which does not exist.
+    """
+    target_ids = apps.get_model('api', target).objects.values_list('pk', flat=True)
+    return apps.get_model('api', model_name).objects.exclude(**{field: None}).exclude(**{field + '__in': target_ids})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_order_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(prepare_ledger_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:46
+
+import uuid
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Mirror tables keyed by the records whose primary key becomes a uuid, as (model, field).
+MIRROR_KEYS = [
+    ('HospitalOrderMirror', 'order'),
+    ('MinistryOrderMirror', 'order'),
+    ('DeliveryMirror', 'delivery'),
+    ('PaymentLetterMirror', 'letter'),
+    ('ProducerOfferMirror', 'offer'),
+]
+
+
+def convert_mirror_keys(apps, schema_editor):
+    """
+    Django does not drop the foreign keys of the mirror tables before changing
+    the type of the primary keys they reference, which Postgres refuses. Their
+    columns are turned into uuid columns here, without the foreign keys and
+    varchar pattern indexes. The foreign keys are created again by the
+    AlterField of the primary keys.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for model_name, field_name in MIRROR_KEYS:
+        model = apps.get_model('api', model_name)
+        column = model._meta.get_field(field_name).column
+        table = schema_editor.quote_name(model._meta.db_table)
+
+        for name in schema_editor._constraint_names(model, [column], foreign_key=True):
+            schema_editor.execute(schema_editor._delete_fk_sql(model, name))
+        for name in schema_editor._constraint_names(model, [column], index=True):
+            if name.endswith('_like'):
+                schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(name)))
+
+        schema_editor.execute('ALTER TABLE {table} ALTER COLUMN {column} TYPE uuid USING {column}::uuid'.format(
+            table=table, column=schema_editor.quote_name(column)
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_ledger_id_references'),
+    ]
+
+    operations = [
+        migrations.RunPython(convert_mirror_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='deal',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='delivery',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='hospitalorder',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='ministryorder',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='paymentletter',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='produceroffer',
+            name='id',
+            field=models.UUIDField(primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='deal',
+            name='letter',
+            field=models.ForeignKey(db_column='letter', on_delete=django.db.models.deletion.PROTECT, to='api.PaymentLetter'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='order',
+            field=models.ForeignKey(db_column='order', on_delete=django.db.models.deletion.PROTECT, to='api.MinistryOrder'),
+        ),
+        migrations.AlterField(
+            model_name='paymentletter',
+            name='order',
+            field=models.ForeignKey(db_column='order', null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.MinistryOrder'),
+        ),
+        migrations.AlterField(
+            model_name='produceroffer',
+            name='order',
+            field=models.ForeignKey(db_column='order', on_delete=django.db.models.deletion.CASCADE, to='api.MinistryOrder'),
+        ),
+        migrations.AlterField(
+            model_name='organization',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, default=None, max_length=2056, null=True),
+        ),
+        migrations.AlterField(
+            model_name='settlement',
+            name='deal_id',
+            field=models.UUIDField(default=uuid.uuid1),
+        ),
+        migrations.AlterField(
+            model_name='settlement',
+            name='delivery_id',
+            field=models.UUIDField(default=uuid.uuid1),
+        ),
+        migrations.AlterField(
+            model_name='settlement',
+            name='letter_id',
+            field=models.UUIDField(default=uuid.uuid1),
+        ),
+    ]
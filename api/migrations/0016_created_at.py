@@ -0,0 +1,55 @@
+import datetime
+import uuid
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+MODELS = ['hospitalorder', 'ministryorder', 'deal', 'delivery', 'paymentletter', 'produceroffer']
+
+# Start of the uuid1 clock
+UUID_EPOCH = datetime.datetime(1582, 10, 15, tzinfo=datetime.timezone.utc)
+
+
+def created_at_of(pk, default):
+    """
+    Ids are made with uuid1, which carries the time it was made at.
+    """
+    if pk.version != 1:
+        return default
+    return UUID_EPOCH + datetime.timedelta(microseconds=pk.time // 10)
+
+
+def set_created_at(apps, schema_editor):
+    now = timezone.now()
+    for model_name in MODELS:
+        model = apps.get_model('api', model_name)
+        rows = []
+        for row in model.objects.only('pk').iterator():
+            row.created_at = created_at_of(row.pk if isinstance(row.pk, uuid.UUID) else uuid.UUID(str(row.pk)), now)
+            rows.append(row)
+        model.objects.bulk_update(rows, ['created_at'], batch_size=1000)
+
+
+def field(**kwargs):
+    return models.DateTimeField(db_index=True, **kwargs)
+
+
+class Migration(migrations.Migration):
+
+    # Rows are updated between the schema changes, which Postgres refuses in a single transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0015_uuid_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(model_name=model_name, name='created_at', field=field(null=True))
+        for model_name in MODELS
+    ] + [
+        migrations.RunPython(set_created_at, migrations.RunPython.noop, atomic=True),
+    ] + [
+        migrations.AlterField(model_name=model_name, name='created_at', field=field(auto_now_add=True))
+        for model_name in MODELS
+    ]
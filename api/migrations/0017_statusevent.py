@@ -0,0 +1,23 @@
+# Generated by Django 2.2.12 on 2026-10-18 15:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_created_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('delivery', 'delivery'), ('hospital_order', 'hospital_order')], max_length=32)),
+                ('record_id', models.UUIDField()),
+                ('status', models.CharField(max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
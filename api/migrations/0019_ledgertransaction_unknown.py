@@ -0,0 +1,18 @@
+# Generated by Django 2.2.12 on 2026-10-18 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_journalentry'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ledgertransaction',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'PENDING'), ('RUNNING', 'RUNNING'), ('COMMITTED', 'COMMITTED'), ('FAILED', 'FAILED'), ('UNKNOWN', 'UNKNOWN')], default='PENDING', max_length=16),
+        ),
+    ]
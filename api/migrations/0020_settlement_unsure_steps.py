@@ -0,0 +1,18 @@
+# Generated by Django 2.2.12 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0019_ledgertransaction_unknown'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settlement',
+            name='unsure_steps',
+            field=models.TextField(default='[]'),
+        ),
+    ]
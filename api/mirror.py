@@ -0,0 +1,314 @@
+from django.db import transaction
+
+from . import models
+from . import blockchain as bc
+from . import journal
+from .directory import directory
+
+
+class Mirror:
+    """
+    Keeps the decoded ledger state of one kind of record in a local table.
+    """
+
+    def __init__(self, kind, model, key_field, source, to_value, to_row):
+        """
+        :param kind: Key of the mirror in MIRRORS, changes are journaled under it.
+        :param model: Mirror model.
+        :param key_field: Field of the mirror model holding the blockchain id.
+        :param source: Function returning the blockchain ids of all the records to be mirrored.
+        :param to_value: Function turning a mirror row into the value returned by the blockchain lookup.
+        :param to_row: Function turning a blockchain id and its lookup value into a mirror row.
+        """
+        self.kind = kind
+        self.model = model
+        self.key_field = key_field
+        self.source = source
+        self.to_value = to_value
+        self.to_row = to_row
+
+    def load(self, ids):
+        """
+        :param ids: Blockchain ids.
+        :return: Mirrored values by blockchain id.
+        """
+        rows = self.model.objects.filter(**{self.key_field + '__in': ids})
+        if '__' in self.key_field:
+            rows = rows.select_related(self.key_field.split('__')[0])
+        return {self.key_of(row): self.to_value(row) for row in rows}
+
+    def key_of(self, row):
+        value = row
+        for attr in self.key_field.split('__'):
+            value = getattr(value, attr)
+        return str(value)
+
+    def store(self, values):
+        """
+        Insert or update the mirror rows of the given records. Records whose
+        ledger state changed are journaled.
+        :param values: Lookup values by blockchain id, failed lookups are skipped.
+        :return: Number of rows stored.
+        """
+        rows = [self.to_row(item_id, value) for item_id, value in values.items() if valid(value)]
+        rows = [row for row in rows if row is not None]
+
+        # Only records which exist locally can be mirrored
+        source_model = self.model._meta.pk.related_model
+        existing = source_model.objects.filter(pk__in=[row.pk for row in rows]).values_list('pk', flat=True)
+        existing = set(str(pk) for pk in existing)
+        rows = [row for row in rows if str(row.pk) in existing]
+
+        with transaction.atomic():
+            previous = self.load([self.key_of(row) for row in rows])
+            changed = [self.key_of(row) for row in rows if comparable(previous.get(self.key_of(row))) != comparable(self.to_value(row))]
+
+            self.model.objects.upsert(rows)
+            journal.record(self.kind, changed)
+
+        return len(rows)
+
+
+def valid(value):
+    return value is not None and value != -1
+
+
+def comparable(value):
+    # Ledger values and values read back from the mirror differ in types only, like UUID and str
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return {key: str(item) for key, item in value.items()}
+    return str(value)
+
+
+def hospital_order_value(row):
+    return {
+        "id": row.order_id,
+        "amount": row.amount,
+        "urgency": row.urgency,
+        "date": row.date,
+        "status": row.status
+    }
+
+
+def hospital_order_row(order_id, value):
+    return models.HospitalOrderMirror(
+        order_id=order_id,
+        amount=value["amount"],
+        urgency=value["urgency"],
+        date=value["date"],
+        status=value["status"]
+    )
+
+
+def ministry_order_value(row):
+    return {
+        "id": row.order_id,
+        "amount": row.amount,
+        "endDate": row.end_date,
+        "openDate": row.open_date,
+        "winner": row.winner
+    }
+
+
+def ministry_order_row(order_id, value):
+    return models.MinistryOrderMirror(
+        order_id=order_id,
+        amount=int(value["amount"]),
+        end_date=value["endDate"],
+        open_date=value["openDate"],
+        winner=value["winner"]
+    )
+
+
+def delivery_value(row):
+    return {
+        "id": row.delivery_id,
+        "date": row.date,
+        "status": row.status
+    }
+
+
+def delivery_row(delivery_id, value):
+    return models.DeliveryMirror(
+        delivery_id=delivery_id,
+        date=value["date"],
+        status=value["status"]
+    )
+
+
+def payment_letter_value(row):
+    return {
+        "id": row.letter_id,
+        "bank": row.bank,
+        "price": row.price,
+        "date": row.date
+    }
+
+
+def payment_letter_row(letter_id, value):
+    return models.PaymentLetterMirror(
+        letter_id=letter_id,
+        bank=value["bank"],
+        price=value["price"],
+        date=value["date"]
+    )
+
+
+def producer_offer_value(row):
+    return {
+        "id": row.offer_id,
+        "producer": row.producer,
+        "order": row.order,
+        "offer": row.price,
+        "status": row.status,
+        "date": row.date
+    }
+
+
+def producer_offer_row(offer_id, value):
+    return models.ProducerOfferMirror(
+        offer_id=offer_id,
+        producer=value["producer"],
+        order=value["order"],
+        price=value["offer"],
+        status=value["status"],
+        date=value["date"]
+    )
+
+
+def producer_stock_row(producer_key, amount):
+    producer = directory.get_by_key(producer_key)
+    if producer is None:
+        return None
+    return models.ProducerStockMirror(producer=producer, amount=amount)
+
+
+def ids_of(model):
+    return lambda: model.objects.values_list('id', flat=True).order_by('id').iterator()
+
+
+MIRRORS = {
+    "hospital_order": Mirror(
+        "hospital_order", models.HospitalOrderMirror, 'order_id', ids_of(models.HospitalOrder),
+        hospital_order_value, hospital_order_row
+    ),
+    "ministry_order": Mirror(
+        "ministry_order", models.MinistryOrderMirror, 'order_id', ids_of(models.MinistryOrder),
+        ministry_order_value, ministry_order_row
+    ),
+    "delivery": Mirror(
+        "delivery", models.DeliveryMirror, 'delivery_id', ids_of(models.Delivery),
+        delivery_value, delivery_row
+    ),
+    "payment_letter": Mirror(
+        "payment_letter", models.PaymentLetterMirror, 'letter_id', ids_of(models.PaymentLetter),
+        payment_letter_value, payment_letter_row
+    ),
+    "producer_offer": Mirror(
+        "producer_offer", models.ProducerOfferMirror, 'offer_id', ids_of(models.ProducerOffer),
+        producer_offer_value, producer_offer_row
+    ),
+    "producer_masks": Mirror(
+        "producer_masks", models.ProducerStockMirror, 'producer__key',
+        lambda: models.Organization.objects.filter(group='PRODUCER').values_list('key', flat=True).order_by('id').iterator(),
+        lambda row: row.amount, producer_stock_row
+    ),
+}
+
+
+def get_many(kind, ids, verify=False):
+    """
+    Same as bc.get_many, but serves the records from the mirror table. Records
+    missing in the mirror, or all of them when verifying, are fetched from the
+    ledger and mirrored.
+    :param kind: One of the keys of MIRRORS.
+    :param ids: Blockchain ids to look up.
+    :param verify: Fetch every record from the ledger.
+    :return: List of bc.BatchResult in the order of ids.
+    """
+    mirror = MIRRORS[kind]
+    ids = [str(item_id) for item_id in ids]
+
+    # Mirrored records are the best there is while the gateway is failing
+    if bc.breaker.is_open:
+        verify = False
+
+    values = {} if verify else mirror.load(ids)
+    missing = [item_id for item_id in ids if item_id not in values]
+
+    errors = {}
+    if missing:
+        fetched = {}
+        for bc_result in bc.get_many(kind, missing):
+            fetched[bc_result.id] = bc_result.value
+            if bc_result.error:
+                errors[bc_result.id] = bc_result.error
+
+        mirror.store(fetched)
+        values.update(fetched)
+
+    return [bc.BatchResult(item_id, values.get(item_id), errors.get(item_id)) for item_id in ids]
+
+
+def refresh(kind, ids):
+    """
+    Fetch records from the ledger and update their mirror rows.
+    :param kind: One of the keys of MIRRORS.
+    :param ids: Blockchain ids of the records.
+    :return: Number of rows stored.
+    """
+    ids = [str(item_id) for item_id in ids]
+    if not ids:
+        return 0
+
+    values = {bc_result.id: bc_result.value for bc_result in bc.get_many(kind, ids)}
+    return MIRRORS[kind].store(values)
+
+
+def sync(kind, batch_size=100):
+    """
+    Refresh the mirror rows of every record of a kind, in batches.
+    :param kind: One of the keys of MIRRORS.
+    :param batch_size: Number of records fetched from the ledger at once.
+    :return: Number of rows stored.
+    """
+    stored = 0
+    batch = []
+    for item_id in MIRRORS[kind].source():
+        batch.append(item_id)
+        if len(batch) >= batch_size:
+            stored += refresh(kind, batch)
+            batch = []
+
+    return stored + refresh(kind, batch)
+
+
+def iter_many(kind, ids, verify=False):
+    """
+    Same as get_many, but yields every record as soon as it is available:
+    mirrored records first, then the ones fetched from the ledger as their
+    lookups complete.
+    :param kind: One of the keys of MIRRORS.
+    :param ids: Blockchain ids to look up.
+    :param verify: Fetch every record from the ledger.
+    :return: Iterator of bc.BatchResult, in no particular order.
+    """
+    mirror = MIRRORS[kind]
+    ids = [str(item_id) for item_id in ids]
+
+    if bc.breaker.is_open:
+        verify = False
+
+    values = {} if verify else mirror.load(ids)
+    for item_id in ids:
+        if item_id in values:
+            yield bc.BatchResult(item_id, values[item_id], None)
+
+    fetched = {}
+    for bc_result in bc.iter_many(kind, [item_id for item_id in ids if item_id not in values]):
+        fetched[bc_result.id] = bc_result.value
+        yield bc_result
+
+    mirror.store(fetched)
@@ -1,6 +1,7 @@
 import uuid
-from django.db import models
+from django.db import models, connections, transaction
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 ORGANIZATION_TYPES = [
@@ -12,25 +13,84 @@ ORGANIZATION_TYPES = [
 ]
 
 
+# Prefix of the blockchain id of an organization, followed by its id
+KEY_PREFIXES = {
+	'HOSPITAL': 'Ho',
+	'PRODUCER': 'Co',
+	'BANK': 'Ba'
+}
+
+
+def key_prefix(group):
+	return KEY_PREFIXES.get(group, 'Mi')
+
+
+class OrganizationQuerySet(models.QuerySet):
+	def reserve_ids(self, count):
+		"""
+		Take ids from the primary key sequence, so that keys can be set before the rows are inserted.
+		:param count: Number of ids.
+		:return: List of ids, None if the database has no sequence to take them from.
+		"""
+		connection = connections[self.db]
+		if connection.vendor != 'postgresql' or count == 0:
+			return None
+
+		with connection.cursor() as cursor:
+			cursor.execute(
+				"SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+				[self.model._meta.db_table, count]
+			)
+			return [row[0] for row in cursor.fetchall()]
+
+	def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+		"""
+		Same as QuerySet.bulk_create, with the keys of new organizations set in the same insert.
+		"""
+		objs = list(objs)
+		new = [obj for obj in objs if obj.id is None]
+		ids = self.reserve_ids(len(new))
+
+		if ids is None:
+			# Ids are only known once the rows are inserted
+			with transaction.atomic(using=self.db):
+				for obj in objs:
+					obj.save(using=self.db)
+			return objs
+
+		for obj, reserved_id in zip(new, ids):
+			obj.id = reserved_id
+		for obj in objs:
+			if not obj.key:
+				obj.key = key_prefix(obj.group) + str(obj.id)
+		return super(OrganizationQuerySet, self).bulk_create(objs, batch_size=batch_size, ignore_conflicts=ignore_conflicts)
+
+
 class Organization(models.Model):
 	name = models.CharField(max_length=1024, null=False, blank=False)
 	group = models.CharField(max_length=32, choices=ORGANIZATION_TYPES, null=False, blank=False, default='OTHER')
-	key = models.CharField(null=True, blank=True, max_length=2056, default=None)
+	key = models.CharField(null=True, blank=True, max_length=2056, default=None, db_index=True)
+
+	objects = OrganizationQuerySet.as_manager()
 
 	def save(self, *args, **kwargs):
-		if not self.id:
-			if self.group == 'HOSPITAL':
-				key_prefix = 'Ho'
-			elif self.group == 'PRODUCER':
-				key_prefix = 'Co'
-			elif self.group == 'BANK':
-				key_prefix = 'Ba'
-			else:
-				key_prefix = 'Mi'
+		if self.id is None:
+			ids = Organization.objects.using(kwargs.get('using')).reserve_ids(1)
+			if ids is not None:
+				self.id = ids[0]
+				kwargs['force_insert'] = True
+
+		if self.key or self.id is not None:
+			if not self.key:
+				self.key = key_prefix(self.group) + str(self.id)
+				if kwargs.get('update_fields') is not None:
+					kwargs['update_fields'] = set(kwargs['update_fields']) | {'key'}
+			return super(Organization, self).save(*args, **kwargs)
 
+		# Without a sequence to take the id from, the key is set once the row has one
 		super(Organization, self).save(*args, **kwargs)
-		self.key = key_prefix + str(self.id)
-		return super(Organization, self).save(*args, **kwargs)
+		self.key = key_prefix(self.group) + str(self.id)
+		return super(Organization, self).save(update_fields=['key'], using=kwargs.get('using'))
 
 	def __str__(self):
 		return '[Name: {} | Group: {} | Key: {}]'.format(self.name, self.group, self.key)
@@ -49,54 +109,297 @@ class OrganizationUser(AbstractUser):
 
 
 class HospitalOrder(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	hospital = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	def __str__(self):
 		return '[ID: {} | Hospital: {}]'.format(self.id, self.hospital)
 
 
 class MinistryOrder(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	ministry = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	def __str__(self):
 		return '[ID: {} | Ministry: {}]'.format(self.id, self.ministry)
 
 
 class Deal(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	producer = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
-	letter = models.CharField(null=False, blank=False, max_length=2056)
+	letter = models.ForeignKey('PaymentLetter', db_column='letter', on_delete=models.PROTECT)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	def __str__(self):
-		return '[ID: {} | Producer: {} | Letter: {}]'.format(self.id, self.producer, self.letter)
+		return '[ID: {} | Producer: {} | Letter: {}]'.format(self.id, self.producer, self.letter_id)
 
 
 class Delivery(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	producer = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	def __str__(self):
 		return '[ID: {} | Producer: {}]'.format(self.id, self.producer)
 
 
 class PaymentLetter(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	bank = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
-	order = models.CharField(null=True, max_length=2056)
+	order = models.ForeignKey(MinistryOrder, db_column='order', null=True, on_delete=models.SET_NULL)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 	def __str__(self):
 		return '[ID: {}]'.format(self.id)
 
 
 class ProducerOffer(models.Model):
-	id = models.CharField(null=False, blank=False, max_length=2056, primary_key=True)
+	id = models.UUIDField(primary_key=True)
 	producer = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
-	order = models.CharField(null=False, blank=False, max_length=2056)
+	order = models.ForeignKey(MinistryOrder, db_column='order', on_delete=models.CASCADE)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
 
 class Payment(models.Model):
-	order = models.CharField(null=False, blank=False, max_length=2056)
+	order = models.ForeignKey(MinistryOrder, db_column='order', on_delete=models.PROTECT)
 	price = models.DecimalField(null=False, blank=False, max_digits=9, decimal_places=2)
 	producer = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL)
+
+
+TRANSACTION_STATUSES = [
+	('PENDING', 'PENDING'),
+	('RUNNING', 'RUNNING'),
+	('COMMITTED', 'COMMITTED'),
+	('FAILED', 'FAILED'),
+	('UNKNOWN', 'UNKNOWN')
+]
+
+
+class LedgerTransaction(models.Model):
+	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+	function = models.CharField(max_length=64)
+	args = models.TextField()
+	record = models.TextField(null=True, blank=True)
+	refresh = models.TextField(null=True, blank=True)
+	status = models.CharField(max_length=16, choices=TRANSACTION_STATUSES, default='PENDING')
+	attempts = models.IntegerField(default=0)
+	last_error = models.TextField(null=True, blank=True)
+	next_attempt_at = models.DateTimeField(default=timezone.now)
+	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	# Set by api.outbox.claim when an earlier attempt may have reached the ledger
+	check_first = False
+
+	class Meta:
+		indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+	def __str__(self):
+		return '[ID: {} | Function: {} | Status: {}]'.format(self.id, self.function, self.status)
+
+
+SETTLEMENT_STATUSES = [
+	('RUNNING', 'RUNNING'),
+	('COMPLETED', 'COMPLETED'),
+	('FAILED', 'FAILED')
+]
+
+
+class Settlement(models.Model):
+	id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+	payment = models.ForeignKey(Payment, on_delete=models.CASCADE)
+	bank = models.ForeignKey(Organization, null=True, on_delete=models.SET_NULL, related_name='bank_settlements')
+	producer = models.ForeignKey(Organization, null=True, blank=True, on_delete=models.SET_NULL, related_name='producer_settlements')
+	letter_id = models.UUIDField(default=uuid.uuid1)
+	deal_id = models.UUIDField(default=uuid.uuid1)
+	delivery_id = models.UUIDField(default=uuid.uuid1)
+	mask_amount = models.IntegerField(null=True, blank=True)
+	steps = models.TextField(default='[]')
+	unsure_steps = models.TextField(default='[]')
+	status = models.CharField(max_length=16, choices=SETTLEMENT_STATUSES, default='RUNNING')
+	attempts = models.IntegerField(default=0)
+	last_error = models.TextField(null=True, blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	updated_at = models.DateTimeField(auto_now=True)
+
+	def __str__(self):
+		return '[ID: {} | Payment: {} | Status: {}]'.format(self.id, self.payment_id, self.status)
+
+
+class IdempotencyKey(models.Model):
+	key = models.CharField(max_length=255)
+	method = models.CharField(max_length=8)
+	path = models.CharField(max_length=1024)
+	fingerprint = models.CharField(max_length=64)
+	status_code = models.IntegerField(null=True)
+	content = models.BinaryField(null=True)
+	content_type = models.CharField(max_length=255, null=True)
+	headers = models.TextField(null=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	expires_at = models.DateTimeField(db_index=True)
+
+	class Meta:
+		unique_together = [('key', 'method', 'path')]
+
+	def __str__(self):
+		return '[Key: {} | {} {} | Status: {}]'.format(self.key, self.method, self.path, self.status_code)
+
+
+STATUS_EVENT_KINDS = [
+	('delivery', 'delivery'),
+	('hospital_order', 'hospital_order')
+]
+
+
+class StatusEvent(models.Model):
+	id = models.BigAutoField(primary_key=True)
+	kind = models.CharField(max_length=32, choices=STATUS_EVENT_KINDS)
+	record_id = models.UUIDField()
+	status = models.CharField(max_length=32)
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return '[ID: {} | {} {} | Status: {}]'.format(self.id, self.kind, self.record_id, self.status)
+
+
+
+class JournalEntry(models.Model):
+	id = models.BigAutoField(primary_key=True)
+	kind = models.CharField(max_length=32)
+	record_id = models.CharField(max_length=255)
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		indexes = [models.Index(fields=['kind', 'id'])]
+
+	def __str__(self):
+		return '[ID: {} | {} {}]'.format(self.id, self.kind, self.record_id)
+
+
+'''
+Ledger mirrors, decoded ledger state of the records above kept in sync by api.mirror
+'''
+
+
+class MirrorQuerySet(models.QuerySet):
+	def upsert(self, objs):
+		"""
+		Insert the rows, updating the ones whose primary key exists already in the same statement,
+		so that concurrent writers of the same rows do not run into each other.
+		:param objs: Model instances.
+		:return:
+		"""
+		objs = list(objs)
+		connection = connections[self.db]
+		if connection.vendor not in ('postgresql', 'sqlite') or not objs:
+			with transaction.atomic(using=self.db):
+				for obj in objs:
+					obj.save(using=self.db)
+			return
+
+		opts = self.model._meta
+		fields = opts.concrete_fields
+		quote = connection.ops.quote_name
+		columns = ', '.join(quote(field.column) for field in fields)
+		updates = ', '.join(
+			'{0} = EXCLUDED.{0}'.format(quote(field.column)) for field in fields if not field.primary_key
+		)
+		batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+
+		with connection.cursor() as cursor:
+			for start in range(0, len(objs), batch_size):
+				batch = objs[start:start + batch_size]
+				params = [
+					field.get_db_prep_save(field.pre_save(obj, True), connection)
+					for obj in batch for field in fields
+				]
+				cursor.execute(
+					'INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+						quote(opts.db_table), columns,
+						', '.join(['({})'.format(', '.join(['%s'] * len(fields)))] * len(batch)),
+						quote(opts.pk.column), updates
+					),
+					params
+				)
+
+
+
+class HospitalOrderMirror(models.Model):
+	order = models.OneToOneField(HospitalOrder, primary_key=True, on_delete=models.CASCADE, related_name='mirror')
+	amount = models.IntegerField()
+	urgency = models.IntegerField()
+	date = models.CharField(max_length=32, db_index=True)
+	status = models.CharField(max_length=32)
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Order: {} | Amount: {} | Status: {}]'.format(self.order_id, self.amount, self.status)
+
+
+class MinistryOrderMirror(models.Model):
+	order = models.OneToOneField(MinistryOrder, primary_key=True, on_delete=models.CASCADE, related_name='mirror')
+	amount = models.IntegerField()
+	end_date = models.CharField(max_length=32)
+	open_date = models.CharField(max_length=32)
+	winner = models.CharField(null=True, max_length=2056)
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Order: {} | Amount: {} | Winner: {}]'.format(self.order_id, self.amount, self.winner)
+
+
+class DeliveryMirror(models.Model):
+	delivery = models.OneToOneField(Delivery, primary_key=True, on_delete=models.CASCADE, related_name='mirror')
+	date = models.CharField(max_length=32)
+	status = models.CharField(max_length=32)
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Delivery: {} | Status: {}]'.format(self.delivery_id, self.status)
+
+
+class PaymentLetterMirror(models.Model):
+	letter = models.OneToOneField(PaymentLetter, primary_key=True, on_delete=models.CASCADE, related_name='mirror')
+	bank = models.CharField(max_length=2056)
+	price = models.IntegerField()
+	date = models.CharField(max_length=32)
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Letter: {} | Price: {}]'.format(self.letter_id, self.price)
+
+
+class ProducerOfferMirror(models.Model):
+	offer = models.OneToOneField(ProducerOffer, primary_key=True, on_delete=models.CASCADE, related_name='mirror')
+	producer = models.CharField(max_length=2056)
+	order = models.CharField(max_length=2056)
+	price = models.CharField(max_length=64)
+	status = models.CharField(max_length=32)
+	date = models.CharField(max_length=32)
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Offer: {} | Price: {} | Status: {}]'.format(self.offer_id, self.price, self.status)
+
+
+class ProducerStockMirror(models.Model):
+	producer = models.OneToOneField(Organization, primary_key=True, on_delete=models.CASCADE, related_name='stock_mirror')
+	amount = models.IntegerField()
+	synced_at = models.DateTimeField(auto_now=True)
+
+	objects = MirrorQuerySet.as_manager()
+
+	def __str__(self):
+		return '[Producer: {} | Amount: {}]'.format(self.producer_id, self.amount)
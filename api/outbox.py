@@ -0,0 +1,305 @@
+import datetime, json
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import models
+from . import mirror
+from . import blockchain as bc
+
+
+# Ledger writes which can be queued, by name.
+WRITE_FUNCTIONS = {
+    "make_ministry_order": bc.amake_ministry_order,
+    "update_mask": bc.aupdate_mask,
+    "make_hospital_order": bc.amake_hospital_order,
+    "update_hospital_order": bc.aupdate_hospital_order,
+    "create_producer_offer": bc.acreate_producer_offer,
+    "accept_offer": bc.aaccept_offer,
+    "create_deal": bc.acreate_deal,
+    "create_delivery": bc.acreate_delivery,
+    "update_delivery": bc.aupdate_delivery,
+    "create_payment_letter": bc.acreate_payment_letter,
+}
+
+# Writes which only set a status, sending them again does no harm even if an earlier attempt was committed.
+IDEMPOTENT_WRITES = frozenset(["update_hospital_order", "update_delivery"])
+
+
+async def arecord_exists(lookup, item_id):
+    """
+    :param lookup: Ledger lookup of the record, like bc.aget_delivery_info.
+    :param item_id: Blockchain id of the record.
+    :return: True if the record is on the ledger, False if it is not, None if the ledger could not be read.
+    """
+    try:
+        value = await lookup(item_id)
+    except (KeyError, TypeError):
+        # The gateway answered with something else than the record
+        return False
+    return None if value is None else True
+
+
+async def aoffer_accepted(offer_id, order_id):
+    try:
+        order = await bc.aget_ministry_order_info(order_id)
+    except (KeyError, TypeError):
+        return False
+    return None if order is None else order["winner"] == str(offer_id)
+
+
+# Checks telling whether a write, which may have reached the ledger, is there: True if it is, False if it is not and
+# None if the ledger could not be read. They take the arguments of the write. Writes without one, like update_mask
+# which adds to the stock, are not sent again once their outcome is unknown.
+WRITE_CHECKS = {
+    "make_ministry_order": lambda order_id, **args: arecord_exists(bc.aget_ministry_order_info, order_id),
+    "make_hospital_order": lambda order_id, **args: arecord_exists(bc.aget_hospital_order_info, order_id),
+    "create_producer_offer": lambda offer_id, **args: arecord_exists(bc.aget_producer_offer_info, offer_id),
+    "accept_offer": aoffer_accepted,
+    "create_delivery": lambda delivery_id, **args: arecord_exists(bc.aget_delivery_info, delivery_id),
+    "create_payment_letter": lambda letter_id, **args: arecord_exists(bc.aget_payment_letter_info, letter_id),
+}
+
+MAX_ATTEMPTS = 5
+
+# Seconds to wait before retrying, doubled after every failed attempt.
+RETRY_DELAY = 5
+
+# Transactions running for longer than this are taken as abandoned by a dead worker.
+LEASE = datetime.timedelta(minutes=5)
+
+
+def enqueue(function, args, record=None, refresh=None):
+    """
+    Persist a ledger write to be submitted by the transaction worker.
+    :param function: Name of the write, one of the keys of WRITE_FUNCTIONS.
+    :param args: Keyword arguments of the write.
+    :param record: Local record to be created once the write is committed, as (model name, fields).
+    :param refresh: Mirrors to be refreshed once the write is committed, as [(kind, ids)].
+    :return: LedgerTransaction
+    """
+    if function not in WRITE_FUNCTIONS:
+        raise ValueError("Unknown ledger write: " + function)
+
+    return models.LedgerTransaction.objects.create(**transaction_fields(function, args, record, refresh))
+
+
+def enqueue_many(writes, claimed=0):
+    """
+    Same as enqueue for many writes, in one insert.
+    :param writes: List of (function, args, record, refresh), as taken by enqueue.
+    :param claimed: Number of the first transactions marked as running, for the caller to submit them with
+        run right away. If it dies before, the worker takes them over once LEASE expired.
+    :return: List of LedgerTransaction
+    """
+    ledger_transactions = []
+    for index, (function, args, record, refresh) in enumerate(writes):
+        if function not in WRITE_FUNCTIONS:
+            raise ValueError("Unknown ledger write: " + function)
+
+        ledger_transaction = models.LedgerTransaction(**transaction_fields(function, args, record, refresh))
+        if index < claimed:
+            ledger_transaction.status = 'RUNNING'
+            ledger_transaction.attempts = 1
+        ledger_transactions.append(ledger_transaction)
+
+    return models.LedgerTransaction.objects.bulk_create(ledger_transactions)
+
+
+def transaction_fields(function, args, record, refresh):
+    return {
+        "function": function,
+        "args": json.dumps(args, default=str),
+        "record": None if record is None else json.dumps({"model": record[0], "fields": record[1]}, default=str),
+        "refresh": None if refresh is None else json.dumps(refresh, default=str),
+    }
+
+
+def claim(batch_size):
+    """
+    Take due transactions to be submitted, skipping the ones other workers hold.
+    :param batch_size: Max number of transactions.
+    :return: List of LedgerTransaction, marked as running.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = models.LedgerTransaction.objects.select_for_update(skip_locked=True).filter(
+            Q(status='PENDING', next_attempt_at__lte=now) |
+            Q(status='UNKNOWN', function__in=list(WRITE_CHECKS), attempts__lt=MAX_ATTEMPTS, next_attempt_at__lte=now) |
+            Q(status='RUNNING', updated_at__lt=now - LEASE)
+        )
+        claimed = list(due.order_by('created_at')[:batch_size])
+
+        for ledger_transaction in claimed:
+            # Abandoned writes may have been sent before their worker died
+            ledger_transaction.check_first = ledger_transaction.status != 'PENDING'
+            ledger_transaction.status = 'RUNNING'
+            ledger_transaction.attempts += 1
+            ledger_transaction.save(update_fields=['status', 'attempts', 'updated_at'])
+
+    return claimed
+
+
+async def asubmit(ledger_transaction):
+    function = ledger_transaction.function
+    args = json.loads(ledger_transaction.args)
+
+    if ledger_transaction.check_first and function not in IDEMPOTENT_WRITES:
+        if function not in WRITE_CHECKS:
+            return "Outcome of an earlier attempt is unknown, the write is not sent again.", True
+
+        found = await WRITE_CHECKS[function](**args)
+        if found is None:
+            return "Outcome of an earlier attempt is unknown, the ledger could not be read.", True
+        if found:
+            return None, False
+
+    success, unsure = await bc.atrack_write(WRITE_FUNCTIONS[function](**args))
+    return (None, False) if success else ("Blockchain request failed", unsure)
+
+
+def submit(ledger_transaction):
+    """
+    Send the write to the ledger. Writes which may have been sent already are
+    only sent again once WRITE_CHECKS tells they are not on the ledger. Does
+    not touch the database, so that it can run in any thread.
+    :param ledger_transaction: LedgerTransaction
+    :return: Error message, None on success, and True if the write may be on the ledger in spite of the error.
+    """
+    try:
+        return bc.client.run(asubmit(ledger_transaction))
+    except Exception as inst:
+        return repr(inst), ledger_transaction.check_first
+
+
+def finish(ledger_transaction, error, unsure=False):
+    """
+    Record the outcome of a submitted transaction. Committed transactions get
+    their local record created and their mirrors refreshed. Failed ones are
+    retried later until MAX_ATTEMPTS, unless they may be on the ledger: these
+    are marked as unknown, and checked before being sent again.
+    :param ledger_transaction: LedgerTransaction
+    :param error: Error message returned by submit.
+    :param unsure: True if the write may be on the ledger in spite of the error.
+    :return:
+    """
+    if error is not None:
+        ledger_transaction.last_error = error
+        if unsure and ledger_transaction.function not in IDEMPOTENT_WRITES:
+            ledger_transaction.status = 'UNKNOWN'
+        elif ledger_transaction.attempts >= MAX_ATTEMPTS:
+            ledger_transaction.status = 'FAILED'
+        else:
+            ledger_transaction.status = 'PENDING'
+        delay = RETRY_DELAY * 2 ** (ledger_transaction.attempts - 1)
+        ledger_transaction.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+        ledger_transaction.save()
+        return
+
+    if ledger_transaction.record:
+        record = json.loads(ledger_transaction.record)
+        model = apps.get_model('api', record["model"])
+        fields = record["fields"]
+        model.objects.get_or_create(pk=fields.pop("id"), defaults=fields)
+
+    # Mirrors are refreshed first, so that the write can be read back once it shows as committed
+    for kind, ids in json.loads(ledger_transaction.refresh or '[]'):
+        mirror.refresh(kind, ids)
+
+    ledger_transaction.status = 'COMMITTED'
+    ledger_transaction.last_error = None
+    ledger_transaction.save()
+
+
+def finish_many(ledger_transactions, outcomes):
+    """
+    Same as finish for many transactions. The local records of the committed
+    ones are created with one insert per model, and their mirrors refreshed
+    with one ledger batch per kind.
+    :param ledger_transactions: List of LedgerTransaction.
+    :param outcomes: Error messages and unsure flags returned by submit, in the same order.
+    :return:
+    """
+    committed = []
+    for ledger_transaction, (error, unsure) in zip(ledger_transactions, outcomes):
+        if error is None:
+            committed.append(ledger_transaction)
+        else:
+            finish(ledger_transaction, error, unsure)
+
+    if not committed:
+        return
+
+    records = {}
+    refresh = {}
+    for ledger_transaction in committed:
+        if ledger_transaction.record:
+            record = json.loads(ledger_transaction.record)
+            records.setdefault(record["model"], []).append(record["fields"])
+        for kind, ids in json.loads(ledger_transaction.refresh or '[]'):
+            refresh.setdefault(kind, []).extend(ids)
+
+    with transaction.atomic():
+        for model_name, rows in records.items():
+            model = apps.get_model('api', model_name)
+            # Same as get_or_create, records created by an earlier attempt are kept
+            model.objects.bulk_create([model(**fields) for fields in rows], ignore_conflicts=True)
+
+    for kind, ids in refresh.items():
+        mirror.refresh(kind, ids)
+
+    for ledger_transaction in committed:
+        ledger_transaction.status = 'COMMITTED'
+        ledger_transaction.last_error = None
+
+    models.LedgerTransaction.objects.filter(id__in=[ledger_transaction.id for ledger_transaction in committed]).update(
+        status='COMMITTED', last_error=None, updated_at=timezone.now()
+    )
+
+
+def run(ledger_transactions, workers=None):
+    """
+    Submit claimed transactions, up to workers of them at the same time, and record their outcome.
+    :param ledger_transactions: List of LedgerTransaction, marked as running.
+    :param workers: Number of writes in flight, connection pool size by default.
+    :return: Error messages, None for the committed transactions.
+    """
+    if not ledger_transactions:
+        return []
+
+    with ThreadPoolExecutor(max_workers=workers or bc.client.pool_size) as executor:
+        futures = [executor.submit(submit, ledger_transaction) for ledger_transaction in ledger_transactions]
+
+        # Writes sent already are only recorded at the end, none may be taken over by the worker until then
+        while wait(futures, timeout=LEASE.total_seconds() / 3).not_done:
+            renew(ledger_transactions)
+
+    outcomes = [future.result() for future in futures]
+    finish_many(ledger_transactions, outcomes)
+    return [error for error, unsure in outcomes]
+
+
+def renew(ledger_transactions):
+    """
+    Extend the lease of running transactions.
+    :param ledger_transactions: List of LedgerTransaction.
+    :return:
+    """
+    models.LedgerTransaction.objects.filter(
+        id__in=[ledger_transaction.id for ledger_transaction in ledger_transactions], status='RUNNING'
+    ).update(updated_at=timezone.now())
+
+
+def process(batch_size=50, workers=None):
+    """
+    Submit a batch of due transactions, up to workers of them at the same time.
+    :param batch_size: Max number of transactions.
+    :param workers: Number of writes in flight, connection pool size by default.
+    :return: Number of transactions processed.
+    """
+    claimed = claim(batch_size)
+    run(claimed, workers)
+    return len(claimed)
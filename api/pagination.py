@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreationCursorPagination(CursorPagination):
+    """
+    Cursor pagination on creation order, newest first. Pages hold PAGE_SIZE
+    rows, clients can ask for up to max_page_size with the page_size query
+    parameter.
+    """
+
+    ordering = '-created_at'
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def __init__(self, ordering=None):
+        if ordering is not None:
+            self.ordering = ordering
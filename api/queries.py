@@ -0,0 +1,169 @@
+import uuid
+
+from . import models
+from .dataloader import Rows, Ledger, QueryError
+from .directory import directory
+
+
+'''
+Queries of the batch endpoint. Each one is a generator resolved by a
+DataLoader, taking the parameters sent by the client.
+'''
+
+
+def organization_param(params, name, group):
+    """
+    :param params: Query parameters.
+    :param name: Parameter holding the id of the organization.
+    :param group: Group the organization must belong to.
+    :return: Organization
+    """
+    organization = directory.get(params.get(name))
+    if organization is None or organization.group != group:
+        raise QueryError("{} must be the id of a {} organization.".format(name, group.lower()))
+    return organization
+
+
+def uuid_param(params, name):
+    try:
+        return uuid.UUID(str(params.get(name)))
+    except ValueError:
+        raise QueryError("{} must be a blockchain id.".format(name))
+
+
+def hospital_orders(params):
+    """
+    Orders of a hospital, newest first.
+    :param params: hospital
+    """
+    hospital = organization_param(params, "hospital", "HOSPITAL")
+    orders = yield Rows(models.HospitalOrder, "hospital_id", [hospital.id])
+    records = yield Ledger("hospital_order", [order.id for order in orders])
+
+    orders = [record for record in records.values() if record is not None and record["amount"] != -1]
+    return sorted(orders, key=lambda k: k['date'], reverse=True)
+
+
+def offers(params):
+    """
+    Offers of a producer or for a ministry order, with the ministry order of
+    every offer under ministryOrder if asked with orders.
+    :param params: producer or order, orders
+    """
+    if "order" in params:
+        rows = Rows(models.ProducerOffer, "order_id", [uuid_param(params, "order")])
+    else:
+        rows = Rows(models.ProducerOffer, "producer_id", [organization_param(params, "producer", "PRODUCER").id])
+
+    offer_rows = yield rows
+    records = yield Ledger("producer_offer", [offer.id for offer in offer_rows])
+
+    offer_rows = [offer for offer in offer_rows if records[str(offer.id)] is not None]
+    if params.get("orders"):
+        orders = yield Ledger("ministry_order", [offer.order_id for offer in offer_rows])
+        for offer in offer_rows:
+            records[str(offer.id)]["ministryOrder"] = orders[str(offer.order_id)]
+
+    return [records[str(offer.id)] for offer in offer_rows]
+
+
+def deals(params):
+    """
+    Deals of a producer, with the delivery of every deal.
+    :param params: producer
+    """
+    producer = organization_param(params, "producer", "PRODUCER")
+    deal_rows = yield Rows(models.Deal, "producer_id", [producer.id])
+
+    # Deals and their deliveries are made by the settlement of a payment
+    settlements = yield Rows(models.Settlement, "deal_id", [deal.id for deal in deal_rows])
+    delivery_ids = {settlement.deal_id: settlement.delivery_id for settlement in settlements}
+    deliveries = yield Ledger("delivery", list(delivery_ids.values()))
+
+    return [
+        {"deal": deal.id, "delivery": deliveries[str(delivery_ids[deal.id])] if deal.id in delivery_ids else None}
+        for deal in deal_rows
+    ]
+
+
+def deliveries(params):
+    """
+    Deliveries of a producer.
+    :param params: producer
+    """
+    producer = organization_param(params, "producer", "PRODUCER")
+    delivery_rows = yield Rows(models.Delivery, "producer_id", [producer.id])
+    records = yield Ledger("delivery", [delivery.id for delivery in delivery_rows])
+
+    result = []
+    for delivery in delivery_rows:
+        record = records[str(delivery.id)]
+        if record is not None:
+            record["producer"] = directory.data(delivery.producer_id)
+            result.append(record)
+    return result
+
+
+def payment_letters(params):
+    """
+    Payment letters of a bank, or for the payments of a producer.
+    :param params: bank or producer
+    """
+    if "bank" in params:
+        letter_rows = yield Rows(models.PaymentLetter, "bank_id", [organization_param(params, "bank", "BANK").id])
+    else:
+        producer = organization_param(params, "producer", "PRODUCER")
+        payments = yield Rows(models.Payment, "producer_id", [producer.id])
+        letter_rows = yield Rows(models.PaymentLetter, "order_id", [payment.order_id for payment in payments])
+
+    records = yield Ledger("payment_letter", [letter.id for letter in letter_rows])
+
+    result = []
+    for letter in letter_rows:
+        record = records[str(letter.id)]
+        if record is not None:
+            bank = directory.get(letter.bank_id)
+            record["name"] = bank.name if bank else None
+            record["order"] = letter.order_id
+            result.append(record)
+    return result
+
+
+def producer_masks(params):
+    """
+    Mask amount of a producer.
+    :param params: producer
+    """
+    producer = organization_param(params, "producer", "PRODUCER")
+    masks = yield Ledger("producer_masks", [producer.key])
+
+    return {"producer": directory.data(producer.id), "masks": masks[producer.key]}
+
+
+def ministry_orders(params):
+    """
+    Ministry orders by id, missing ones are left out.
+    :param params: ids
+    """
+    ids = params.get("ids")
+    if not isinstance(ids, list):
+        raise QueryError("ids must be a list of blockchain ids.")
+
+    ids = [uuid_param({"id": item_id}, "id") for item_id in ids]
+    records = yield Ledger("ministry_order", ids)
+
+    return [records[str(order_id)] for order_id in ids if records[str(order_id)] is not None]
+
+
+QUERIES = {
+    "hospital_orders": hospital_orders,
+    "offers": offers,
+    "deals": deals,
+    "deliveries": deliveries,
+    "payment_letters": payment_letters,
+    "producer_masks": producer_masks,
+    "ministry_orders": ministry_orders,
+}
+
+# Max number of queries in a batch.
+MAX_QUERIES = 20
@@ -1,6 +1,6 @@
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, CharField
 
-from .models import Organization, OrganizationUser, Payment
+from .models import Organization, OrganizationUser, Payment, LedgerTransaction
 
 
 class OrganizationSerializer(ModelSerializer):
@@ -17,6 +17,15 @@ class OrganizationUserSerializer(ModelSerializer):
 
 
 class PaymentSerializer(ModelSerializer):
+    # Views listing payments select the producer along with them
+    producerName = CharField(source='producer.name', read_only=True)
+
     class Meta:
         model = Payment
         fields = '__all__'
+
+
+class LedgerTransactionSerializer(ModelSerializer):
+    class Meta:
+        model = LedgerTransaction
+        fields = ('id', 'function', 'status', 'attempts', 'last_error', 'created_at', 'updated_at')
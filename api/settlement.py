@@ -0,0 +1,297 @@
+import asyncio, datetime, json
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import models
+from . import mirror
+from . import outbox
+from . import blockchain as bc
+from .directory import directory
+
+
+MAX_ATTEMPTS = 5
+
+# Settlements running for longer than this are taken as abandoned by a dead worker.
+LEASE = datetime.timedelta(minutes=5)
+
+
+class SettlementError(Exception):
+    def __init__(self, message, unsure=False):
+        """
+        :param message: Error message of the step.
+        :param unsure: True if the write of the step may be on the ledger in spite of the error.
+        """
+        super(SettlementError, self).__init__(message)
+        self.unsure = unsure
+
+
+class SettlementBusy(Exception):
+    pass
+
+
+async def required(coro, message):
+    """
+    Await a ledger call and fail the step if the call failed.
+    :param coro: Ledger call.
+    :param message: Error message of the step.
+    :return: Result of the call.
+    """
+    result = await coro
+    if not result:
+        raise SettlementError(message)
+    return result
+
+
+async def required_write(coro, message):
+    """
+    Same as required for a ledger write, telling whether it may be on the ledger when it failed.
+    :param coro: Ledger write.
+    :param message: Error message of the step.
+    :return: True
+    """
+    success, unsure = await bc.atrack_write(coro)
+    if not success:
+        raise SettlementError(message, unsure)
+    return success
+
+
+async def awinner(order_id):
+    """
+    Look up the winner offer of a ministry order.
+    :param order_id: Blockchain id of the ministry order.
+    :return: Mask amount of the order and blockchain id of the winner producer.
+    """
+    order = await required(bc.aget_ministry_order_info(order_id), "Blockchain request failed for ministry order.")
+    if order["winner"] is None:
+        raise SettlementError("Ministry order has no winner offer.")
+
+    offer = await required(bc.aget_producer_offer_info(order["winner"]), "Blockchain request failed for producer offer.")
+    return int(order["amount"]), offer["producer"]
+
+
+'''
+Steps, each as (ledger call, local save). Steps of a phase do not depend on
+each other and run at the same time, the next phase starts once all of them
+completed.
+'''
+
+# Steps writing to the ledger, which may have been sent when their settlement was abandoned.
+WRITE_STEPS = ("letter", "deal", "delivery")
+
+# Checks telling whether the write of a step is on the ledger, as for outbox.WRITE_CHECKS. The deal can not be
+# looked up, and it moves masks, so it is not sent again once its outcome is unknown.
+STEP_CHECKS = {
+    "letter": lambda settlement: outbox.arecord_exists(bc.aget_payment_letter_info, settlement.letter_id),
+    "delivery": lambda settlement: outbox.arecord_exists(bc.aget_delivery_info, settlement.delivery_id),
+}
+
+
+def letter_call(settlement):
+    return required_write(
+        bc.acreate_payment_letter(settlement.letter_id, settlement.bank.key, str(int(settlement.payment.price))),
+        "Blockchain request failed for payment letter."
+    )
+
+
+def letter_save(settlement, result):
+    models.PaymentLetter.objects.get_or_create(
+        id=settlement.letter_id,
+        defaults={"bank": settlement.bank, "order_id": settlement.payment.order_id}
+    )
+
+
+def producer_call(settlement):
+    return awinner(settlement.payment.order_id)
+
+
+def producer_save(settlement, result):
+    mask_amount, producer_key = result
+    producer = directory.get_by_key(producer_key)
+    if producer is None:
+        raise SettlementError("Producer of the winner offer not found.")
+
+    settlement.producer = producer
+    settlement.mask_amount = mask_amount
+
+
+def deal_call(settlement):
+    return required_write(
+        bc.acreate_deal(settlement.deal_id, settlement.producer.key, settlement.payment.price,
+                        settlement.letter_id, settlement.mask_amount),
+        "Blockchain request failed for deal."
+    )
+
+
+def deal_save(settlement, result):
+    models.Deal.objects.get_or_create(
+        id=settlement.deal_id,
+        defaults={"producer": settlement.producer, "letter_id": settlement.letter_id}
+    )
+
+
+def delivery_call(settlement):
+    return required_write(
+        bc.acreate_delivery(settlement.delivery_id, settlement.producer.key, "1"),
+        "Blockchain request failed for delivery."
+    )
+
+
+def delivery_save(settlement, result):
+    models.Delivery.objects.get_or_create(
+        id=settlement.delivery_id,
+        defaults={"producer": settlement.producer}
+    )
+
+
+PHASES = [
+    {"letter": (letter_call, letter_save), "producer": (producer_call, producer_save)},
+    {"deal": (deal_call, deal_save), "delivery": (delivery_call, delivery_save)},
+]
+
+
+async def acall_step(settlement, name, call, unsure):
+    """
+    Run the ledger call of a step. A write which may have been sent by an
+    earlier attempt is only sent again once its check tells it is not on the ledger.
+    :param settlement: Settlement
+    :param name: Name of the step.
+    :param call: Ledger call of the step.
+    :param unsure: Names of the steps whose write may be on the ledger.
+    :return: Result of the call.
+    """
+    if name in unsure:
+        if name not in STEP_CHECKS:
+            raise SettlementError("Outcome of an earlier {} write is unknown, it is not sent again.".format(name), True)
+
+        found = await STEP_CHECKS[name](settlement)
+        if found is None:
+            raise SettlementError("Outcome of an earlier {} write is unknown, the ledger could not be read.".format(name), True)
+        if found:
+            return True
+
+    return await call(settlement)
+
+
+async def arun_steps(calls):
+    """
+    :param calls: Ledger calls by step name.
+    :return: Results by step name, the exception for failed steps.
+    """
+    results = await asyncio.gather(*calls.values(), return_exceptions=True)
+    return dict(zip(calls, results))
+
+
+def acquire(settlements):
+    """
+    Lock a settlement to run it, unless another worker is running it.
+    :param settlements: Queryset of the settlement.
+    :return: Settlement, marked as running.
+    """
+    with transaction.atomic():
+        settlement = settlements.select_for_update().get()
+        if settlement.status == 'RUNNING' and settlement.attempts:
+            if settlement.updated_at > timezone.now() - LEASE:
+                raise SettlementBusy()
+
+            # Abandoned by a dead worker, which may have sent the writes of its last phase
+            done = json.loads(settlement.steps)
+            settlement.unsure_steps = json.dumps([name for name in WRITE_STEPS if name not in done])
+
+        settlement.status = 'RUNNING'
+        settlement.attempts += 1
+        settlement.save(update_fields=['status', 'attempts', 'unsure_steps', 'updated_at'])
+
+    return settlement
+
+
+def begin(bank, payment):
+    """
+    Take the unfinished settlement of a payment to resume it, or start a new one.
+    :param bank: Organization of the bank paying.
+    :param payment: Payment
+    :return: Settlement, marked as running. The completed one if the payment was settled already.
+    """
+    with transaction.atomic():
+        # Requests paying the same payment wait for each other here, so that it gets a single settlement
+        models.Payment.objects.select_for_update().get(pk=payment.pk)
+
+        settlement = models.Settlement.objects.filter(payment=payment).order_by('-created_at').first()
+        if settlement is None:
+            settlement = models.Settlement.objects.create(payment=payment, bank=bank)
+        elif settlement.status == 'COMPLETED':
+            return settlement
+        elif "letter" not in json.loads(settlement.steps):
+            # The letter is not on the ledger yet, any bank can still pay
+            settlement.bank = bank
+            settlement.save(update_fields=['bank', 'updated_at'])
+
+        return acquire(models.Settlement.objects.filter(id=settlement.id))
+
+
+def settle(settlement):
+    """
+    Run the steps of a settlement which did not complete yet. Progress is saved
+    after every phase, so a failed settlement resumes from where it stopped.
+    :param settlement: Settlement taken with begin or acquire.
+    :return: Settlement, completed or failed.
+    """
+    # Ledger calls run on the loop thread, so the rows they read are loaded here
+    settlement = models.Settlement.objects.select_related('payment', 'bank', 'producer').get(id=settlement.id)
+    done = json.loads(settlement.steps)
+    unsure = set(json.loads(settlement.unsure_steps))
+
+    for phase in PHASES:
+        steps = {name: step for name, step in phase.items() if name not in done}
+        results = bc.client.run(arun_steps({
+            name: acall_step(settlement, name, call, unsure) for name, (call, save) in steps.items()
+        }))
+
+        errors = []
+        for name, (call, save) in steps.items():
+            result = results[name]
+            if not isinstance(result, Exception):
+                try:
+                    save(settlement, result)
+                    done.append(name)
+                    unsure.discard(name)
+                    continue
+                except SettlementError as inst:
+                    result = inst
+
+            if isinstance(result, SettlementError):
+                if result.unsure:
+                    unsure.add(name)
+                else:
+                    unsure.discard(name)
+            errors.append(str(result) if isinstance(result, SettlementError) else repr(result))
+
+        settlement.steps = json.dumps(done)
+        settlement.unsure_steps = json.dumps(sorted(unsure))
+        if errors:
+            settlement.status = 'FAILED'
+            settlement.last_error = " ".join(errors)
+            settlement.save()
+            return settlement
+
+        settlement.save()
+
+    settlement.status = 'COMPLETED'
+    settlement.last_error = None
+    settlement.save()
+
+    mirror.refresh("payment_letter", [settlement.letter_id])
+    mirror.refresh("delivery", [settlement.delivery_id])
+    mirror.refresh("producer_masks", [settlement.producer.key])
+    return settlement
+
+
+def resumable():
+    """
+    :return: Ids of the failed or abandoned settlements which can be resumed.
+    """
+    return models.Settlement.objects.filter(
+        Q(status='FAILED') | Q(status='RUNNING', updated_at__lt=timezone.now() - LEASE),
+        attempts__lt=MAX_ATTEMPTS
+    ).order_by('created_at').values_list('id', flat=True)
@@ -0,0 +1,97 @@
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited JSON. Lists are streamed with ndjson_response, this
+    renders the responses which are not, like errors, as a single line.
+    """
+
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return (json.dumps(data, cls=JSONEncoder, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def wants_stream(request):
+    """
+    :param request: DRF request.
+    :return: True if the client asked for a stream with ?stream=1 or the NDJSON media type.
+    """
+    if request.query_params.get('stream') in ('1', 'true'):
+        return True
+    return getattr(request, 'accepted_renderer', None) is not None and request.accepted_renderer.format == 'ndjson'
+
+
+def ndjson_response(records, headers=None):
+    """
+    Stream records as newline delimited JSON, each one is sent as soon as it is produced.
+    :param records: Iterator of JSON serializable records.
+    :param headers: Response headers.
+    :return: StreamingHttpResponse
+    """
+    def lines():
+        for record in records:
+            yield (json.dumps(record, cls=JSONEncoder, ensure_ascii=False) + "\n").encode('utf-8')
+
+    response = StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+    for header, value in (headers or {}).items():
+        response[header] = value
+    return response
+
+
+def sse_message(data=None, event=None, event_id=None, retry=None, comment=None):
+    """
+    Format a server-sent event.
+    :param data: JSON serializable data of the event.
+    :param event: Name of the event.
+    :param event_id: Id of the event, sent back by the client in Last-Event-ID when it reconnects.
+    :param retry: Milliseconds the client waits before reconnecting.
+    :param comment: Comment, ignored by the client.
+    :return: Message as bytes.
+    """
+    lines = []
+    if comment is not None:
+        lines.append(": " + comment)
+    if retry is not None:
+        lines.append("retry: {}".format(retry))
+    if event is not None:
+        lines.append("event: " + event)
+    if event_id is not None:
+        lines.append("id: {}".format(event_id))
+    if data is not None:
+        lines.append("data: " + json.dumps(data, cls=JSONEncoder, ensure_ascii=False))
+    return ("\n".join(lines) + "\n\n").encode('utf-8')
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Server-sent events. Streams are sent with event_stream_response, this
+    renders the responses which are not, like errors, as an error event.
+    """
+
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return sse_message(data, event='error')
+
+
+def event_stream_response(messages):
+    """
+    Stream server-sent events, each one is sent as soon as it is produced.
+    :param messages: Iterator of messages from sse_message.
+    :return: StreamingHttpResponse
+    """
+    response = StreamingHttpResponse(messages, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keeps nginx from buffering the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -1,3 +1,828 @@
-from django.test import TestCase
+import asyncio, datetime, json, uuid
+from unittest import mock
 
-# Create your tests here.
+import httpx
+
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import models
+from . import blockchain as bc
+from . import events
+from . import journal
+from . import mirror
+from . import outbox
+from . import settlement
+from .directory import directory, invalidate_directory
+
+
+class PaymentListQueriesTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.producer = models.Organization(name='Producer', group='PRODUCER')
+        self.producer.save()
+        self.bank = models.Organization(name='Bank', group='BANK')
+        self.bank.save()
+
+    def add_payments(self, count):
+        orders = models.MinistryOrder.objects.bulk_create([models.MinistryOrder(id=uuid.uuid1()) for i in range(count)])
+        models.Payment.objects.bulk_create([
+            models.Payment(order=order, price=10, producer=self.producer) for order in orders
+        ])
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_payments(1)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/payments/')
+        self.assertEqual(len(response.json()['results']), 1)
+
+        self.add_payments(20)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/payments/')
+        self.assertEqual(len(response.json()['results']), 21)
+        self.assertEqual(response.json()['results'][0]['producerName'], 'Producer')
+
+    def test_pages_follow_creation_order(self):
+        self.add_payments(12)
+
+        ids = []
+        url = '/api/v1/payments/?page_size=5'
+        while url:
+            response = self.client.get(url)
+            self.assertLessEqual(len(response.json()['results']), 5)
+            ids += [payment['id'] for payment in response.json()['results']]
+            url = response.json()['next']
+
+        self.assertEqual(ids, sorted(models.Payment.objects.values_list('id', flat=True), reverse=True))
+
+    def test_unpaid_query_count(self):
+        self.add_payments(5)
+        models.PaymentLetter.objects.create(id=uuid.uuid1(), bank=self.bank, order=models.MinistryOrder.objects.first())
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/payments/?unpaid')
+        self.assertEqual(len(response.json()['results']), 4)
+
+
+class PaymentLetterListQueriesTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.producer = models.Organization(name='Producer', group='PRODUCER')
+        self.producer.save()
+        self.bank = models.Organization(name='Bank', group='BANK')
+        self.bank.save()
+
+    def add_letters(self, count):
+        # Letters are mirrored, so the view does not call the ledger
+        for i in range(count):
+            order = models.MinistryOrder.objects.create(id=uuid.uuid1())
+            letter = models.PaymentLetter.objects.create(id=uuid.uuid1(), bank=self.bank, order=order)
+            models.PaymentLetterMirror.objects.create(letter=letter, bank=self.bank.key, price=10, date='01/01/2020')
+            models.Payment.objects.create(order=order, price=10, producer=self.producer)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_letters(1)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/payment-letters/')
+        self.assertEqual(len(response.json()['results']), 1)
+
+        self.add_letters(20)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/payment-letters/')
+        self.assertEqual(len(response.json()['results']), 21)
+        self.assertEqual(response.json()['results'][0]['name'], 'Bank')
+
+    def test_producer_filter_query_count(self):
+        self.add_letters(5)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/v1/payment-letters/?producer={}'.format(self.producer.id))
+        self.assertEqual(len(response.json()['results']), 5)
+
+    def test_letters_without_bank_or_order(self):
+        self.add_letters(1)
+        models.PaymentLetter.objects.update(bank=None, order=None)
+
+        response = self.client.get('/api/v1/payment-letters/')
+        self.assertEqual([(letter['name'], letter['order']) for letter in response.json()['results']], [(None, None)])
+
+
+class HospitalOrderListQueriesTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.hospitals = []
+        for name in ('Hospital 1', 'Hospital 2'):
+            hospital = models.Organization(name=name, group='HOSPITAL')
+            hospital.save()
+            self.hospitals.append(hospital)
+        directory.entries()
+
+    def add_orders(self, hospital, count, status='0', date='2020-04-16 10:00'):
+        # Orders are mirrored, so the view does not call the ledger
+        for i in range(count):
+            order = models.HospitalOrder.objects.create(id=uuid.uuid1(), hospital=hospital)
+            models.HospitalOrderMirror.objects.create(order=order, amount=5, urgency=1, date=date, status=status)
+
+    def test_query_count_does_not_grow_with_orders(self):
+        self.add_orders(self.hospitals[0], 1)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/hospital-orders/')
+        self.assertEqual([len(hospital['orders']) for hospital in response.json()['results']], [1])
+
+        self.add_orders(self.hospitals[0], 5)
+        self.add_orders(self.hospitals[1], 5)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/hospital-orders/')
+        self.assertEqual([len(hospital['orders']) for hospital in response.json()['results']], [5, 6])
+
+    def test_pages_hold_orders(self):
+        self.add_orders(self.hospitals[0], 3)
+        self.add_orders(self.hospitals[1], 2)
+
+        response = self.client.get('/api/v1/hospital-orders/?page_size=3').json()
+        self.assertEqual([(hospital['id'], len(hospital['orders'])) for hospital in response['results']],
+                         [(self.hospitals[1].id, 2), (self.hospitals[0].id, 1)])
+
+        response = self.client.get(response['next']).json()
+        self.assertEqual([(hospital['id'], len(hospital['orders'])) for hospital in response['results']],
+                         [(self.hospitals[0].id, 2)])
+        self.assertIsNone(response['next'])
+
+    def test_filters(self):
+        self.add_orders(self.hospitals[0], 2, status='1', date='2020-04-10 10:00')
+        self.add_orders(self.hospitals[1], 3, status='0', date='2020-04-16 10:00')
+
+        response = self.client.get('/api/v1/hospital-orders/?status=1')
+        self.assertEqual([hospital['id'] for hospital in response.json()['results']], [self.hospitals[0].id])
+        self.assertEqual(len(response.json()['results'][0]['orders']), 2)
+
+        response = self.client.get('/api/v1/hospital-orders/?date_from=2020-04-16&date_to=2020-04-16')
+        self.assertEqual([hospital['id'] for hospital in response.json()['results']], [self.hospitals[1].id])
+        self.assertEqual(len(response.json()['results'][0]['orders']), 3)
+
+        response = self.client.get('/api/v1/hospital-orders/?hospital={}'.format(self.hospitals[1].id))
+        self.assertEqual([hospital['id'] for hospital in response.json()['results']], [self.hospitals[1].id])
+
+        response = self.client.get('/api/v1/hospital-orders/?date_from=yesterday')
+        self.assertEqual(response.status_code, 400)
+
+
+class PartialListTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.hospital = models.Organization.objects.create(name='Hospital', group='HOSPITAL')
+        self.producer = models.Organization.objects.create(name='Producer', group='PRODUCER')
+        directory.entries()
+
+        # Records which are not mirrored are looked up on the ledger, which fails
+        failed = lambda kind, ids: [bc.BatchResult(str(item_id), None, Exception("Timed out")) for item_id in ids]
+        self.get_many = mock.patch.object(bc, 'get_many', side_effect=failed)
+        self.get_many.start()
+        self.addCleanup(self.get_many.stop)
+
+    def assertPartial(self, response, partial):
+        self.assertEqual((response.json()["partial"], response.json()["degraded"]), (partial, False))
+        self.assertEqual(response['X-Ledger-Partial'], 'true' if partial else 'false')
+
+    def test_ministry_orders(self):
+        order = models.MinistryOrder.objects.create(id=uuid.uuid1())
+        models.MinistryOrderMirror.objects.create(order=order, amount=5, end_date='', open_date='', winner=None)
+        self.assertPartial(self.client.get('/api/v1/ministry-orders/'), False)
+
+        models.MinistryOrder.objects.create(id=uuid.uuid1())
+        response = self.client.get('/api/v1/ministry-orders/')
+        self.assertEqual(len(response.json()["results"]), 1)
+        self.assertPartial(response, True)
+
+    def test_hospital_orders(self):
+        order = models.HospitalOrder.objects.create(id=uuid.uuid1(), hospital=self.hospital)
+        models.HospitalOrderMirror.objects.create(order=order, amount=5, urgency=1, date='', status='0')
+        self.assertPartial(self.client.get('/api/v1/hospital-orders/'), False)
+
+        models.HospitalOrder.objects.create(id=uuid.uuid1(), hospital=self.hospital)
+        response = self.client.get('/api/v1/hospital-orders/')
+        self.assertEqual(len(response.json()["results"][0]["orders"]), 1)
+        self.assertPartial(response, True)
+
+    def test_deliveries(self):
+        delivery = models.Delivery.objects.create(id=uuid.uuid1(), producer=self.producer)
+        models.DeliveryMirror.objects.create(delivery=delivery, date='', status='1')
+        self.assertPartial(self.client.get('/api/v1/deliveries/'), False)
+
+        models.Delivery.objects.create(id=uuid.uuid1(), producer=self.producer)
+        response = self.client.get('/api/v1/deliveries/')
+        self.assertEqual(response.json()["results"][0], None)
+        self.assertPartial(response, True)
+
+
+@override_settings(STATUS_EVENTS_MAX=3, STATUS_EVENTS_STREAM_SECONDS=0, CURSOR_COMMIT_LAG=0)
+class StatusEventsTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def read_events(self, **headers):
+        response = self.client.get('/api/v1/events/?kind=delivery', **headers)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        messages = b''.join(response.streaming_content).decode().split('\n\n')
+        return [dict(line.split(': ', 1) for line in message.split('\n')) for message in messages if message.startswith('event')]
+
+    def test_resume_from_last_event_id(self):
+        delivery_id = uuid.uuid1()
+        first = events.publish('delivery', delivery_id, 1)
+        events.publish('hospital_order', uuid.uuid1(), 2)
+        last = events.publish('delivery', delivery_id, 3)
+
+        messages = self.read_events(HTTP_LAST_EVENT_ID=str(first.id))
+        self.assertEqual([message['id'] for message in messages], [str(last.id)])
+        self.assertEqual(json.loads(messages[0]['data'])['status'], '3')
+
+        self.assertEqual(self.read_events(), [])
+
+    def test_dropped_events_reset_the_client(self):
+        first = events.publish('delivery', uuid.uuid1(), 1)
+        for i in range(4):
+            last = events.publish('delivery', uuid.uuid1(), 1)
+        self.assertEqual(models.StatusEvent.objects.count(), 3)
+
+        messages = self.read_events(HTTP_LAST_EVENT_ID=str(first.id))
+        self.assertEqual([(message['event'], message['id']) for message in messages], [('reset', str(last.id))])
+
+    @override_settings(CURSOR_COMMIT_LAG=5)
+    def test_ids_are_held_back_behind_recent_events(self):
+        first = events.publish('delivery', uuid.uuid1(), 1)
+        models.StatusEvent.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=1))
+        events.publish('delivery', uuid.uuid1(), 2)
+
+        # The recent event is sent, but a client resuming from its id could miss events still being committed
+        messages = self.read_events(HTTP_LAST_EVENT_ID=str(first.id - 1))
+        self.assertEqual([(json.loads(message['data'])['status'], message['id']) for message in messages],
+                         [('1', str(first.id)), ('2', str(first.id))])
+
+        # New clients do not get the recent events published before they connected
+        self.assertEqual(self.read_events(), [])
+
+
+@override_settings(CURSOR_COMMIT_LAG=0)
+class DeltaSyncTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.hospital = models.Organization(name='Hospital', group='HOSPITAL')
+        self.hospital.save()
+
+    def add_order(self, status='0'):
+        order = models.HospitalOrder.objects.create(id=uuid.uuid1(), hospital=self.hospital)
+        self.store(order, status)
+        return order
+
+    def store(self, order, status):
+        # Same as a mirror refresh after a ledger write
+        mirror.MIRRORS['hospital_order'].store({
+            str(order.id): {"id": str(order.id), "amount": 5, "urgency": 1, "date": "2020-04-16 10:00", "status": status}
+        })
+
+    def test_changes_since_cursor(self):
+        unchanged = self.add_order()
+        updated = self.add_order()
+        deleted = self.add_order()
+
+        cursor = self.client.get('/api/v1/hospital-orders/')['X-Sync-Cursor']
+        self.store(unchanged, '0')
+        self.store(updated, '1')
+        deleted_id = str(deleted.id)
+        deleted.delete()
+        created = self.add_order()
+
+        response = self.client.get('/api/v1/hospital-orders/?since={}'.format(cursor)).json()
+        self.assertEqual([order['id'] for order in response['results']], [str(updated.id), str(created.id)])
+        self.assertEqual(response['results'][0]['hospital']['id'], self.hospital.id)
+        self.assertEqual(response['deleted'], [deleted_id])
+
+        response = self.client.get('/api/v1/hospital-orders/?since={}'.format(response['cursor'])).json()
+        self.assertEqual((response['results'], response['deleted'], response['more']), ([], [], False))
+
+    def test_records_leaving_the_filter_are_deleted(self):
+        order = self.add_order(status='0')
+        cursor = self.client.get('/api/v1/hospital-orders/?status=0')['X-Sync-Cursor']
+        self.store(order, '1')
+
+        response = self.client.get('/api/v1/hospital-orders/?status=0&since={}'.format(cursor)).json()
+        self.assertEqual((response['results'], response['deleted']), ([], [str(order.id)]))
+
+    @override_settings(CURSOR_COMMIT_LAG=5)
+    def test_cursor_is_held_back_behind_recent_changes(self):
+        old = self.add_order()
+        models.JournalEntry.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=1))
+        recent = self.add_order()
+
+        # The change of the recent order may follow changes of transactions still running
+        cursor = self.client.get('/api/v1/hospital-orders/')['X-Sync-Cursor']
+        self.assertEqual(int(cursor), models.JournalEntry.objects.get(record_id=str(old.id)).id)
+
+        response = self.client.get('/api/v1/hospital-orders/?since={}'.format(cursor)).json()
+        self.assertEqual((response['results'], response['cursor']), ([], int(cursor)))
+
+        models.JournalEntry.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=1))
+        response = self.client.get('/api/v1/hospital-orders/?since={}'.format(cursor)).json()
+        self.assertEqual([order['id'] for order in response['results']], [str(recent.id)])
+
+    @override_settings(CHANGE_JOURNAL_MAX=2)
+    def test_expired_cursor(self):
+        for i in range(4):
+            self.add_order()
+
+        response = self.client.get('/api/v1/hospital-orders/?since=0')
+        self.assertEqual(response.status_code, 410)
+
+
+class MirrorUpsertTest(TestCase):
+    def test_existing_rows_are_updated(self):
+        hospital = models.Organization.objects.create(name='Hospital', group='HOSPITAL')
+        orders = [models.HospitalOrder.objects.create(id=uuid.uuid1(), hospital=hospital) for i in range(2)]
+
+        def row(order, status):
+            return models.HospitalOrderMirror(order=order, amount=5, urgency=1, date="2020-04-16 10:00", status=status)
+
+        models.HospitalOrderMirror.objects.upsert([row(orders[0], '0')])
+        models.HospitalOrderMirror.objects.upsert([row(orders[0], '1'), row(orders[1], '0')])
+
+        self.assertEqual(
+            dict(models.HospitalOrderMirror.objects.values_list('order_id', 'status')),
+            {orders[0].id: '1', orders[1].id: '0'}
+        )
+
+
+class BatchQueryTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.producer = models.Organization(name='Producer', group='PRODUCER')
+        self.producer.save()
+        directory.entries()
+
+        # Records are mirrored, so the queries do not call the ledger
+        self.order = models.MinistryOrder.objects.create(id=uuid.uuid1())
+        models.MinistryOrderMirror.objects.create(order=self.order, amount=5, end_date='', open_date='', winner=None)
+        for i in range(3):
+            offer = models.ProducerOffer.objects.create(id=uuid.uuid1(), producer=self.producer, order=self.order)
+            models.ProducerOfferMirror.objects.create(offer=offer, producer=self.producer.key, order=str(self.order.id),
+                                                      price='10', status='0', date='')
+            delivery = models.Delivery.objects.create(id=uuid.uuid1(), producer=self.producer)
+            models.DeliveryMirror.objects.create(delivery=delivery, date='', status='1')
+        models.ProducerStockMirror.objects.create(producer=self.producer, amount=7)
+
+    def post(self, batch):
+        return self.client.post('/api/v1/queries/', {"queries": batch}).json()["results"]
+
+    def test_lookups_are_shared_by_queries(self):
+        dashboard = [
+            {"query": "offers", "params": {"producer": self.producer.id, "orders": True}},
+            {"query": "deliveries", "params": {"producer": self.producer.id}},
+            {"query": "producer_masks", "params": {"producer": self.producer.id}},
+        ]
+
+        # Offers, deliveries and stock in a first round, their mirrors in a second, the ministry order last
+        with self.assertNumQueries(6):
+            results = self.post(dashboard)
+        self.assertEqual(len(results[0]["data"]), 3)
+        self.assertEqual(results[0]["data"][0]["ministryOrder"]["amount"], 5)
+        self.assertEqual(len(results[1]["data"]), 3)
+        self.assertEqual(results[2]["data"]["masks"], 7)
+
+        with self.assertNumQueries(6):
+            results = self.post(dashboard + dashboard)
+        self.assertEqual(results[3:], results[:3])
+
+    def test_deals_come_with_the_delivery_of_their_settlement(self):
+        bank = models.Organization.objects.create(name='Bank', group='BANK')
+        letter = models.PaymentLetter.objects.create(id=uuid.uuid1(), bank=bank, order=self.order)
+        payment = models.Payment.objects.create(order=self.order, price=10, producer=self.producer)
+        settlement = models.Settlement.objects.create(payment=payment, bank=bank, producer=self.producer)
+        models.Deal.objects.create(id=settlement.deal_id, producer=self.producer, letter=letter)
+        delivery = models.Delivery.objects.create(id=settlement.delivery_id, producer=self.producer)
+        models.DeliveryMirror.objects.create(delivery=delivery, date='', status='2')
+
+        results = self.post([{"query": "deals", "params": {"producer": self.producer.id}}])
+        self.assertEqual(results[0]["data"], [
+            {"deal": str(settlement.deal_id), "delivery": {"id": str(delivery.id), "date": "", "status": "2"}}
+        ])
+
+    def test_invalid_queries(self):
+        results = self.post([
+            {"query": "unknown"},
+            {"query": "deliveries", "params": {"producer": 0}},
+            {"query": "producer_masks", "params": {"producer": self.producer.id}},
+        ])
+        self.assertEqual([sorted(result) for result in results], [["error"], ["error"], ["data"]])
+
+        response = self.client.post('/api/v1/queries/', {"queries": "offers"})
+        self.assertEqual(response.status_code, 400)
+
+
+class HospitalOrderBulkTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.hospital = models.Organization(name='Hospital', group='HOSPITAL')
+        self.hospital.save()
+        self.producer = models.Organization(name='Producer', group='PRODUCER')
+        self.producer.save()
+
+    def post(self, orders):
+        return self.client.post('/api/v1/hospital-orders/bulk', {"orders": orders})
+
+    def test_invalid_batch_is_not_written(self):
+        response = self.post([
+            {"hospital": self.hospital.id, "masks": 10, "urgency": 1},
+            {"hospital": self.producer.id, "masks": 10, "urgency": 1},
+            {"hospital": self.hospital.id, "masks": "many", "urgency": 1},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.json()['errors']], [1, 2])
+        self.assertFalse(models.LedgerTransaction.objects.exists())
+
+    def test_orders_of_committed_writes_are_created(self):
+        # Orders of 20 masks fail on the ledger
+        async def make_hospital_order(mask_amount, **kwargs):
+            return mask_amount != 20
+
+        writes = {"make_hospital_order": make_hospital_order}
+
+        with mock.patch.dict(outbox.WRITE_FUNCTIONS, writes), mock.patch.object(mirror, 'refresh'):
+            response = self.post([
+                {"hospital": self.hospital.id, "masks": masks, "urgency": 1} for masks in (10, 20, 30)
+            ])
+
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['COMMITTED', 'PENDING', 'COMMITTED'])
+        self.assertEqual(
+            set(str(pk) for pk in models.HospitalOrder.objects.values_list('id', flat=True)),
+            {results[0]['order'], results[2]['order']}
+        )
+        # The failed write is retried by the transaction worker
+        self.assertEqual(models.LedgerTransaction.objects.get(id=results[1]['transaction']).status, 'PENDING')
+
+    def test_writes_past_the_sync_limit_are_left_to_the_worker(self):
+        make_hospital_order = mock.AsyncMock(return_value=True)
+
+        with mock.patch.dict(outbox.WRITE_FUNCTIONS, {"make_hospital_order": make_hospital_order}), \
+                mock.patch.object(mirror, 'refresh'), mock.patch('api.views.BULK_SYNC_ITEMS', 2):
+            response = self.post([
+                {"hospital": self.hospital.id, "masks": masks, "urgency": 1} for masks in (10, 20, 30)
+            ])
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual([result['status'] for result in response.json()['results']], ['COMMITTED', 'COMMITTED', 'PENDING'])
+        self.assertEqual(make_hospital_order.call_count, 2)
+        self.assertEqual(outbox.claim(10)[0].id, uuid.UUID(response.json()['results'][2]['transaction']))
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        self.refresh = mock.patch.object(mirror, 'refresh')
+        self.refresh.start()
+        self.addCleanup(self.refresh.stop)
+
+    def enqueue(self, function="update_mask", **fields):
+        args = {"producer_id": "Co1", "mask_amount": 10}
+        if function == "make_hospital_order":
+            args = {"order_id": str(uuid.uuid1()), "mask_amount": 10, "hospital_id": "Ho1", "urgency": 1}
+
+        ledger_transaction = outbox.enqueue(function, args)
+        if fields:
+            models.LedgerTransaction.objects.filter(id=ledger_transaction.id).update(**fields)
+        return ledger_transaction
+
+    def process(self, post):
+        # Ledger requests end up in post, as sent by the gateway client
+        with mock.patch.object(bc, 'breaker', bc.CircuitBreaker(failure_threshold=100)), \
+                mock.patch.object(bc.client, 'post', post), \
+                mock.patch.object(bc.enrollment, 'ensure', mock.AsyncMock(return_value=0)), \
+                mock.patch.object(bc, 'logger'):
+            return outbox.process()
+
+    def test_claim_takes_due_transactions(self):
+        now = timezone.now()
+        due = self.enqueue()
+        self.enqueue(next_attempt_at=now + datetime.timedelta(minutes=1))
+        self.enqueue(status='RUNNING')
+        abandoned = self.enqueue(status='RUNNING', updated_at=now - outbox.LEASE - datetime.timedelta(seconds=1))
+        self.enqueue(status='UNKNOWN')
+        unknown = self.enqueue("make_hospital_order", status='UNKNOWN', attempts=1)
+
+        claimed = {ledger_transaction.id: ledger_transaction for ledger_transaction in outbox.claim(10)}
+
+        self.assertEqual(set(claimed), {due.id, abandoned.id, unknown.id})
+        self.assertEqual([claimed[due.id].check_first, claimed[abandoned.id].check_first, claimed[unknown.id].check_first],
+                         [False, True, True])
+        self.assertEqual(claimed[unknown.id].attempts, 2)
+        self.assertEqual(outbox.claim(10), [])
+
+    def test_undelivered_write_is_retried(self):
+        ledger_transaction = self.enqueue()
+        self.process(mock.AsyncMock(side_effect=httpx.ConnectError("Connection refused")))
+
+        ledger_transaction.refresh_from_db()
+        self.assertEqual((ledger_transaction.status, ledger_transaction.attempts), ('PENDING', 1))
+        self.assertGreater(ledger_transaction.next_attempt_at, timezone.now())
+
+        # Given up once MAX_ATTEMPTS are used
+        models.LedgerTransaction.objects.filter(id=ledger_transaction.id).update(
+            attempts=outbox.MAX_ATTEMPTS - 1, next_attempt_at=timezone.now()
+        )
+        self.process(mock.AsyncMock(side_effect=httpx.ConnectError("Connection refused")))
+        ledger_transaction.refresh_from_db()
+        self.assertEqual(ledger_transaction.status, 'FAILED')
+
+    def test_write_with_lost_response_is_not_sent_again(self):
+        post = mock.AsyncMock(side_effect=httpx.ReadTimeout("Timed out"))
+        ledger_transaction = self.enqueue()
+        self.process(post)
+
+        ledger_transaction.refresh_from_db()
+        self.assertEqual(ledger_transaction.status, 'UNKNOWN')
+
+        # Masks are added to the stock, there is no telling whether they were
+        models.LedgerTransaction.objects.filter(id=ledger_transaction.id).update(next_attempt_at=timezone.now())
+        self.assertEqual(self.process(post), 0)
+        self.assertEqual(post.call_count, 1)
+
+    def test_write_with_lost_response_is_checked_before_sending_again(self):
+        post = mock.AsyncMock(side_effect=httpx.ReadTimeout("Timed out"))
+        ledger_transaction = self.enqueue("make_hospital_order")
+        self.process(post)
+        models.LedgerTransaction.objects.filter(id=ledger_transaction.id).update(next_attempt_at=timezone.now())
+
+        order = {"id": json.loads(ledger_transaction.args)["order_id"], "amount": 10, "urgency": 1, "date": "", "status": "0"}
+        with mock.patch.object(bc, 'aget_hospital_order_info', mock.AsyncMock(return_value=order)):
+            self.process(post)
+
+        ledger_transaction.refresh_from_db()
+        self.assertEqual((ledger_transaction.status, ledger_transaction.attempts), ('COMMITTED', 2))
+        self.assertEqual(post.call_count, 1)
+
+    @mock.patch.object(outbox, 'LEASE', datetime.timedelta(seconds=0.3))
+    def test_lease_is_renewed_while_writes_run(self):
+        async def slow_write(**kwargs):
+            await asyncio.sleep(0.7)
+            return True
+
+        ledger_transaction = self.enqueue()
+        claimed_meanwhile = []
+
+        def renew(ledger_transactions):
+            renew_lease(ledger_transactions)
+            claimed_meanwhile.extend(outbox.claim(10))
+
+        renew_lease = outbox.renew
+        with mock.patch.dict(outbox.WRITE_FUNCTIONS, {"update_mask": slow_write}), \
+                mock.patch.object(outbox, 'renew', side_effect=renew) as renewed:
+            outbox.process()
+
+        self.assertTrue(renewed.called)
+        self.assertEqual(claimed_meanwhile, [])
+        ledger_transaction.refresh_from_db()
+        self.assertEqual((ledger_transaction.status, ledger_transaction.attempts), ('COMMITTED', 1))
+
+
+class SettlementTest(TestCase):
+    def setUp(self):
+        self.refresh = mock.patch.object(mirror, 'refresh')
+        self.refresh.start()
+        self.addCleanup(self.refresh.stop)
+
+        self.bank = models.Organization.objects.create(name='Bank', group='BANK', key='Ba1')
+        self.producer = models.Organization.objects.create(name='Producer', group='PRODUCER', key='Co1')
+        directory.entries()
+        order = models.MinistryOrder.objects.create(id=uuid.uuid1())
+        self.payment = models.Payment.objects.create(order=order, price=10, producer=self.producer)
+
+    def settle(self, payment_settlement, **writes):
+        # Ledger writes answer True unless given, reads find the winner offer of the order
+        calls = {name: mock.AsyncMock(return_value=True) for name in ("acreate_payment_letter", "acreate_deal", "acreate_delivery")}
+        calls.update(writes)
+        calls["aget_ministry_order_info"] = mock.AsyncMock(return_value={"winner": "Of1", "amount": "10"})
+        calls["aget_producer_offer_info"] = mock.AsyncMock(return_value={"producer": self.producer.key})
+        with mock.patch.multiple(bc, **calls):
+            return settlement.settle(payment_settlement), calls
+
+    def test_payment_is_settled_once(self):
+        completed = models.Settlement.objects.create(payment=self.payment, bank=self.bank, status='COMPLETED', attempts=1)
+
+        self.assertEqual(settlement.begin(self.bank, self.payment), completed)
+        self.assertEqual(models.Settlement.objects.filter(payment=self.payment).count(), 1)
+
+    def test_written_letter_is_checked_before_sending_again(self):
+        payment_settlement = models.Settlement.objects.create(payment=self.payment, bank=self.bank, status='FAILED',
+                                                              attempts=1, unsure_steps='["letter"]')
+        payment_settlement = settlement.begin(self.bank, self.payment)
+
+        letter = {"id": str(payment_settlement.letter_id), "bank": self.bank.key, "amount": "10"}
+        with mock.patch.object(bc, 'aget_payment_letter_info', mock.AsyncMock(return_value=letter)):
+            payment_settlement, calls = self.settle(payment_settlement)
+
+        self.assertEqual(payment_settlement.status, 'COMPLETED')
+        self.assertFalse(calls["acreate_payment_letter"].called)
+        self.assertEqual(json.loads(payment_settlement.unsure_steps), [])
+
+    def test_deal_with_unknown_outcome_is_not_sent_again(self):
+        # Abandoned by a worker during the deal and delivery phase
+        models.Settlement.objects.create(payment=self.payment, bank=self.bank, producer=self.producer, mask_amount=10,
+                                         steps='["letter", "producer"]', attempts=1)
+        models.Settlement.objects.update(updated_at=timezone.now() - settlement.LEASE - datetime.timedelta(seconds=1))
+
+        payment_settlement = settlement.begin(self.bank, self.payment)
+        self.assertEqual(json.loads(payment_settlement.unsure_steps), ["deal", "delivery"])
+
+        # The delivery is not on the ledger, the gateway answers without it
+        with mock.patch.object(bc, 'aget_delivery_info', mock.AsyncMock(side_effect=KeyError("delivery"))):
+            payment_settlement, calls = self.settle(payment_settlement)
+
+        self.assertEqual(payment_settlement.status, 'FAILED')
+        self.assertFalse(calls["acreate_deal"].called)
+        self.assertTrue(calls["acreate_delivery"].called)
+        self.assertEqual(json.loads(payment_settlement.unsure_steps), ["deal"])
+
+
+class CacheSyncTest(TestCase):
+    def setUp(self):
+        self.addCleanup(bc.cache.clear)
+        self.cache_sync = journal.CacheSync(check_interval=0)
+
+    def cache(self, producer_key, amount):
+        bc.cache.set("getProducerInfo", {"coID": producer_key}, {"amount": amount}, bc.cache.version)
+
+    def cached(self, producer_key):
+        return bc.cache.get("getProducerInfo", {"coID": producer_key})
+
+    def test_reads_changed_elsewhere_are_dropped(self):
+        self.cache_sync.run()
+        self.assertIsNone(self.cache_sync.cursor)
+
+        # Reads cached before the first sync may be stale already
+        self.cache("Co1", "5")
+        self.cache_sync.run()
+        self.assertIsNone(self.cached("Co1"))
+
+        self.cache("Co1", "5")
+        self.cache("Co2", "5")
+        journal.record("producer_masks", ["Co1"])
+        self.cache_sync.run()
+
+        self.assertIsNone(self.cached("Co1"))
+        self.assertEqual(self.cached("Co2"), {"amount": "5"})
+
+        # Recent changes are kept after the cursor, but dropped once only
+        self.cache("Co1", "6")
+        self.cache_sync.run()
+        self.assertEqual(self.cached("Co1"), {"amount": "6"})
+        self.assertEqual(self.cache_sync.cursor, 0)
+
+    def test_journal_is_not_read_on_every_request(self):
+        cache_sync = journal.CacheSync(check_interval=60)
+
+        # Nothing cached, nothing to drop
+        with self.assertNumQueries(0):
+            self.cache_sync.run()
+
+        self.cache("Co1", "5")
+        with self.assertNumQueries(1):
+            cache_sync.run()
+        with self.assertNumQueries(0):
+            cache_sync.run()
+
+
+class DirectoryTest(TestCase):
+    def test_organizations_created_elsewhere_are_found(self):
+        directory.entries()
+
+        # Same as a save by another worker, which this one is not told about
+        post_save.disconnect(invalidate_directory, sender=models.Organization)
+        try:
+            producer = models.Organization.objects.create(name='Producer', group='PRODUCER')
+        finally:
+            post_save.connect(invalidate_directory, sender=models.Organization)
+
+        self.assertEqual(directory.get(producer.id), producer)
+        self.assertEqual(directory.get_by_key(producer.key), producer)
+        self.assertEqual(directory.data(producer.id)['name'], 'Producer')
+        self.assertIsNone(directory.get(producer.id + 1))
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(bc.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = bc.CircuitBreaker(failure_threshold=3, cooldown=30, half_open_calls=1)
+
+    def fail(self, count):
+        for i in range(count):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.CLOSED)
+
+        self.fail(1)
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_after_cooldown(self):
+        self.fail(3)
+        self.now += 30
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.HALF_OPEN)
+
+        # A single trial call at a time
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.CLOSED)
+
+    def test_failed_trial_opens_again(self):
+        self.fail(3)
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.OPEN)
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+
+    def test_released_trial_is_given_back(self):
+        self.fail(3)
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.release()
+
+        self.assertEqual(self.breaker.state, bc.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+
+
+class CancelledRequestTest(SimpleTestCase):
+    def test_cancelled_request_is_not_a_failure(self):
+        breaker = bc.CircuitBreaker(failure_threshold=1)
+
+        async def post(path, json):
+            await asyncio.sleep(60)
+
+        async def cancel_request():
+            task = asyncio.ensure_future(bc.send_request("getDeliveryInfo", {"args": {"delID": "d"}}))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(bc, 'breaker', breaker), mock.patch.object(bc.client, 'post', post), \
+                mock.patch.object(bc.enrollment, 'ensure', mock.AsyncMock(return_value=0)):
+            asyncio.new_event_loop().run_until_complete(cancel_request())
+
+        self.assertEqual(breaker.state, bc.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+
+class DeadlineTest(SimpleTestCase):
+    def post(self, path):
+        async def post(path, json):
+            await asyncio.sleep(0.05)
+            return "response"
+
+        async def run():
+            bc.set_deadline(0.01)
+            return await bc.post_within_deadline(path, {"args": {}})
+
+        with mock.patch.object(bc.client, 'post', post):
+            return asyncio.new_event_loop().run_until_complete(run())
+
+    def test_reads_are_given_up_at_the_deadline(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            self.post("getProducerInfo")
+
+    def test_writes_are_waited_for(self):
+        self.assertEqual(self.post("updateMask"), "response")
+
+
+class SingleFlightTest(SimpleTestCase):
+    def test_followers_outlive_a_cancelled_leader(self):
+        single_flight = bc.SingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"status": "1"}
+
+        async def run():
+            leader = asyncio.ensure_future(single_flight.do("key", lookup))
+            await asyncio.sleep(0.01)
+            follower = asyncio.ensure_future(single_flight.do("key", lookup))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.new_event_loop().run_until_complete(run()), {"status": "1"})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(single_flight.shared, 1)
@@ -10,6 +10,9 @@ urlpatterns = [
     path('token-auth', obtain_jwt_token),
     path('token-refresh', refresh_jwt_token),
 
+    # Monitoring
+    path('metrics', views.metrics, name='metrics'),
+
     # Views
     path('organizations/<organization_id>', views.OrganizationDetail.as_view(), name='organization_detail'),
     path('organizations', views.OrganizationList.as_view(), name='organization_list'),
@@ -18,22 +21,29 @@ urlpatterns = [
 
     # API function based views
     path('ministry-masks/', views.get_ministry_mask_amount),
+    path('producer-masks/bulk', views.ProducerMaskBulk.as_view()),
     path('producer-masks/<producer_id>', views.ProducerMaskDetail.as_view()),
     path('producer-masks/', views.get_all_producer_mask_amount),
 
     path('ministry-orders/', views.MinistryOrder.as_view()),
-    path('ministry-orders/<order_id>', views.get_single_ministry_order),
+    path('ministry-orders/<uuid:order_id>', views.get_single_ministry_order),
 
+    path('hospital-orders/bulk', views.HospitalOrderBulk.as_view()),
     path('hospital-orders/<hospital_id>', views.HospitalOrderDetail.as_view()),
     path('hospital-orders/', views.HospitalOrderList.as_view()),
 
     path('payment-letters/', views.PaymentLetterList.as_view()),
 
-    path('offers/<offer_id>', views.ProducerOfferDetail.as_view()),
+    path('offers/<uuid:offer_id>', views.ProducerOfferDetail.as_view()),
     path('offers/', views.ProducerOfferList.as_view()),
 
     path('payments/', views.PaymentList.as_view()),
 
     path('deals/', views.DealList.as_view()),
     path('deliveries/', views.DeliveryList.as_view()),
+
+    path('queries/', views.BatchQuery.as_view(), name='batch_query'),
+    path('events/', views.StatusEventList.as_view(), name='status_events'),
+
+    path('transactions/<uuid:transaction_id>', views.TransactionDetail.as_view(), name='transaction_detail'),
 ]
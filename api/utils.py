@@ -5,12 +5,12 @@ from datetime import datetime
 from rest_framework_jwt.compat import get_username, get_username_field
 from rest_framework_jwt.settings import api_settings
 
-from .serializers import OrganizationSerializer
+from .directory import directory
 
 
 def jwt_payload_handler(user):
     username = get_username(user)
-    organization = OrganizationSerializer(user.organization).data
+    organization = directory.data(user.organization_id)
 
     payload = {
         'id': user.pk, 'username': username,
@@ -1,13 +1,233 @@
-import uuid, datetime
+import uuid, datetime, itertools
+from django.db.models import Exists, OuterRef, Q
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from rest_framework import status
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 from rest_framework.views import Response, APIView
 from rest_framework.decorators import api_view
+from rest_framework.settings import api_settings
 
-from .serializers import OrganizationSerializer, OrganizationUserSerializer, PaymentSerializer
+from .serializers import OrganizationSerializer, OrganizationUserSerializer, PaymentSerializer, LedgerTransactionSerializer
 from . import models
 from . import blockchain as bc
+from . import mirror
+from . import outbox
+from . import settlement
+from . import events
+from . import journal
+from . import queries
+from .dataloader import DataLoader, QueryError
+from .directory import directory, as_id, get_or_404 as get_organization_or_404
+from .metrics import render as render_metrics
+from .pagination import CreationCursorPagination
+from .streaming import NDJSONRenderer, EventStreamRenderer, ndjson_response, event_stream_response, wants_stream
+
+def parse_id(value):
+    """
+    Parse the blockchain id of a record sent by the client.
+    :param value: Id from the request.
+    :return: UUID, None if it is not one.
+    """
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def ledger_response(data, missing=None, **kwargs):
+    """
+    Response of a view reading records from the ledger. While the gateway is
+    failing, records may be missing or stale, which is flagged in the
+    X-Ledger-Degraded header. Records which could not be read from the
+    ledger, as when the time budget of the request ran out, are left out or
+    None, which is flagged in the X-Ledger-Partial header.
+    :param data: Response data.
+    :param missing: Number of records left out or None, whether the time budget ran out when not counted.
+    :return: Response
+    """
+    partial = bc.deadline_passed() if missing is None else missing > 0
+
+    response = Response(data, **kwargs)
+    response['X-Ledger-Degraded'] = 'true' if bc.breaker.is_open else 'false'
+    response['X-Ledger-Partial'] = 'true' if partial else 'false'
+    return response
+
+
+def paginate(request, queryset, ordering=None):
+    """
+    Take the requested page of a list, so that ledger records are only looked
+    up for the rows on the page.
+    :param request:
+    :param queryset: Rows of the list.
+    :param ordering: Ordering of the pages, creation order newest first by default.
+    :return: Paginator, and the rows on the page.
+    """
+    paginator = CreationCursorPagination(ordering)
+    return paginator, paginator.paginate_queryset(queryset, request)
+
+
+def ledger_page_response(paginator, results, cursor=None, missing=0):
+    """
+    Same as ledger_response, for a page of a list. The flags are in the body
+    as well, as partial and degraded.
+    :param paginator: Paginator returned by paginate.
+    :param results: Records on the page.
+    :param cursor: Journal cursor taken before reading the list, sent in the X-Sync-Cursor header.
+    :param missing: Number of records of the page left out or None, as they could not be read from the ledger.
+    :return: Response with the next and previous page URLs.
+    """
+    data = paginator.get_paginated_response(results).data
+    data["partial"] = missing > 0
+    data["degraded"] = bc.breaker.is_open
+
+    response = ledger_response(data, missing)
+    if cursor is not None:
+        response['X-Sync-Cursor'] = cursor
+    return response
+
+
+def delta_response(request, kind, rows, to_record=None):
+    """
+    Changes of a list after the journal cursor given with ?since=, in place
+    of the whole list. Records created or updated after the cursor are in
+    results, the ones deleted or no longer in the list are in deleted. Records
+    which could not be looked up on the ledger are in neither, a later sync
+    returns them. Clients sync from the returned cursor next, right away when
+    more is set.
+    :param request:
+    :param kind: One of the keys of mirror.MIRRORS.
+    :param rows: Queryset of the list, keyed by blockchain id, with its filters.
+    :param to_record: Function turning a row and its ledger record into the listed record, None if it is not listed.
+    :return: Response, 410 when the changes after the cursor were dropped and the list has to be reloaded.
+    """
+    try:
+        cursor = int(request.query_params['since'])
+    except ValueError:
+        return Response({"error": "Invalid cursor"}, status=status.HTTP_400_BAD_REQUEST)
+
+    if journal.expired(cursor):
+        return Response({"error": "Cursor expired, reload the list."}, status=status.HTTP_410_GONE)
+
+    ids, cursor, more = journal.changes(kind, cursor)
+    rows = {str(row.pk): row for row in rows.filter(pk__in=ids)}
+
+    results = []
+    missing = 0
+    deleted = [item_id for item_id in ids if item_id not in rows]
+    for bc_result in mirror.get_many(kind, list(rows), verify='verify' in request.query_params):
+        if bc_result.value is None:
+            missing += 1
+            continue
+
+        record = bc_result.value if to_record is None else to_record(rows[bc_result.id], bc_result.value)
+        if record is None:
+            deleted.append(bc_result.id)
+        else:
+            results.append(record)
+
+    return ledger_response({"cursor": cursor, "more": more, "results": results, "deleted": deleted}, missing)
+
+
+def stream_ledger_records(kind, rows, verify=False, to_record=None, chunk_size=100):
+    """
+    Ledger records of the rows of a list, as soon as each lookup completes.
+    Rows are read from the database in chunks, so memory does not grow with
+    the list. Records missing on the ledger are skipped.
+    :param kind: One of the keys of mirror.MIRRORS.
+    :param rows: Queryset of the rows, keyed by their blockchain id.
+    :param verify: Fetch every record from the ledger.
+    :param to_record: Function turning a row and its ledger record into the streamed record, None to skip it.
+    :param chunk_size: Number of rows looked up at once.
+    :return: Iterator of records.
+    """
+    rows = rows.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = {str(row.pk): row for row in itertools.islice(rows, chunk_size)}
+        if not chunk:
+            return
+
+        for bc_result in mirror.iter_many(kind, list(chunk), verify=verify):
+            if bc_result.value is None:
+                continue
+
+            record = bc_result.value if to_record is None else to_record(chunk[bc_result.id], bc_result.value)
+            if record is not None:
+                yield record
+
+
+def ledger_stream_response(records):
+    """
+    Same as ledger_response, streaming the records as newline delimited JSON.
+    The stream outlives the request, so its ledger calls are not bound by the
+    request deadline and X-Ledger-Partial is not set.
+    :param records: Iterator of records.
+    :return: StreamingHttpResponse
+    """
+    return ndjson_response(records, headers={'X-Ledger-Degraded': 'true' if bc.breaker.is_open else 'false'})
+
+
+def transaction_response(data, ledger_transaction):
+    """
+    Response of a view queueing a ledger write. The write is submitted by the
+    transaction worker, its status can be followed at the Location URL.
+    :param data: Response data, the transaction id is added to it.
+    :param ledger_transaction: Queued LedgerTransaction.
+    :return: Response
+    """
+    data["transaction"] = ledger_transaction.id
+    response = Response(data, status=status.HTTP_202_ACCEPTED)
+    response['Location'] = reverse('transaction_detail', args=[ledger_transaction.id])
+    return response
+
+
+# Max number of items of a bulk write.
+BULK_MAX_ITEMS = 500
+
+# Max number of writes of a bulk write submitted within the request, the others are sent by the transaction worker.
+BULK_SYNC_ITEMS = 20
+
+
+def bulk_items(request, name):
+    """
+    :param request:
+    :param name: Key of the list of items in the request body.
+    :return: Items of a bulk write, None if there is no list of 1 to BULK_MAX_ITEMS objects.
+    """
+    items = request.data.get(name) if isinstance(request.data, dict) else None
+    if not isinstance(items, list) or not 0 < len(items) <= BULK_MAX_ITEMS:
+        return None
+    if not all(isinstance(item, dict) for item in items):
+        return None
+    return items
+
+
+def bulk_response(results, writes):
+    """
+    Response of a bulk write. The ledger writes of the items are queued in one
+    insert, and the first BULK_SYNC_ITEMS of them are submitted right away, up
+    to the connection pool size at the same time. The others, and the failed
+    ones, are left to the transaction worker, their status can be followed at
+    their transaction URL.
+    :param results: Response data of every item, the transaction and its status are added to them.
+    :param writes: Ledger write of every item, as taken by outbox.enqueue.
+    :return: Response, 202 if some of the writes are left to the worker.
+    """
+    ledger_transactions = outbox.enqueue_many(writes, claimed=BULK_SYNC_ITEMS)
+    submitted = ledger_transactions[:BULK_SYNC_ITEMS]
+    errors = outbox.run(submitted)
+    errors += [None] * (len(ledger_transactions) - len(submitted))
+
+    for data, ledger_transaction, error in zip(results, ledger_transactions, errors):
+        data["transaction"] = ledger_transaction.id
+        data["status"] = ledger_transaction.status
+        if error is not None:
+            data["error"] = error
+
+    queued = any(ledger_transaction.status == 'PENDING' for ledger_transaction in ledger_transactions)
+    return Response({"results": results}, status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK)
+
 
 '''
 Generic views
@@ -41,6 +261,16 @@ Non-generic views
 '''
 
 
+def metrics(request):
+    """
+    Metrics of the ledger calls of this process, in Prometheus text format.
+    :param request:
+    :return:
+    """
+    return HttpResponse(render_metrics(bc.collect_metrics()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+
 @api_view(['GET'])
 def get_ministry_mask_amount(request):
     masks = bc.get_ministry_masks()
@@ -63,16 +293,15 @@ class ProducerMaskDetail(APIView):
         :param producer_id:
         :return:
         """
-        producer = models.Organization.objects.get(id=producer_id)
+        producer = directory.get(producer_id)
 
         if producer is None or producer.group != 'PRODUCER':
             return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
 
         mask_amount = bc.get_producer_masks(producer.key)
-        print(mask_amount)
 
         return Response({
-            "producer": OrganizationSerializer(producer).data,
+            "producer": directory.data(producer.id),
             "masks": mask_amount
         })
 
@@ -84,17 +313,67 @@ class ProducerMaskDetail(APIView):
         :return:
         """
         mask_amount = request.data['masks']
-        producer = models.Organization.objects.get(id=producer_id)
+        producer = directory.get(producer_id)
 
         if producer is None or producer.group != 'PRODUCER':
             return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        bc.update_mask(producer.key, int(mask_amount))
+        ledger_transaction = outbox.enqueue(
+            "update_mask",
+            {"producer_id": producer.key, "mask_amount": int(mask_amount)},
+            refresh=[("producer_masks", [producer.key])]
+        )
 
-        return Response({
-            "producer": OrganizationSerializer(producer).data,
+        return transaction_response({
+            "producer": directory.data(producer.id),
             "masks": mask_amount
-        })
+        }, ledger_transaction)
+
+
+class ProducerMaskBulk(APIView):
+    def put(self, request):
+        """
+        Update mask amounts of many producers. Nothing is written unless every item is valid.
+        Body: {"producers": [{"producer": 3, "masks": 1000}, ...]}
+        :param request:
+        :return: Result of every item in order, with its transaction.
+        """
+        items = bulk_items(request, "producers")
+        if items is None:
+            return Response({"error": "producers must be a list of 1 to {} objects".format(BULK_MAX_ITEMS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        errors = []
+        results = []
+        writes = []
+        for index, item in enumerate(items):
+            producer = directory.get(item.get("producer"))
+            if producer is None or producer.group != 'PRODUCER':
+                errors.append({"index": index, "error": "Not a producer"})
+                continue
+            if any(result["producer"]["id"] == producer.id for result in results):
+                errors.append({"index": index, "error": "Producer is listed twice"})
+                continue
+            try:
+                mask_amount = int(item["masks"])
+            except (KeyError, TypeError, ValueError):
+                mask_amount = -1
+            if mask_amount < 0:
+                errors.append({"index": index, "error": "masks must be zero or more"})
+                continue
+
+            results.append({"producer": directory.data(producer.id), "masks": mask_amount})
+            writes.append((
+                "update_mask",
+                {"producer_id": producer.key, "mask_amount": mask_amount},
+                None,
+                [("producer_masks", [producer.key])]
+            ))
+
+        if errors:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        return bulk_response(results, writes)
 
 
 @api_view(['GET'])
@@ -104,18 +383,17 @@ def get_all_producer_mask_amount(request):
     :param request:
     :return:
     """
-    producers = models.Organization.objects.filter(group='PRODUCER')
+    producers = directory.in_group('PRODUCER')
+    bc_results = mirror.get_many("producer_masks", [producer.key for producer in producers], verify='verify' in request.query_params)
 
     mask_amounts = []
-    for producer in producers:
-        mask_amount = bc.get_producer_masks(producer.key)
-
+    for producer, bc_result in zip(producers, bc_results):
         mask_amounts.append({
-            "producer": OrganizationSerializer(producer).data,
-            "masks": mask_amount
+            "producer": directory.data(producer.id),
+            "masks": -1 if bc_result.error else bc_result.value
         })
 
-    return Response(mask_amounts)
+    return ledger_response(mask_amounts)
 
 
 @api_view(['GET'])
@@ -125,13 +403,13 @@ def get_all_hospital_mask_amount(request):
     :param request:
     :return:
     """
-    producers = models.Organization.objects.filter(group='HOSPITAL')
+    producers = directory.in_group('HOSPITAL')
 
     mask_amounts = []
     for producer in producers:
         mask_amount = bc.get_(producer.key)
         mask_amounts.append({
-            "producer": OrganizationSerializer(producer).data,
+            "producer": directory.data(producer.id),
             "masks": mask_amount
         })
 
@@ -150,26 +428,29 @@ class MinistryOrder(APIView):
         :param request:
         :return:
         """
-        orders = list(models.MinistryOrder.objects.all())
+        orders = models.MinistryOrder.objects.all()
 
         if "unpaid" in request.query_params:
-            payments = models.Payment.objects.all()
-            for payment in payments:
-                for order in orders:
-                    if payment.order == order.id:
-                        orders.remove(order)
+            orders = orders.annotate(
+                paid=Exists(models.Payment.objects.filter(order=OuterRef('id')))
+            ).filter(paid=False)
 
-        result = []
-        for order in orders:
-            bc_order_id = order.id
-            bc_result = bc.get_ministry_order_info(bc_order_id)
+        if 'since' in request.query_params:
+            return delta_response(request, "ministry_order", orders)
 
-            if bc_result is None:
+        cursor = journal.safe_id()
+        paginator, orders = paginate(request, orders)
+
+        result = []
+        missing = 0
+        for bc_result in mirror.get_many("ministry_order", [order.id for order in orders], verify='verify' in request.query_params):
+            if bc_result.value is None:
+                missing += 1
                 continue
 
-            result.append(bc_result)
+            result.append(bc_result.value)
 
-        return Response(result)
+        return ledger_page_response(paginator, result, cursor, missing)
 
     def post(self, request):
         """
@@ -186,20 +467,17 @@ class MinistryOrder(APIView):
         else:
             mask_amount = int(mask_amount)
 
-        ministry = models.Organization.objects.filter(group='MINISTRY')[0]
+        ministry = directory.in_group('MINISTRY')[0]
         order_id = uuid.uuid1()
-        ministry_order = models.MinistryOrder(
-            id=order_id,
-            ministry=ministry
-        )
-
-        bc_success = bc.make_ministry_order(order_id, mask_amount, end_date)
 
-        if bc_success is False:
-            return Response({"error": "Blockchain error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        ledger_transaction = outbox.enqueue(
+            "make_ministry_order",
+            {"order_id": order_id, "mask_amount": mask_amount, "date_str": end_date},
+            record=("MinistryOrder", {"id": order_id, "ministry_id": ministry.id}),
+            refresh=[("ministry_order", [order_id])]
+        )
 
-        ministry_order.save()
-        return Response({"id": order_id}, status=status.HTTP_201_CREATED)
+        return transaction_response({"id": order_id}, ledger_transaction)
 
 
 @api_view(['GET'])
@@ -240,6 +518,8 @@ class DealList(APIView):
         if 'producer' in request.query_params:
             deals = deals.filter(producer__id=request.query_params['producer'])
 
+        paginator, deals = paginate(request, deals)
+
         result = []
         for deal in deals:
             delivery_id = bc.get_delivery_info(deal)
@@ -248,31 +528,51 @@ class DealList(APIView):
                 "delivery": delivery_id
             })
 
-        return Response(result)
+        missing = sum(1 for deal in result if deal["delivery"] is None)
+        return ledger_page_response(paginator, result, missing=missing)
 
 
 class DeliveryList(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+
     def get(self, request):
         """
-        Get all deliveries
+        Get all deliveries, streamed one per line with ?stream=1 or Accept: application/x-ndjson,
+        or the ones changed after a journal cursor with ?since=.
         :param request:
         :return:
         """
         deliveries = models.Delivery.objects.all()
+
+        def delivery_record(delivery, obj):
+            obj['producer'] = directory.data(delivery.producer_id)
+            return obj
+
+        if 'since' in request.query_params:
+            return delta_response(request, "delivery", deliveries, delivery_record)
+
+        if wants_stream(request):
+            return ledger_stream_response(stream_ledger_records(
+                "delivery", deliveries.order_by('-created_at'), 'verify' in request.query_params, delivery_record
+            ))
+
+        cursor = journal.safe_id()
+        paginator, deliveries = paginate(request, deliveries)
+        bc_results = mirror.get_many("delivery", [delivery.id for delivery in deliveries], verify='verify' in request.query_params)
+
         result = []
-        for delivery in deliveries:
-            obj = bc.get_delivery_info(delivery.id)
+        for delivery, bc_result in zip(deliveries, bc_results):
+            obj = bc_result.value
 
             if obj is not None:
-                obj['producer'] = OrganizationSerializer(delivery.producer).data
-
+                obj['producer'] = directory.data(delivery.producer_id)
 
             result.append(obj)
 
-        return Response(result)
+        return ledger_page_response(paginator, result, cursor, result.count(None))
 
     def patch(self, request):
-        delivery_id = request.data['delivery']
+        delivery_id = parse_id(request.data['delivery'])
         delivery_status = request.data['status']
 
         if delivery_id is None or delivery_status is None:
@@ -283,6 +583,8 @@ class DeliveryList(APIView):
         if bc_response is False:
             return Response({}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        mirror.refresh("delivery", [delivery_id])
+        events.publish("delivery", delivery_id, delivery_status)
         return Response({}, status=status.HTTP_202_ACCEPTED)
 
 '''
@@ -290,6 +592,66 @@ Hospital functions
 '''
 
 
+def hospital_order_lookups(query_params):
+    """
+    Filters of hospital orders on their ledger state, from the status, urgency,
+    date_from and date_to (YYYY-MM-DD, inclusive) query parameters.
+    :param query_params:
+    :return: Lookups on the fields of HospitalOrderMirror, None if a filter is invalid.
+    """
+    lookups = {}
+    try:
+        if 'status' in query_params:
+            lookups['status'] = query_params['status']
+        if 'urgency' in query_params:
+            lookups['urgency'] = int(query_params['urgency'])
+        if 'date_from' in query_params:
+            date_from = datetime.datetime.strptime(query_params['date_from'], "%Y-%m-%d")
+            lookups['date__gte'] = date_from.strftime("%Y-%m-%d")
+        if 'date_to' in query_params:
+            date_to = datetime.datetime.strptime(query_params['date_to'], "%Y-%m-%d")
+            lookups['date__lt'] = (date_to + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+    return lookups
+
+
+def prefilter_hospital_orders(orders, lookups, verify):
+    """
+    Filter hospital orders on their mirrored state before any ledger work,
+    unless verifying. Orders which are not mirrored yet are kept, they are
+    filtered with matches_lookups once fetched.
+    :param orders: Queryset of HospitalOrder.
+    :param lookups: Lookups from hospital_order_lookups.
+    :param verify: True if the records are fetched from the ledger.
+    :return: Queryset of HospitalOrder.
+    """
+    if not lookups or verify:
+        return orders
+    return orders.filter(
+        Q(**{'mirror__' + lookup: value for lookup, value in lookups.items()}) | Q(mirror__isnull=True)
+    )
+
+
+def matches_lookups(value, lookups):
+    """
+    Apply hospital order lookups to an order fetched from the ledger.
+    :param value: Hospital order as returned by bc.get_hospital_order_info.
+    :param lookups: Lookups from hospital_order_lookups.
+    :return: True if the order passes every filter.
+    """
+    for lookup, expected in lookups.items():
+        field, _, operator = lookup.partition('__')
+        actual = value[field]
+        if operator == 'gte' and not actual >= expected:
+            return False
+        if operator == 'lt' and not actual < expected:
+            return False
+        if not operator and str(actual) != str(expected):
+            return False
+    return True
+
+
 class HospitalOrderDetail(APIView):
     def get(self, request, hospital_id):
         """
@@ -297,7 +659,7 @@ class HospitalOrderDetail(APIView):
         :param request:
         :return:
         """
-        hospital = get_object_or_404(models.Organization, id=hospital_id)
+        hospital = get_organization_or_404(hospital_id)
 
         if hospital.group != 'HOSPITAL':
             return Response({"error": "Organization is not hospital"}, status=status.HTTP_400_BAD_REQUEST)
@@ -310,78 +672,164 @@ class HospitalOrderDetail(APIView):
 
         orders = models.HospitalOrder.objects.filter(hospital=hospital)
 
-        for order in orders:
-            bc_result = bc.get_hospital_order_info(order.id)
-
-            if bc_result is None:
+        missing = 0
+        for bc_result in mirror.get_many("hospital_order", [order.id for order in orders], verify='verify' in request.query_params):
+            if bc_result.value is None:
+                missing += 1
                 continue
 
-            hospital_obj["orders"].append(bc_result)
+            hospital_obj["orders"].append(bc_result.value)
 
         orders = hospital_obj["orders"]
         hospital_obj["orders"] = sorted(orders, key=lambda k: k['date'], reverse=True)
 
-        return Response(hospital_obj)
+        hospital_obj["degraded"] = bc.breaker.is_open
+        hospital_obj["partial"] = missing > 0
+
+        return ledger_response(hospital_obj, missing)
 
     def post(self, request, hospital_id):
         hospital_id = int(hospital_id)
         mask_amount = request.data["masks"]
         urgency = request.data["urgency"]
 
-        hospital = get_object_or_404(models.Organization, id=hospital_id)
+        hospital = get_organization_or_404(hospital_id)
 
         if hospital.group != 'HOSPITAL':
             return Response({"error": "Wrong organization"}, status=status.HTTP_400_BAD_REQUEST)
 
         order_key = uuid.uuid1()
-        hospital_order = models.HospitalOrder(
-            id=order_key,
-            hospital=hospital
+
+        ledger_transaction = outbox.enqueue(
+            "make_hospital_order",
+            {"order_id": order_key, "mask_amount": int(mask_amount), "hospital_id": hospital.key, "urgency": urgency},
+            record=("HospitalOrder", {"id": order_key, "hospital_id": hospital.id}),
+            refresh=[("hospital_order", [order_key])]
         )
 
-        bc_success = bc.make_hospital_order(order_key, int(mask_amount), hospital.key, urgency)
+        return transaction_response({"order": order_key}, ledger_transaction)
 
-        if not bc_success:
-            return Response({"error": "Blockchain error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        hospital_order.save()
-        return Response({"order": order_key})
+class HospitalOrderBulk(APIView):
+    def post(self, request):
+        """
+        Create many hospital orders. Nothing is written unless every item is valid.
+        Body: {"orders": [{"hospital": 5, "masks": 100, "urgency": 1}, ...]}
+        :param request:
+        :return: Result of every item in order, with its order and transaction.
+        """
+        items = bulk_items(request, "orders")
+        if items is None:
+            return Response({"error": "orders must be a list of 1 to {} objects".format(BULK_MAX_ITEMS)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        errors = []
+        results = []
+        writes = []
+        for index, item in enumerate(items):
+            hospital = directory.get(item.get("hospital"))
+            if hospital is None or hospital.group != 'HOSPITAL':
+                errors.append({"index": index, "error": "Wrong organization"})
+                continue
+            try:
+                mask_amount = int(item["masks"])
+                urgency = int(item["urgency"])
+            except (KeyError, TypeError, ValueError):
+                errors.append({"index": index, "error": "masks and urgency must be numbers"})
+                continue
+            if mask_amount <= 0:
+                errors.append({"index": index, "error": "masks must be a positive number"})
+                continue
+
+            order_key = uuid.uuid1()
+            results.append({"order": order_key, "hospital": hospital.id})
+            writes.append((
+                "make_hospital_order",
+                {"order_id": order_key, "mask_amount": mask_amount, "hospital_id": hospital.key, "urgency": urgency},
+                ("HospitalOrder", {"id": order_key, "hospital_id": hospital.id}),
+                [("hospital_order", [order_key])]
+            ))
+
+        if errors:
+            return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        return bulk_response(results, writes)
 
 
 class HospitalOrderList(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+
     def get(self, request):
         """
-            Gets hospital orders from all hospitals.
+            Gets hospital orders from all hospitals, paged newest first and grouped by the hospitals
+            with orders on the page. With ?stream=1 or Accept: application/x-ndjson,
+            orders are streamed one per line along with their hospital instead. With ?since=, the
+            orders changed after a journal cursor are returned along with their hospital.
             :param request:
             :return:
             """
+        verify = 'verify' in request.query_params
+        lookups = hospital_order_lookups(request.query_params)
+        if lookups is None:
+            return Response({"error": "Invalid filter"}, status=status.HTTP_400_BAD_REQUEST)
+
         hospitals = models.Organization.objects.filter(group='HOSPITAL')
+        if 'hospital' in request.query_params:
+            hospital_ids = [as_id(hospital_id) for hospital_id in request.query_params['hospital'].split(',')]
+            hospitals = hospitals.filter(id__in=[hospital_id for hospital_id in hospital_ids if hospital_id is not None])
+
+        def order_record(order, obj):
+            if obj["amount"] == -1 or not matches_lookups(obj, lookups):
+                return None
+            obj["hospital"] = directory.data(order.hospital_id)
+            return obj
+
+        if 'since' in request.query_params:
+            return delta_response(request, "hospital_order", models.HospitalOrder.objects.filter(hospital__in=hospitals), order_record)
+
+        if wants_stream(request):
+            orders = prefilter_hospital_orders(models.HospitalOrder.objects.filter(hospital__in=hospitals), lookups, verify)
+            return ledger_stream_response(stream_ledger_records(
+                "hospital_order", orders.order_by('hospital_id', '-created_at'), verify, order_record
+            ))
+
+        # Pages of orders in creation order, newest first, grouped by their hospital
+        cursor = journal.safe_id()
+        orders = prefilter_hospital_orders(models.HospitalOrder.objects.filter(hospital__in=hospitals), lookups, verify)
+        paginator, orders = paginate(request, orders)
+        bc_results = mirror.get_many("hospital_order", [order.id for order in orders], verify=verify)
 
         result = []
-        for hospital in hospitals:
-            hospital_obj = {
-                "id": hospital.id,
-                "name": hospital.name,
-                "orders": [],
-                "dirty": False
-            }
-
-            orders = models.HospitalOrder.objects.filter(hospital=hospital)
-
-            for order in orders:
-                bc_result = bc.get_hospital_order_info(order.id)
-
-                if bc_result is None or bc_result["amount"] == -1:
-                    hospital_obj["dirty"] = True
-                    continue
-                hospital_obj["orders"].append(bc_result)
+        hospital_objs = {}
+        missing = 0
+        for order, bc_result in zip(orders, bc_results):
+            hospital_obj = hospital_objs.get(order.hospital_id)
+            if hospital_obj is None:
+                hospital = directory.get(order.hospital_id)
+                hospital_obj = hospital_objs[order.hospital_id] = {
+                    "id": hospital.id,
+                    "name": hospital.name,
+                    "orders": [],
+                    "dirty": False
+                }
+                result.append(hospital_obj)
+
+            bc_result = bc_result.value
 
-            result.append(hospital_obj)
+            if bc_result is None:
+                missing += 1
+                hospital_obj["dirty"] = True
+                continue
+            if bc_result["amount"] == -1:
+                hospital_obj["dirty"] = True
+                continue
+            if matches_lookups(bc_result, lookups):
+                hospital_obj["orders"].append(bc_result)
 
-        return Response(result)
+        return ledger_page_response(paginator, result, cursor, missing)
 
     def patch(self, request):
-        order_id = request.data['order']
+        order_id = parse_id(request.data['order'])
         order_status = request.data['status']
 
         if order_id is None or order_status is None:
@@ -392,6 +840,8 @@ class HospitalOrderList(APIView):
         if bc_success is False:
             return Response({"error": "Blockchain request failed"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        mirror.refresh("hospital_order", [order_id])
+        events.publish("hospital_order", order_id, order_status)
         return Response(True, status=status.HTTP_202_ACCEPTED)
 
 
@@ -407,24 +857,32 @@ class PaymentLetterList(APIView):
         :param request:
         :return:
         """
-        payment_letters = models.PaymentLetter.objects.all()
+        payment_letters = models.PaymentLetter.objects.select_related('bank')
 
         if 'bank' in request.query_params:
             payment_letters = payment_letters.filter(bank__id=request.query_params['bank'])
 
         if 'producer' in request.query_params:
             producer_payments = models.Payment.objects.filter(producer__id=request.query_params['producer'])
-            orders = list(map(lambda x: x['order'], PaymentSerializer(producer_payments, many=True).data))
-            payment_letters = payment_letters.filter(order__in=orders)
+            payment_letters = payment_letters.filter(order__in=producer_payments.values('order'))
+
+        paginator, payment_letters = paginate(request, payment_letters)
+        bc_results = mirror.get_many("payment_letter", [payment_letter.id for payment_letter in payment_letters], verify='verify' in request.query_params)
 
         result = []
-        for payment_letter in payment_letters:
-            letter = bc.get_payment_letter_info(payment_letter.id)
-            letter["name"] = payment_letter.bank.name
-            letter["order"] = payment_letter.order
+        missing = 0
+        for payment_letter, bc_result in zip(payment_letters, bc_results):
+            letter = bc_result.value
+
+            if letter is None:
+                missing += 1
+                continue
+
+            letter["name"] = None if payment_letter.bank is None else payment_letter.bank.name
+            letter["order"] = payment_letter.order_id
             result.append(letter)
 
-        return Response(result)
+        return ledger_page_response(paginator, result, missing=missing)
 
     def post(self, request):
         """
@@ -435,72 +893,33 @@ class PaymentLetterList(APIView):
         bank_id = request.data["bank"]
         payment_id = request.data["payment"]
 
-        bank = get_object_or_404(models.Organization, id=bank_id)
+        bank = get_organization_or_404(bank_id)
 
         if bank.group != "BANK":
             return Response({"error": "Wrong organization type."}, status=status.HTTP_400_BAD_REQUEST)
 
         payment = get_object_or_404(models.Payment, id=payment_id)
 
-        payment_letter_id = uuid.uuid1()
-        payment_letter = models.PaymentLetter(
-            id=payment_letter_id,
-            bank=bank,
-            order=payment.order
-        )
-
-        bc_success = bc.create_payment_letter(payment_letter_id, bank.key, str(int(payment.price)))
-
-        if bc_success is False:
-            return Response({"error": "Blockchain request failed for payment letter."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        payment_letter.save()
-
-        # Get order
-        order = bc.get_ministry_order_info(payment.order)
-        winner_offer = order['winner']
-
-        if winner_offer is None:
-            # TODO handle
-            pass
-
-
-        # Get offer
-        offer = bc.get_producer_offer_info(winner_offer)
-        producer_id = offer['producer']
-        producer = get_object_or_404(models.Organization, key=producer_id)
-
-        if producer_id is None:
-            # TODO handle
-            pass
-
-        # Create deal
-        deal_id = uuid.uuid1()
-        deal = models.Deal(
-            id=deal_id,
-            producer=producer,
-            letter=payment_letter_id
-        )
-        bc_success = bc.create_deal(deal_id, producer_id, payment.price, payment_letter_id, order['amount'])
-
-        if bc_success is False:
-            # TODO handle
-            return
-        deal.save()
+        # Settlement of the payment is resumed from its last completed step if it failed before,
+        # a payment settled already gets the ids of its settlement back
+        try:
+            payment_settlement = settlement.begin(bank, payment)
+        except settlement.SettlementBusy:
+            return Response({"error": "Settlement of the payment is in progress."}, status=status.HTTP_409_CONFLICT)
 
-        # Create delivery
-        delivery_id = uuid.uuid1()
-        delivery = models.Delivery(
-            id=delivery_id,
-            producer=producer
-        )
-        bc_success = bc.create_delivery(delivery_id, producer_id, "1")
+        if payment_settlement.status != 'COMPLETED':
+            payment_settlement = settlement.settle(payment_settlement)
 
-        if bc_success is False:
-            # TODO handle
-            return
-        delivery.save()
+        if payment_settlement.status != 'COMPLETED':
+            return Response({"error": payment_settlement.last_error, "settlement": payment_settlement.id},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return Response({"letter": payment_letter_id, "deal": deal_id, "delivery": delivery_id})
+        return Response({
+            "letter": payment_settlement.letter_id,
+            "deal": payment_settlement.deal_id,
+            "delivery": payment_settlement.delivery_id,
+            "settlement": payment_settlement.id
+        })
 
 
 '''
@@ -509,9 +928,12 @@ Offers
 
 
 class ProducerOfferList(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+
     def get(self, request):
         """
-        Get all producer offers.
+        Get all producer offers, streamed one per line with ?stream=1 or Accept: application/x-ndjson,
+        or the ones changed after a journal cursor with ?since=.
         :param request:
         :return:
         """
@@ -521,15 +943,31 @@ class ProducerOfferList(APIView):
             offers = offers.filter(producer=request.query_params['producer'])
 
         if 'order' in request.query_params:
-            offers = offers.filter(order=request.query_params['order'])
+            order_id = parse_id(request.query_params['order'])
+            if order_id is None:
+                return Response({"error": "Invalid order id."}, status=status.HTTP_400_BAD_REQUEST)
+            offers = offers.filter(order=order_id)
+
+        if 'since' in request.query_params:
+            return delta_response(request, "producer_offer", offers)
+
+        if wants_stream(request):
+            return ledger_stream_response(stream_ledger_records(
+                "producer_offer", offers.order_by('-created_at'), 'verify' in request.query_params
+            ))
+
+        cursor = journal.safe_id()
+        paginator, offers = paginate(request, offers)
 
         result = []
-        for offer in offers:
-            bc_result = bc.get_producer_offer_info(offer.id)
-            if bc_result:
-                result.append(bc_result)
+        missing = 0
+        for bc_result in mirror.get_many("producer_offer", [offer.id for offer in offers], verify='verify' in request.query_params):
+            if bc_result.value:
+                result.append(bc_result.value)
+            else:
+                missing += 1
 
-        return Response(result, status=status.HTTP_200_OK)
+        return ledger_page_response(paginator, result, cursor, missing)
 
     def post(self, request):
         """
@@ -538,28 +976,28 @@ class ProducerOfferList(APIView):
         :return:
         """
         producer_id = request.data["producer"]
-        order_id = request.data["order"]
+        order_id = parse_id(request.data["order"])
         offer_price = request.data["offer"]
 
-        producer = get_object_or_404(models.Organization, id=producer_id)
+        producer = get_organization_or_404(producer_id)
 
         if producer.group != "PRODUCER":
             return Response({"error": "Wrong organization type."}, status=status.HTTP_400_BAD_REQUEST)
 
-        offer_id = uuid.uuid1()
-        offer = models.ProducerOffer(
-            id=offer_id,
-            producer=producer,
-            order=order_id
-        )
+        if order_id is None:
+            return Response({"error": "Invalid order id."}, status=status.HTTP_400_BAD_REQUEST)
+        get_object_or_404(models.MinistryOrder, id=order_id)
 
-        bc_success = bc.create_producer_offer(offer_id, producer.key, order_id, offer_price)
+        offer_id = uuid.uuid1()
 
-        if bc_success is False:
-            return Response({"error": "Blockchain request failed."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        ledger_transaction = outbox.enqueue(
+            "create_producer_offer",
+            {"offer_id": offer_id, "producer_id": producer.key, "order_id": order_id, "offer": offer_price},
+            record=("ProducerOffer", {"id": offer_id, "producer_id": producer.id, "order_id": order_id}),
+            refresh=[("producer_offer", [offer_id])]
+        )
 
-        offer.save()
-        return Response({"id": offer_id}, status=status.HTTP_201_CREATED)
+        return transaction_response({"id": offer_id}, ledger_transaction)
 
 
 class ProducerOfferDetail(APIView):
@@ -586,7 +1024,7 @@ class ProducerOfferDetail(APIView):
         """
 
         offer = get_object_or_404(models.ProducerOffer, id=offer_id)
-        order_id = offer.order
+        order_id = offer.order_id
 
         if order_id is None or offer_id is None:
             return Response({"error": "Missing data"}, status=status.HTTP_400_BAD_REQUEST)
@@ -596,6 +1034,9 @@ class ProducerOfferDetail(APIView):
         if bc_response is False:
             return Response({"error": "Blockchain request failed"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        # Other offers of the order may change status as well
+        mirror.refresh("ministry_order", [order_id])
+        mirror.refresh("producer_offer", models.ProducerOffer.objects.filter(order=order_id).values_list('id', flat=True))
         return Response({"message": "Offer accepted"}, status=status.HTTP_202_ACCEPTED)
 
 
@@ -611,31 +1052,22 @@ class PaymentList(APIView):
         :param request:
         :return:
         """
-        payments = models.Payment.objects.all()
+        payments = models.Payment.objects.select_related('producer')
 
         if 'order' in request.query_params:
-            payments = payments.filter(order=request.query_params['order'])
-
-        payments = PaymentSerializer(payments, many=True).data
-
-        for payment in payments:
-            payment['producerName'] = models.Organization.objects.get(id=payment['producer']).name
+            order_id = parse_id(request.query_params['order'])
+            if order_id is None:
+                return Response({"error": "Invalid order id."}, status=status.HTTP_400_BAD_REQUEST)
+            payments = payments.filter(order=order_id)
 
         if 'unpaid' in request.query_params:
-            payment_letters = models.PaymentLetter.objects.all()
-            result = []
-            for payment in payments:
-                found = False
-                for letter in payment_letters:
-                    if payment['order'] == letter.order:
-                        found = True
-
-                if not found:
-                    result.append(payment)
-            payments = result
-
+            payments = payments.annotate(
+                has_letter=Exists(models.PaymentLetter.objects.filter(order=OuterRef('order')))
+            ).filter(has_letter=False)
 
-        return Response(payments)
+        # Payment ids follow creation order
+        paginator, payments = paginate(request, payments, ordering='-id')
+        return paginator.get_paginated_response(PaymentSerializer(payments, many=True).data)
 
     def post(self, request):
         """
@@ -645,15 +1077,110 @@ class PaymentList(APIView):
         """
 
         price = request.data['price']
-        order = request.data['order']
+        order_id = parse_id(request.data['order'])
         producer_id = request.data['producer']
 
-        producer = get_object_or_404(models.Organization, key=producer_id)
+        producer = get_organization_or_404(key=producer_id)
 
-        if order is None or price is None:
+        if order_id is None or price is None:
             return Response({"error": "Invalid data"}, status=status.HTTP_400_BAD_REQUEST)
 
+        order = get_object_or_404(models.MinistryOrder, id=order_id)
         payment = models.Payment(price=price, order=order, producer=producer)
         payment.save()
 
+        # The order leaves the unpaid ministry orders
+        journal.record("ministry_order", [order.id])
+
         return Response(PaymentSerializer(payment).data, status=status.HTTP_201_CREATED)
+
+
+'''
+Batch queries
+'''
+
+
+class BatchQuery(APIView):
+    def post(self, request):
+        """
+        Run many queries in one request, like the lists a dashboard is made of.
+        Their SQL and ledger lookups are deduplicated and batched together, so
+        records shared by queries are looked up once.
+        Body: {"queries": [{"query": "offers", "params": {"producer": 3, "orders": true}}, ...]}
+        :param request:
+        :return: Result of every query in order, as {"data": ...} or {"error": ...}.
+        """
+        batch = request.data.get("queries") if isinstance(request.data, dict) else None
+        if not isinstance(batch, list) or not all(isinstance(item, dict) for item in batch):
+            return Response({"error": "queries must be a list of objects"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(batch) > queries.MAX_QUERIES:
+            return Response({"error": "At most {} queries are allowed".format(queries.MAX_QUERIES)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(batch)
+        generators = {}
+        for index, item in enumerate(batch):
+            query = queries.QUERIES.get(item.get("query"))
+            params = item.get("params") or {}
+            if query is None:
+                results[index] = QueryError("Unknown query {!r}".format(item.get("query")))
+            elif not isinstance(params, dict):
+                results[index] = QueryError("params must be an object")
+            else:
+                generators[index] = query(params)
+
+        loader = DataLoader(verify='verify' in request.query_params)
+        for index, result in zip(generators, loader.run(list(generators.values()))):
+            results[index] = result
+
+        return ledger_response({"results": [
+            {"error": str(result)} if isinstance(result, QueryError) else {"data": result} for result in results
+        ]})
+
+
+'''
+Ledger transactions
+'''
+
+
+class TransactionDetail(APIView):
+    def get(self, request, transaction_id):
+        """
+        Get the status of a queued ledger write.
+        :param request:
+        :param transaction_id:
+        :return:
+        """
+        ledger_transaction = get_object_or_404(models.LedgerTransaction, id=transaction_id)
+        return Response(LedgerTransactionSerializer(ledger_transaction).data)
+
+
+'''
+Status events
+'''
+
+
+class StatusEventList(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer]
+
+    def get(self, request):
+        """
+        Stream status changes of deliveries and hospital orders as server-sent
+        events, in place of polling the lists. Reconnecting clients resume
+        from the Last-Event-ID header, or the last_event_id query parameter.
+        Events can be limited to some kinds with ?kind=delivery,hospital_order.
+        :param request:
+        :return:
+        """
+        kinds = request.query_params['kind'].split(',') if 'kind' in request.query_params else events.KINDS
+        if any(kind not in events.KINDS for kind in kinds):
+            return Response({"error": "Invalid kind"}, status=status.HTTP_400_BAD_REQUEST)
+
+        last_id = request.META.get('HTTP_LAST_EVENT_ID', request.query_params.get('last_event_id'))
+        if last_id is not None:
+            try:
+                last_id = int(last_id)
+            except ValueError:
+                return Response({"error": "Invalid event id"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return event_stream_response(events.stream(last_id, kinds))
@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 import os
 import datetime
 
+from corsheaders.defaults import default_headers
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -55,6 +57,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.middleware.RequestDeadlineMiddleware',
+    'api.middleware.LedgerCacheMiddleware',
+    'api.middleware.IdempotencyMiddleware',
 ]
 
 ROOT_URLCONF = 'medical_equipment.urls'
@@ -144,6 +149,19 @@ CORS_ORIGIN_WHITELIST = (
     'localhost:8081',
 )
 
+CORS_ALLOW_HEADERS = default_headers + (
+    'x-request-deadline',
+    'idempotency-key',
+    'last-event-id',
+)
+
+CORS_EXPOSE_HEADERS = (
+    'x-ledger-degraded',
+    'x-ledger-partial',
+    'idempotent-replayed',
+    'x-sync-cursor',
+)
+
 # REST settings
 
 REST_FRAMEWORK = {
@@ -157,6 +175,47 @@ REST_FRAMEWORK = {
     'TEST_REQUEST_DEFAULT_FORMAT': 'json'
 }
 
+# Time budget of a request for its ledger calls in seconds, clients can ask for another one
+# with the X-Request-Deadline header up to the max.
+REQUEST_DEADLINE = 15
+REQUEST_DEADLINE_MAX = 60
+
+# Responses of writes sent with an Idempotency-Key header are replayed for this long
+IDEMPOTENCY_KEY_TTL = datetime.timedelta(hours=24)
+
+# Status events kept for clients to resume from, older ones are dropped
+STATUS_EVENTS_MAX = 10000
+
+# Event streams are closed after this long in seconds, browsers reconnect with Last-Event-ID a second
+# later and get the events published meanwhile. An open stream holds a worker and reads the events
+# table every second, so streams are kept short instead of open for as long as the page is.
+STATUS_EVENTS_STREAM_SECONDS = 5
+
+# Journal entries kept for clients to sync lists from, older cursors have to reload the lists
+CHANGE_JOURNAL_MAX = 100000
+
+# Seconds a transaction may take to commit. Journal cursors and event ids are held back behind newer entries, so
+# that the entries of transactions committing out of order are not skipped.
+CURSOR_COMMIT_LAG = 5
+
+# Logging, set API_LOG_LEVEL=DEBUG to log the ledger request and response bodies
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': os.environ.get('API_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
 # API Auth
 JWT_AUTH = {
     'JWT_ALLOW_REFRESH': True,